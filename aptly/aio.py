@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import time
+import logging
+import threading
+
+import aiohttp
+
+from aptly.exceptions import AptlyException, TaskTimeout
+from aptly.tasks import Task, TASK_SUCCEEDED, backoff
+from aptly.cache import Cache
+from aptly.client import has_feature
+from aptly.metrics import Metrics
+from aptly.transport import get_codec, encode_body, LogPayload
+
+lg = logging.getLogger(__name__)
+
+
+class AsyncResponse(object):
+    """
+    Response of AsyncAptly request
+
+    Provides attributes of requests.Response used by consumers of
+    AptlyException (status_code, reason, text, json)
+    """
+    def __init__(self, status_code, reason, text, url=None):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncAptly(object):
+    """
+    Asyncio Aptly client with same interface as aptly.client.Aptly
+
+    All requests share one aiohttp session with connection pool limited to
+    pool_size connections, so many requests can be in flight at once.
+    Call connect() (or use as async context manager) before first request.
+    """
+    def __init__(self, url, auth=None, timeout=300, dry=False, pool_size=100,
+                 use_tasks=False, task_timeout=None, task_poll_interval=0.5,
+                 task_poll_max=10, cache=None, package_store=None,
+                 metrics=None, codec='auto', stream_requests=False,
+                 compress_requests=False, log_max_length=1024):
+        self.url = '%s%s' % (url, '/api')
+        self.timeout = timeout
+        self.dry = dry
+
+        # Transport of large payloads, see aptly.client.Aptly
+        self.codec = codec if hasattr(codec, 'loads') else get_codec(codec)
+        self.stream_requests = stream_requests
+        self.compress_requests = compress_requests
+        self.log_max_length = log_max_length
+
+        # Cache of results read by publisher, invalidated by our own
+        # mutating calls
+        self.cache = cache if cache is not None else Cache()
+        # Per-endpoint request metrics, see aptly.metrics.Metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Optional aptly.store.PackageStore persisting snapshot packages
+        self.package_store = package_store
+
+        # Submit mutating calls as aptly background tasks
+        self.use_tasks = use_tasks
+        self.task_timeout = task_timeout
+        self.task_poll_interval = task_poll_interval
+        self.task_poll_max = task_poll_max
+        self.task_history = []
+
+        self.auth = aiohttp.BasicAuth(*auth) if auth is not None else None
+        self.pool_size = pool_size
+        self.session = None
+        self.api_version = None
+        self.disabled_features = set()
+
+    async def connect(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                auth=self.auth,
+                headers={
+                    'Accept': 'application/json',
+                    'Content-type': 'application/json',
+                },
+            )
+        self.api_version = await self.get_version()
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get_version(self):
+        return (await self.do_get('/version'))["Version"]
+
+    def has_feature(self, feature):
+        return feature not in self.disabled_features and has_feature(self.api_version, feature)
+
+    def disable_feature(self, feature):
+        self.disabled_features.add(feature)
+
+    def _process_result(self, res):
+        if res.status_code < 200 or res.status_code >= 300:
+            raise AptlyException(
+                res,
+                "Something went wrong: %s (%s)" % (res.reason, res.status_code)
+            )
+        try:
+            return self.codec.loads(res.text)
+        except ValueError:
+            return res.text
+
+    def _task_params(self):
+        return {'_async': 'true'} if self.use_tasks else None
+
+    async def _process_task(self, result, method, uri, wait):
+        if not self.use_tasks:
+            return result
+
+        task = Task(result, method, uri)
+        lg.debug("Submitted task %s for %s %s" % (task.id, method, uri))
+        if wait:
+            return await self.wait_task(task)
+        return task
+
+    async def _finish_task(self, task):
+        try:
+            return_value = await self.do_get('/tasks/%s/return_value' % task.id)
+        except AptlyException as e:
+            if e.res.status_code != 404:
+                raise
+            # Older aptly without return values
+            return_value = None
+
+        output = None
+        if task.state != TASK_SUCCEEDED or return_value is None:
+            try:
+                output = await self.do_get('/tasks/%s/output' % task.id)
+            except AptlyException:
+                pass
+
+        task.set_return_value(return_value, output)
+        self.cache.invalidate_uri(task.uri)
+        self.task_history.append(task)
+        lg.info("Task %s %s %s in %.1fs" % (task.id, task.name, task.state_name, task.duration))
+
+        try:
+            await self.do_delete('/tasks/%s' % task.id)
+        except AptlyException as e:
+            lg.debug("Can't delete finished task %s: %s" % (task.id, e))
+
+    async def wait_task(self, task, timeout=None):
+        return (await self.wait_tasks([task], timeout=timeout))[0]
+
+    async def wait_tasks(self, tasks, timeout=None, raise_error=True):
+        """
+        Wait for all background tasks to finish, see
+        aptly.client.Aptly.wait_tasks
+        """
+        timeout = timeout or self.task_timeout
+        deadline = time.time() + timeout if timeout else None
+        pending = [task for task in tasks if not task.done]
+
+        for interval in backoff(self.task_poll_interval, self.task_poll_max):
+            states = []
+            if len(pending) == 1:
+                states = [await self.do_get('/tasks/%s' % pending[0].id)]
+            elif pending:
+                states = await self.do_get('/tasks')
+            states = dict((state['ID'], state) for state in states)
+
+            finished = []
+            for task in list(pending):
+                if task.id in states:
+                    task.update(states[task.id])
+                if task.done:
+                    finished.append(task)
+                    pending.remove(task)
+            await asyncio.gather(*[self._finish_task(task) for task in finished])
+
+            if not pending:
+                break
+
+            if deadline and time.time() + interval > deadline:
+                raise TaskTimeout("Tasks %s didn't finish in %ss" % (pending, timeout))
+            await asyncio.sleep(interval)
+
+        if raise_error:
+            for task in tasks:
+                if task.error:
+                    raise task.error
+        return [task.result for task in tasks]
+
+    async def _request(self, method, url, timeout=None, **kwargs):
+        uri = url[len(self.url):]
+        sent = [0]
+        data = kwargs.pop('data', None)
+        if data is not None:
+            kwargs['data'] = self._body(data, sent)
+            if self.compress_requests:
+                kwargs['headers'] = {'Content-Encoding': 'gzip'}
+        start = time.time()
+        try:
+            async with self.session.request(
+                method,
+                url,
+                timeout=aiohttp.ClientTimeout(total=timeout or self.timeout),
+                **kwargs
+            ) as res:
+                text = await res.text()
+        except Exception:
+            self.metrics.record(method, uri, None, time.time() - start, sent[0])
+            raise
+        finally:
+            if method != 'GET':
+                self.cache.invalidate_uri(uri)
+        self.metrics.record(method, uri, res.status, time.time() - start,
+                            sent[0], len(text))
+        return self._process_result(
+            AsyncResponse(res.status, res.reason, text, url=url)
+        )
+
+    def _body(self, data, sent):
+        """
+        Return request body encoded by configured codec, async generator of
+        chunks with stream_requests (sent as chunked request)
+        """
+        body = encode_body(data, self.codec, stream=self.stream_requests,
+                           compress=self.compress_requests)
+        if not self.stream_requests:
+            sent[0] = len(body)
+            return body
+
+        async def chunks():
+            for chunk in body:
+                sent[0] += len(chunk)
+                yield chunk
+        return chunks()
+
+    def _log_request(self, method, uri, data=None):
+        # Payload is formatted only when debug message is emitted
+        if data:
+            lg.debug("%s %s%s, data=%s", method, self.url, uri,
+                     LogPayload(data, self.log_max_length))
+        else:
+            lg.debug("%s %s%s", method, self.url, uri)
+
+    async def do_get(self, uri, kwargs=None, timeout=None):
+        url = '%s%s' % (self.url, uri)
+        lg.debug("GET %s, args=%s" % (url, kwargs))
+        return await self._request('GET', url, timeout=timeout, params=kwargs)
+
+    async def do_get_many(self, uris, timeout=None):
+        """
+        Get list of URIs concurrently, return list of results in same order
+        """
+        return await asyncio.gather(
+            *[self.do_get(uri, timeout=timeout) for uri in uris]
+        )
+
+    async def do_post(self, uri, data, timeout=None, wait=True):
+        url = '%s%s' % (self.url, uri)
+        self._log_request('POST', uri, data)
+
+        if self.dry:
+            return
+
+        result = await self._request('POST', url, timeout=timeout,
+                                     data=data,
+                                     params=self._task_params())
+        return await self._process_task(result, 'POST', uri, wait)
+
+    async def do_delete(self, uri, data=None, timeout=None, wait=True):
+        url = '%s%s' % (self.url, uri)
+        self._log_request('DELETE', uri, data)
+
+        if self.dry:
+            return
+
+        # Deleting of tasks itself is not a task
+        use_task = not uri.startswith('/tasks/')
+        result = await self._request('DELETE', url, timeout=timeout,
+                                     data=data or None,
+                                     params=self._task_params() if use_task else None)
+        if not use_task:
+            return result
+        return await self._process_task(result, 'DELETE', uri, wait)
+
+    async def do_put(self, uri, data, timeout=None, wait=True):
+        url = '%s%s' % (self.url, uri)
+        self._log_request('PUT', uri, data)
+
+        if self.dry:
+            return
+
+        result = await self._request('PUT', url, timeout=timeout,
+                                     data=data,
+                                     params=self._task_params())
+        return await self._process_task(result, 'PUT', uri, wait)
+
+
+class AptlyBridge(object):
+    """
+    Blocking facade of AsyncAptly compatible with aptly.client.Aptly
+
+    Runs single event loop in background thread and submits every call to
+    it, so Publish and PublishManager can drive AsyncAptly without changes.
+    Calls made from multiple threads (eg. concurrent publishes) share one
+    connection pool and do_get_many keeps all requests in flight at once
+    without thread per request.
+    """
+    def __init__(self, url, auth=None, timeout=300, dry=False, pool_size=100,
+                 **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='aptly-aio')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.aclient = AsyncAptly(url, auth=auth, timeout=timeout, dry=dry,
+                                  pool_size=pool_size, **kwargs)
+        self._run(self.aclient.connect())
+
+    @property
+    def url(self):
+        return self.aclient.url
+
+    @property
+    def timeout(self):
+        return self.aclient.timeout
+
+    @property
+    def dry(self):
+        return self.aclient.dry
+
+    @property
+    def api_version(self):
+        return self.aclient.api_version
+
+    @property
+    def cache(self):
+        return self.aclient.cache
+
+    @property
+    def metrics(self):
+        return self.aclient.metrics
+
+    @property
+    def package_store(self):
+        return self.aclient.package_store
+
+    @property
+    def use_tasks(self):
+        return self.aclient.use_tasks
+
+    @property
+    def task_history(self):
+        return self.aclient.task_history
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        self._run(self.aclient.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def get_version(self):
+        return self._run(self.aclient.get_version())
+
+    def has_feature(self, feature):
+        return self.aclient.has_feature(feature)
+
+    def disable_feature(self, feature):
+        self.aclient.disable_feature(feature)
+
+    def do_get(self, uri, kwargs=None, timeout=None):
+        return self._run(self.aclient.do_get(uri, kwargs, timeout))
+
+    def do_get_many(self, uris, timeout=None):
+        return self._run(self.aclient.do_get_many(uris, timeout))
+
+    def do_post(self, uri, data, timeout=None, wait=True):
+        return self._run(self.aclient.do_post(uri, data, timeout, wait))
+
+    def do_delete(self, uri, data=None, timeout=None, wait=True):
+        return self._run(self.aclient.do_delete(uri, data, timeout, wait))
+
+    def do_put(self, uri, data, timeout=None, wait=True):
+        return self._run(self.aclient.do_put(uri, data, timeout, wait))
+
+    def wait_task(self, task, timeout=None):
+        return self._run(self.aclient.wait_task(task, timeout))
+
+    def wait_tasks(self, tasks, timeout=None, raise_error=True):
+        return self._run(self.aclient.wait_tasks(tasks, timeout, raise_error))
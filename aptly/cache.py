@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import threading
+import weakref
+import logging
+from collections import OrderedDict
+
+lg = logging.getLogger(__name__)
+
+
+def estimate_size(value):
+    """
+    Estimate memory used by JSON-like value in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+def resource_uri(uri):
+    """
+    Return URI without query string and trailing slash
+    """
+    return uri.split('?', 1)[0].rstrip('/') or '/'
+
+
+class Cache(object):
+    """
+    LRU cache of API results limited by number of entries and their
+    estimated size, with optional expiration.
+
+    Entries are keyed by tuple starting with resource URI they were read
+    from, so they can be invalidated when the resource is modified.
+    """
+    def __init__(self, max_entries=1024, max_bytes=512 * 1024 * 1024,
+                 ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        # Generation of last modification of every modified resource
+        self.generation = 0
+        self._modified = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry):
+        return entry[2] is not None and entry[2] < time.time()
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            # Mark as most recently used
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        size = estimate_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            lg.debug("Not caching %s, size %s exceeds cache limit" % (key, size))
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time() + ttl if ttl else None)
+            self._bytes += size
+
+            while self._entries and (
+                    (self.max_entries and len(self._entries) > self.max_entries) or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_uri(self, uri):
+        """
+        Invalidate entries affected by modification of given resource
+
+        Modification of /collection/name/... invalidates listing of
+        /collection and everything read from /collection/name
+        """
+        segments = resource_uri(uri).strip('/').split('/')
+        collection = '/' + segments[0]
+        resource = '/'.join([collection] + segments[1:2])
+
+        with self._lock:
+            self.generation += 1
+            self._modified[resource] = self.generation
+            for key in list(self._entries.keys()):
+                key_uri = key[0]
+                if key_uri == collection or (
+                        len(segments) > 1 and (key_uri == resource or key_uri.startswith(resource + '/'))):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def modified_since(self, uri, generation):
+        """
+        Return True if resource was modified (see invalidate_uri) after
+        given generation
+        """
+        segments = resource_uri(uri).strip('/').split('/')
+        resource = '/'.join(['/' + segments[0]] + segments[1:2])
+        with self._lock:
+            return self._modified.get(resource, 0) > generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+_client_caches = weakref.WeakKeyDictionary()
+
+
+def get_cache(client):
+    """
+    Return cache of given client
+
+    Clients without own cache attribute get default cache, scoped to the
+    client object
+    """
+    cache = getattr(client, 'cache', None)
+    if cache is not None:
+        return cache
+    try:
+        return _client_caches[client]
+    except KeyError:
+        _client_caches[client] = Cache()
+        return _client_caches[client]
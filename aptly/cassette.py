@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import json
+import time
+import base64
+import hashlib
+import logging
+import datetime
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from aptly.exceptions import CassetteError
+
+lg = logging.getLogger(__name__)
+
+CASSETTE_FORMAT = 'aptly-cassette'
+CASSETTE_VERSION = 1
+
+
+def _request_uri(url):
+    """
+    Return path with query of URL, so cassette doesn't depend on server
+    address
+    """
+    url = urlsplit(url)
+    return '%s?%s' % (url.path, url.query) if url.query else url.path
+
+
+def _digest(data):
+    if isinstance(data, str) and not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hash_chunks(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+class Cassette(object):
+    """
+    Recording of API requests and responses replayable without server
+
+    Cassette is gzip compressed file of JSON lines: header, requests with
+    their status, latency and digests of request and response bodies and
+    response bodies (each stored only once, eg. package list of snapshot
+    read several times).
+
+    Request is replayed by response recorded for the same method and URI
+    (in recorded order), request body is used to prefer exact match only.
+    GET requests repeated more times than recorded get the last response.
+    Recorded latencies are replayed multiplied by latency_scale (0 to
+    respond immediately).
+    """
+    def __init__(self, path, mode='replay', latency_scale=1.0):
+        if mode not in ('record', 'replay'):
+            raise ValueError("Unknown cassette mode %s" % mode)
+
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.url = None
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._closed = False
+        self._blobs = {}
+        self._entries = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+
+        if mode == 'replay':
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, 'rt') as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get('format') != CASSETTE_FORMAT:
+                raise CassetteError("%s is not aptly cassette" % self.path)
+            if header.get('version', 0) > CASSETTE_VERSION:
+                raise CassetteError("Cassette %s has unsupported version %s" % (self.path, header['version']))
+            self.url = header.get('url')
+
+            for line in cassette_file:
+                record = json.loads(line)
+                if 'blob' in record:
+                    if 'base64' in record:
+                        self._blobs[record['blob']] = base64.b64decode(record['base64'])
+                    else:
+                        self._blobs[record['blob']] = record['data'].encode('utf-8')
+                else:
+                    self._entries.setdefault((record['method'], record['uri']), deque()).append(record)
+
+        lg.debug("Loaded %s requests from cassette %s" % (sum(len(x) for x in self._entries.values()), self.path))
+
+    def _start(self, url):
+        # Recording starts by the first request, server address is kept
+        # only for information
+        url = urlsplit(url)
+        self.url = '%s://%s' % (url.scheme, url.netloc)
+        self._file = gzip.open(self.path + '.tmp', 'wt')
+        self._write({
+            'format': CASSETTE_FORMAT,
+            'version': CASSETTE_VERSION,
+            'url': self.url,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        })
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, sort_keys=True, separators=(',', ':')))
+        self._file.write('\n')
+
+    def close(self):
+        """
+        Finish recording, cassette is moved into place only now
+        """
+        with self._lock:
+            self._closed = True
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            os.rename(self.path + '.tmp', self.path)
+            lg.info("Recorded %s requests into cassette %s" % (self.recorded, self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def adapter(self, adapter=None):
+        """
+        Return transport adapter recording requests sent by given adapter
+        or replaying them
+        """
+        return CassetteAdapter(self, adapter)
+
+    def record(self, request, response, elapsed, body_digest=None):
+        content = response.content
+        response_digest = _digest(content)
+
+        with self._lock:
+            if self._closed:
+                raise CassetteError("Cassette %s is already closed" % self.path)
+            if self._file is None:
+                self._start(request.url)
+            if response_digest not in self._blobs:
+                self._blobs[response_digest] = True
+                blob = {'blob': response_digest}
+                try:
+                    blob['data'] = content.decode('utf-8')
+                except UnicodeDecodeError:
+                    blob['base64'] = base64.b64encode(content).decode('ascii')
+                self._write(blob)
+
+            self._write({
+                'method': request.method,
+                'uri': _request_uri(request.url),
+                'request': body_digest,
+                'status': response.status_code,
+                'reason': response.reason,
+                'content_type': response.headers.get('Content-Type'),
+                'response': response_digest,
+                'elapsed': round(elapsed, 6),
+            })
+            self.recorded += 1
+
+    def _find(self, method, uri, body_digest):
+        entries = self._entries.get((method, uri))
+        if not entries:
+            return None
+
+        entry = entries[0]
+        for candidate in entries:
+            if candidate['request'] == body_digest:
+                entry = candidate
+                break
+
+        if len(entries) > 1 or method != 'GET':
+            entries.remove(entry)
+        return entry
+
+    def play(self, request):
+        """
+        Return recorded requests.Response for request
+        """
+        uri = _request_uri(request.url)
+        body = request.body
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = b''.join(body)
+        body_digest = _digest(body) if body is not None else None
+
+        with self._lock:
+            entry = self._find(request.method, uri, body_digest)
+            if entry is None:
+                self.missed += 1
+                raise CassetteError("Request %s %s is not recorded in cassette %s" % (request.method, uri, self.path))
+            self.replayed += 1
+
+        if self.latency_scale:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict()
+        if entry.get('content_type'):
+            response.headers['Content-Type'] = entry['content_type']
+        response._content = self._blobs[entry['response']]
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=entry['elapsed'])
+        return response
+
+    def stats(self):
+        return {
+            'recorded': self.recorded,
+            'replayed': self.replayed,
+            'missed': self.missed,
+        }
+
+
+class CassetteAdapter(BaseAdapter):
+    """
+    Transport adapter of requests session recording or replaying cassette
+    """
+    def __init__(self, cassette, adapter=None):
+        super(CassetteAdapter, self).__init__()
+        self.cassette = cassette
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            return self.cassette.play(request)
+
+        digest = None
+        if request.body is not None:
+            if isinstance(request.body, (bytes, str)):
+                digest = _digest(request.body)
+            else:
+                # Body is streamed, hash it while it's being sent
+                digest = hashlib.sha256()
+                request.body = _hash_chunks(request.body, digest)
+
+        start = time.time()
+        response = self.adapter.send(request, **kwargs)
+        elapsed = time.time() - start
+        self.cassette.record(request, response, elapsed,
+                             digest.hexdigest() if hasattr(digest, 'hexdigest') else digest)
+        return response
+
+    def close(self):
+        self.adapter.close()
@@ -1,20 +1,103 @@
 # -*- coding: utf-8 -*-
 
 import requests
-import json
+import time
+import functools
+import re
 import logging
-from aptly.exceptions import AptlyException
+from aptly.exceptions import AptlyException, TaskTimeout
+from aptly.tasks import Task, TASK_SUCCEEDED, backoff
+from aptly.cache import Cache
+from aptly.metrics import Metrics
+from aptly.transport import get_codec, encode_body, LogPayload, RetryPolicy
 
 lg = logging.getLogger(__name__)
 
+RE_MERGE_URI = re.compile(r'^/snapshots/([^/?]+)/merge(\?.*)?$')
+
+# Minimal aptly versions supporting optional API features
+FEATURES = {
+    # POST /snapshots/{name}/merge
+    'snapshot_merge': (1, 6, 0),
+}
+
+
+def parse_version(version):
+    """
+    Return tuple of numeric parts of aptly version, eg. 1.6.0+ds1 -> (1, 6, 0)
+    """
+    match = re.match(r'\d+(\.\d+)*', version or '')
+    if not match:
+        return ()
+    return tuple(int(part) for part in match.group(0).split('.'))
+
+
+def has_feature(version, feature):
+    """
+    Check if aptly of given version supports feature from FEATURES
+    """
+    return parse_version(version) >= FEATURES[feature]
+
+
+def _count_chunks(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
 
 class Aptly(object):
-    def __init__(self, url, auth=None, timeout=300, dry=False):
+    def __init__(self, url, auth=None, timeout=300, dry=False,
+                 use_tasks=False, task_timeout=None, task_poll_interval=0.5,
+                 task_poll_max=10, cache=None, package_store=None,
+                 codec='auto', stream_requests=False, compress_requests=False,
+                 log_max_length=1024, retry=None, pool_size=10, metrics=None,
+                 cassette=None):
         self.url = '%s%s' % (url, '/api')
         self.timeout = timeout
         self.dry = dry
 
+        # Transport of large payloads: JSON codec (orjson when installed),
+        # incremental encoding of request bodies into chunked requests and
+        # their gzip compression (responses are decompressed by requests)
+        self.codec = codec if hasattr(codec, 'loads') else get_codec(codec)
+        self.stream_requests = stream_requests
+        self.compress_requests = compress_requests
+        self.log_max_length = log_max_length
+
+        # Cache of results read by publisher, invalidated by our own
+        # mutating calls
+        self.cache = cache if cache is not None else Cache()
+        # Optional aptly.store.PackageStore persisting snapshot packages
+        self.package_store = package_store
+
+        # Submit mutating calls as aptly background tasks
+        self.use_tasks = use_tasks
+        self.task_timeout = task_timeout
+        self.task_poll_interval = task_poll_interval
+        self.task_poll_max = task_poll_max
+        self.task_history = []
+
+        # Features that turned out to be unsupported despite server version
+        self.disabled_features = set()
+
+        # Per-endpoint request metrics, see aptly.metrics.Metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # Retry of transient failures, see aptly.transport.RetryPolicy
+        self.retry = retry if retry is not None else RetryPolicy()
+
+        # Record requests into aptly.cassette.Cassette or replay them
+        # without server
+        self.cassette = cassette
+
         self.session = requests.Session()
+        # Keep connections for all concurrent workers
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        if cassette is not None:
+            adapter = cassette.adapter(adapter)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         if auth is not None:
             self.session.auth = auth
         self.session.headers.update({
@@ -26,6 +109,12 @@ class Aptly(object):
     def get_version(self):
         return self.do_get('/version')["Version"]
 
+    def has_feature(self, feature):
+        return feature not in self.disabled_features and has_feature(self.api_version, feature)
+
+    def disable_feature(self, feature):
+        self.disabled_features.add(feature)
+
     def _process_result(self, res):
         if res.status_code < 200 or res.status_code >= 300:
             raise AptlyException(
@@ -33,71 +122,246 @@ class Aptly(object):
                 "Something went wrong: %s (%s)" % (res.reason, res.status_code)
             )
         try:
-            return res.json()
+            return self.codec.loads(res.content)
         except ValueError:
             return res.text
 
+    def _task_params(self):
+        return {'_async': 'true'} if self.use_tasks else None
+
+    def _process_task(self, result, method, uri, wait):
+        """
+        Return result of mutating call, waiting for background task if it
+        was submitted as task. With wait=False return Task instead.
+        """
+        if not self.use_tasks:
+            return result
+
+        task = Task(result, method, uri)
+        lg.debug("Submitted task %s for %s %s" % (task.id, method, uri))
+        if wait:
+            return self.wait_task(task)
+        return task
+
+    def _finish_task(self, task):
+        try:
+            return_value = self.do_get('/tasks/%s/return_value' % task.id)
+        except AptlyException as e:
+            if e.res.status_code != 404:
+                raise
+            # Older aptly without return values
+            return_value = None
+
+        output = None
+        if task.state != TASK_SUCCEEDED or return_value is None:
+            try:
+                output = self.do_get('/tasks/%s/output' % task.id)
+            except AptlyException:
+                pass
+
+        task.set_return_value(return_value, output)
+        self.cache.invalidate_uri(task.uri)
+        self.task_history.append(task)
+        lg.info("Task %s %s %s in %.1fs" % (task.id, task.name, task.state_name, task.duration))
+
+        try:
+            self.do_delete('/tasks/%s' % task.id)
+        except AptlyException as e:
+            lg.debug("Can't delete finished task %s: %s" % (task.id, e))
+
+    def wait_task(self, task, timeout=None):
+        """
+        Wait for background task to finish and return its result
+        """
+        return self.wait_tasks([task], timeout=timeout)[0]
+
+    def wait_tasks(self, tasks, timeout=None, raise_error=True):
+        """
+        Wait for all background tasks to finish and return list of their
+        results in same order
+
+        Polls with exponential backoff, state of multiple tasks is read by
+        single request. If raise_error is False, result of failed task is
+        None and error is available in task.error
+        """
+        timeout = timeout or self.task_timeout
+        deadline = time.time() + timeout if timeout else None
+        pending = [task for task in tasks if not task.done]
+
+        for interval in backoff(self.task_poll_interval, self.task_poll_max):
+            states = []
+            if len(pending) == 1:
+                states = [self.do_get('/tasks/%s' % pending[0].id)]
+            elif pending:
+                states = self.do_get('/tasks')
+            states = dict((state['ID'], state) for state in states)
+
+            for task in list(pending):
+                if task.id in states:
+                    task.update(states[task.id])
+                if task.done:
+                    self._finish_task(task)
+                    pending.remove(task)
+
+            if not pending:
+                break
+
+            if deadline and time.time() + interval > deadline:
+                raise TaskTimeout("Tasks %s didn't finish in %ss" % (pending, timeout))
+            time.sleep(interval)
+
+        if raise_error:
+            for task in tasks:
+                if task.error:
+                    raise task.error
+        return [task.result for task in tasks]
+
     def do_get(self, uri, kwargs=None, timeout=None):
         url = '%s%s' % (self.url, uri)
         lg.debug("GET %s, args=%s" % (url, kwargs))
-        res = self.session.get(
+        res = self.retry.call('GET', uri, lambda: self.metrics.call('GET', uri, lambda: self.session.get(
             url,
             timeout=timeout or self.timeout,
             params=kwargs,
-        )
+        )))
         return self._process_result(res)
 
-    def do_post(self, uri, data, timeout=None):
-        data_json = json.dumps(data)
-        url = '%s%s' % (self.url, uri)
-        lg.debug("POST %s, data=%s" % (url, data_json))
+    def do_get_many(self, uris, timeout=None):
+        """
+        Get list of URIs, return list of results in same order
+        """
+        return [self.do_get(uri, timeout=timeout) for uri in uris]
 
-        if self.dry:
-            return
+    def _send(self, method, uri, data=None, params=None, timeout=None):
+        """
+        Send mutating request, body is encoded by configured codec (again
+        for every retry, streamed body can't be reused)
+        """
+        headers = None
+        if data is not None and self.compress_requests:
+            headers = {'Content-Encoding': 'gzip'}
 
-        res = self.session.post(
-            url,
-            timeout=timeout or self.timeout,
-            data=data_json,
-        )
-        return self._process_result(res)
+        def request():
+            body = None
+            sent = [0]
+            if data is not None:
+                body = encode_body(data, self.codec, stream=self.stream_requests,
+                                   compress=self.compress_requests)
+                if self.stream_requests:
+                    body = _count_chunks(body, sent)
+                else:
+                    sent[0] = len(body)
+            return self.metrics.call(method, uri, lambda: self.session.request(
+                method,
+                '%s%s' % (self.url, uri),
+                data=body,
+                headers=headers,
+                timeout=timeout or self.timeout,
+                params=params,
+            ), request_bytes=lambda: sent[0])
 
-    def do_delete(self, uri, data=None, timeout=None):
-        data_json = json.dumps(data) if data else ""
-        url = '%s%s' % (self.url, uri)
+        confirm = None
+        if method == 'POST' and isinstance(data, dict):
+            confirm = functools.partial(self._confirm_created, uri, data)
+        elif method == 'DELETE':
+            confirm = self._confirm_deleted
+        return self.retry.call(method, uri, request, confirm=confirm)
 
+    def _confirm_created(self, uri, data, res):
+        """
+        Return response of GET of snapshot which failed to be created as
+        duplicate if it's the one requested (so it was created by previous
+        attempt of the request), otherwise None
+        """
+        merge = RE_MERGE_URI.match(uri)
+        name = merge.group(1) if merge else data.get('Name')
+        if not name:
+            return None
+        uri = '/snapshots/%s' % name
+        try:
+            snapshot = self.do_get(uri)
+            if 'PackageRefs' in data:
+                # Snapshot created from packages
+                if set(self.do_get('%s/packages' % uri)) != set(data['PackageRefs']):
+                    return None
+            elif 'Sources' in data:
+                # Merge snapshot, sources are known from description only
+                if set(re.findall(r"'([^']*)'", snapshot.get('Description', ''))) != set(data['Sources']):
+                    return None
+            else:
+                return None
+        except AptlyException as e:
+            lg.debug("Can't confirm creation of snapshot %s: %s" % (name, e))
+            return None
+
+        confirmed = self.session.get('%s%s' % (self.url, uri), timeout=self.timeout)
+        if confirmed.status_code != 200:
+            return None
+        # It's not a task even with use_tasks
+        confirmed.aptly_confirmed = True
+        return confirmed
+
+    def _confirm_deleted(self, res):
+        """
+        Accept missing object of retried DELETE, it was deleted by previous
+        attempt
+        """
+        res.aptly_confirmed = True
+        return res
+
+    def _log_request(self, method, uri, data=None):
+        # Payload is formatted only when debug message is emitted
         if data:
-            lg.debug("DELETE %s, data=%s" % (url, data_json))
+            lg.debug("%s %s%s, data=%s", method, self.url, uri,
+                     LogPayload(data, self.log_max_length))
         else:
-            lg.debug("DELETE %s" % url)
+            lg.debug("%s %s%s", method, self.url, uri)
+
+    def do_post(self, uri, data, timeout=None, wait=True):
+        self._log_request('POST', uri, data)
 
         if self.dry:
             return
 
-        if data:
-            res = self.session.delete(
-                url,
-                data=data_json,
-                timeout=timeout or self.timeout,
-            )
-        else:
-            res = self.session.delete(
-            url,
-            timeout=timeout or self.timeout,
-        )
-        return self._process_result(res)
+        try:
+            res = self._send('POST', uri, data, params=self._task_params(),
+                             timeout=timeout)
+        finally:
+            self.cache.invalidate_uri(uri)
+        if getattr(res, 'aptly_confirmed', False):
+            return self._process_result(res)
+        return self._process_task(self._process_result(res), 'POST', uri, wait)
 
-    def do_put(self, uri, data, timeout=None):
-        data_json = json.dumps(data)
-        url = '%s%s' % (self.url, uri)
-        lg.debug("PUT %s, data=%s" % (url, data_json))
+    def do_delete(self, uri, data=None, timeout=None, wait=True):
+        self._log_request('DELETE', uri, data)
 
         if self.dry:
             return
 
-        res = self.session.put(
-            url,
-            timeout=timeout or self.timeout,
-            data=data_json,
-        )
-        return self._process_result(res)
+        # Deleting of tasks itself is not a task
+        use_task = not uri.startswith('/tasks/')
+        try:
+            res = self._send('DELETE', uri, data or None,
+                             params=self._task_params() if use_task else None,
+                             timeout=timeout)
+        finally:
+            self.cache.invalidate_uri(uri)
+        if getattr(res, 'aptly_confirmed', False):
+            return None
+        result = self._process_result(res)
+        if not use_task:
+            return result
+        return self._process_task(result, 'DELETE', uri, wait)
+
+    def do_put(self, uri, data, timeout=None, wait=True):
+        self._log_request('PUT', uri, data)
+
+        if self.dry:
+            return
+
+        try:
+            res = self._send('PUT', uri, data, params=self._task_params(),
+                             timeout=timeout)
+        finally:
+            self.cache.invalidate_uri(uri)
+        return self._process_task(self._process_result(res), 'PUT', uri, wait)
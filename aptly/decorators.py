@@ -1,25 +1,61 @@
 # -*- coding: utf-8 -*-
 
+import functools
+from aptly.cache import get_cache
+
 
 class CachedMethod(object):
     """
-    Decorator for caching of function results
+    Decorator for caching of results of function reading API resource
+
+    Function is expected to take client as first argument, results are
+    stored in cache of that client (see aptly.cache.get_cache) under key
+    made of resource URI (uri formatted by remaining arguments), so they
+    are invalidated when client modifies the resource.
     """
-    def __init__(self, function):
+    def __init__(self, function, uri, ttl=None):
         self.function = function
-        self.mem = {}
+        self.uri = uri
+        self.ttl = ttl
+        functools.update_wrapper(self, function)
+
+    def _key(self, args, kwargs):
+        return (self.uri.format(*args[1:]), self.function.__name__, args[1:],
+                str(sorted(kwargs.items())))
 
     def __call__(self, *args, **kwargs):
         cached = kwargs.pop('cached', True)
+        cache = get_cache(args[0])
+        key = self._key(args, kwargs)
         if cached is True:
-            if (args, str(kwargs)) in self.mem:
-                return self.mem[args, str(kwargs)]
+            missing = object()
+            tmp = cache.get(key, missing)
+            if tmp is not missing:
+                return tmp
 
         tmp = self.function(*args, **kwargs)
-        self.mem[args, str(kwargs)] = tmp
+        cache.set(key, tmp, ttl=self.ttl)
         return tmp
 
+    def is_cached(self, *args, **kwargs):
+        return self._key(args, kwargs) in get_cache(args[0])
+
+    def store(self, value, *args, **kwargs):
+        """ Store result of call with given arguments """
+        get_cache(args[0]).set(self._key(args, kwargs), value, ttl=self.ttl)
+
     def __get__(self, obj, objtype):
         """ Support instance methods """
-        import functools
         return functools.partial(self.__call__, obj)
+
+
+def cached(uri, ttl=None):
+    """
+    Cache results of function reading given API resource, eg.
+
+    @cached('/{}/{}/packages')
+    def _get_packages(client, source_type, source_name):
+    """
+    def decorator(function):
+        return CachedMethod(function, uri, ttl=ttl)
+    return decorator
@@ -9,3 +9,11 @@ class AptlyException(Exception):
 
 class NoSuchPublish(Exception):
     pass
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class CassetteError(Exception):
+    pass
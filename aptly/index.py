@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import logging
+from aptly.publisher.packages import PackageSelection, version_compare
+
+lg = logging.getLogger(__name__)
+
+
+class PackageIndex(object):
+    """
+    Persistent reverse index of packages of snapshots and publishes
+
+    For every server it keeps package refs of indexed snapshots (by name and
+    creation time, so unchanged snapshots are never indexed again) and
+    snapshots used by publishes: published snapshots and sources they were
+    created from. Index is SQLite database like PackageStore, package refs
+    are shared by all snapshots containing them.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60,
+                                     check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                'id INTEGER PRIMARY KEY, server TEXT, name TEXT, '
+                'created_at TEXT, UNIQUE (server, name))'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS refs ('
+                'id INTEGER PRIMARY KEY, name TEXT, version TEXT, arch TEXT, '
+                'hash TEXT, UNIQUE (name, version, arch, hash))'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshot_refs ('
+                'snapshot INTEGER, ref INTEGER, '
+                'PRIMARY KEY (snapshot, ref)) WITHOUT ROWID'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS snapshot_refs_ref '
+                'ON snapshot_refs (ref)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS publishes ('
+                'server TEXT, publish TEXT, component TEXT, snapshot TEXT, '
+                'published INTEGER)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS publishes_server '
+                'ON publishes (server, snapshot)'
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def snapshots(self, server):
+        """
+        Return dict {snapshot name: creation time} of indexed snapshots
+        """
+        with self._lock:
+            return dict(self._conn.execute(
+                'SELECT name, created_at FROM snapshots WHERE server = ?',
+                (server,)
+            ).fetchall())
+
+    def servers(self):
+        """
+        Return list of indexed servers
+        """
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT DISTINCT server FROM snapshots ORDER BY server')]
+
+    def _delete_snapshot(self, server, name):
+        row = self._conn.execute(
+            'SELECT id FROM snapshots WHERE server = ? AND name = ?',
+            (server, name)
+        ).fetchone()
+        if row is None:
+            return
+        self._conn.execute('DELETE FROM snapshot_refs WHERE snapshot = ?', row)
+        self._conn.execute('DELETE FROM snapshots WHERE id = ?', row)
+
+    def add_snapshot(self, server, name, created_at, rows):
+        """
+        Index snapshot with package rows (arch, name, version, hash),
+        replacing previously indexed snapshot of the same name
+        """
+        rows = [(row[1], row[2], row[0], row[3]) for row in rows]
+        with self._lock:
+            self._delete_snapshot(server, name)
+            snapshot_id = self._conn.execute(
+                'INSERT INTO snapshots (server, name, created_at) '
+                'VALUES (?, ?, ?)',
+                (server, name, created_at)
+            ).lastrowid
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO refs (name, version, arch, hash) '
+                'VALUES (?, ?, ?, ?)', rows
+            )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO snapshot_refs '
+                'SELECT ?, id FROM refs '
+                'WHERE name = ? AND version = ? AND arch = ? AND hash = ?',
+                [(snapshot_id,) + row for row in rows]
+            )
+            self._conn.commit()
+
+    def remove_snapshots(self, server, names):
+        """
+        Remove snapshots from index and refs not used by any snapshot
+        """
+        if not names:
+            return
+        with self._lock:
+            for name in names:
+                self._delete_snapshot(server, name)
+            self._conn.execute(
+                'DELETE FROM refs WHERE id NOT IN '
+                '(SELECT ref FROM snapshot_refs)'
+            )
+            self._conn.commit()
+
+    def set_publishes(self, server, rows):
+        """
+        Replace publishes of server by rows (publish name, component,
+        snapshot name, published) where published is false for sources of
+        published snapshot
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM publishes WHERE server = ?', (server,))
+            self._conn.executemany(
+                'INSERT INTO publishes VALUES (?, ?, ?, ?, ?)',
+                [(server, publish, component, snapshot, int(bool(published)))
+                 for publish, component, snapshot, published in rows]
+            )
+            self._conn.commit()
+
+    def query(self, server, selection, architectures=None, compare=version_compare):
+        """
+        Find packages selected by PackageSelection (or list of its specs)
+
+        Return list of dicts with package name, version, arch and list of
+        snapshots containing it, each with list of publishes using it
+        """
+        if not isinstance(selection, PackageSelection):
+            selection = PackageSelection(selection)
+
+        with self._lock:
+            names = set(selection.by_name)
+            if selection.patterns:
+                for (name,) in self._conn.execute('SELECT DISTINCT name FROM refs'):
+                    if any(selector.match_name(name) for selector in selection.patterns):
+                        names.add(name)
+
+            found = {}
+            for name in names:
+                for version, arch, snapshot in self._conn.execute(
+                        'SELECT refs.version, refs.arch, snapshots.name FROM refs '
+                        'JOIN snapshot_refs ON snapshot_refs.ref = refs.id '
+                        'JOIN snapshots ON snapshots.id = snapshot_refs.snapshot '
+                        'WHERE refs.name = ? AND snapshots.server = ?',
+                        (name, server)):
+                    # Architecture of aptly package key is prefixed by P
+                    if architectures and arch not in architectures and \
+                            not (arch.startswith('P') and arch[1:] in architectures):
+                        continue
+                    found.setdefault((name, version, arch), set()).add(snapshot)
+
+            publishes = {}
+            for publish, component, snapshot, published in self._conn.execute(
+                    'SELECT publish, component, snapshot, published '
+                    'FROM publishes WHERE server = ?', (server,)):
+                publishes.setdefault(snapshot, []).append({
+                    'publish': publish,
+                    'component': component,
+                    'published': bool(published),
+                })
+
+        results = []
+        for (name, version, arch), snapshots in sorted(found.items()):
+            selectors = selection.by_name.get(name, []) + [
+                selector for selector in selection.patterns if selector.match_name(name)]
+            if not any(selector.match_version(version, compare) for selector in selectors):
+                continue
+            results.append({
+                'package': name,
+                'version': version,
+                'arch': arch,
+                'snapshots': [{
+                    'name': snapshot,
+                    'publishes': sorted(publishes.get(snapshot, []),
+                                        key=lambda x: (x['publish'], x['component'])),
+                } for snapshot in sorted(snapshots)],
+            })
+        return results
+
+    def stats(self):
+        with self._lock:
+            snapshots, = self._conn.execute('SELECT COUNT(*) FROM snapshots').fetchone()
+            refs, = self._conn.execute('SELECT COUNT(*) FROM refs').fetchone()
+        return {
+            'snapshots': snapshots,
+            'refs': refs,
+        }
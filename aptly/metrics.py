@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           300)
+
+
+def normalize_endpoint(uri):
+    """
+    Replace names in API URI by placeholders, so requests of the same
+    endpoint are counted together, eg.
+    /snapshots/foo/diff/bar?x=1 -> /snapshots/{name}/diff/{name}
+    """
+    path = uri.split('?', 1)[0].strip('/').split('/')
+    collection = path[0]
+    if not collection or len(path) == 1:
+        return '/' + collection
+
+    if collection == 'publish':
+        # /publish/{prefix}/{distribution}
+        params = ['{prefix}', '{distribution}']
+        path[1:3] = params[:len(path[1:3])]
+    else:
+        path[1] = '{id}' if collection == 'tasks' else '{name}'
+        if len(path) > 3 and path[2] == 'diff':
+            path[3] = '{name}'
+    return '/' + '/'.join(path)
+
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def add(self, status, latency, request_bytes, response_bytes):
+        self.count += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+
+    def to_dict(self):
+        errors = dict((status, count) for status, count in self.statuses.items()
+                      if status == 'error' or int(status) >= 400)
+        return {
+            'count': self.count,
+            'statuses': dict(self.statuses),
+            'errors': sum(errors.values()),
+            'latency_sum': round(self.latency_sum, 6),
+            'latency_avg': round(self.latency_sum / self.count, 6) if self.count else 0,
+            'latency_max': round(self.latency_max, 6),
+            'latency_buckets': [[bound, count] for bound, count in zip(BUCKETS, self.buckets)],
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+        }
+
+
+class Metrics(object):
+    """
+    Per-endpoint metrics of API requests: count, statuses (error for
+    connection errors), latency histogram and transferred bytes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, method, uri, status, latency, request_bytes=0,
+               response_bytes=0):
+        key = (method, normalize_endpoint(uri))
+        status = 'error' if status is None else str(status)
+        with self._lock:
+            try:
+                endpoint = self.endpoints[key]
+            except KeyError:
+                endpoint = self.endpoints[key] = EndpointMetrics()
+            endpoint.add(status, latency, request_bytes, response_bytes)
+
+    def call(self, method, uri, request, request_bytes=0):
+        """
+        Call request (function returning requests.Response) and record it,
+        request_bytes can be callable evaluated after request is sent
+        """
+        start = time.time()
+        try:
+            res = request()
+        except Exception:
+            self.record(method, uri, None, time.time() - start,
+                        request_bytes() if callable(request_bytes) else request_bytes)
+            raise
+        self.record(method, uri, res.status_code, time.time() - start,
+                    request_bytes() if callable(request_bytes) else request_bytes,
+                    len(res.content))
+        return res
+
+    def stats(self):
+        """
+        Return dict {"METHOD /endpoint": metrics}
+        """
+        with self._lock:
+            return dict(('%s %s' % key, endpoint.to_dict())
+                        for key, endpoint in sorted(self.endpoints.items()))
+
+    def to_json(self):
+        return json.dumps(self.stats(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='aptly_client'):
+        """
+        Return metrics in Prometheus text format (eg. for node_exporter
+        textfile collector)
+        """
+        lines = [
+            '# HELP %s_requests_total Number of Aptly API requests' % prefix,
+            '# TYPE %s_requests_total counter' % prefix,
+        ]
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+
+        def labels(method, endpoint, **extra):
+            items = [('method', method), ('endpoint', endpoint)] + sorted(extra.items())
+            return ','.join('%s="%s"' % (name, value) for name, value in items)
+
+        for (method, endpoint), metrics in endpoints:
+            for status, count in sorted(metrics.statuses.items()):
+                lines.append('%s_requests_total{%s} %s' % (prefix, labels(method, endpoint, status=status), count))
+
+        lines.extend([
+            '# HELP %s_request_duration_seconds Latency of Aptly API requests' % prefix,
+            '# TYPE %s_request_duration_seconds histogram' % prefix,
+        ])
+        for (method, endpoint), metrics in endpoints:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, metrics.buckets):
+                cumulative += count
+                lines.append('%s_request_duration_seconds_bucket{%s} %s' % (prefix, labels(method, endpoint, le=bound), cumulative))
+            lines.append('%s_request_duration_seconds_bucket{%s} %s' % (prefix, labels(method, endpoint, le='+Inf'), metrics.count))
+            lines.append('%s_request_duration_seconds_sum{%s} %s' % (prefix, labels(method, endpoint), metrics.latency_sum))
+            lines.append('%s_request_duration_seconds_count{%s} %s' % (prefix, labels(method, endpoint), metrics.count))
+
+        for name, attr, help_text in (('request_bytes_total', 'request_bytes', 'Bytes sent in Aptly API request bodies'),
+                                      ('response_bytes_total', 'response_bytes', 'Bytes received in Aptly API response bodies')):
+            lines.extend([
+                '# HELP %s_%s %s' % (prefix, name, help_text),
+                '# TYPE %s_%s counter' % (prefix, name),
+            ])
+            for (method, endpoint), metrics in endpoints:
+                lines.append('%s_%s{%s} %s' % (prefix, name, labels(method, endpoint), getattr(metrics, attr)))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, fmt=None):
+        """
+        Write metrics into file as json or prometheus (default by file
+        extension, .prom is prometheus), file is replaced atomically
+        """
+        if fmt is None:
+            fmt = 'prometheus' if path.endswith('.prom') else 'json'
+        data = self.to_prometheus() if fmt == 'prometheus' else self.to_json()
+
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(data)
+        os.rename(path + '.tmp', path)
@@ -3,17 +3,25 @@
 import time
 import re
 import logging
-import yaml
-import apt_pkg
+import functools
+import weakref
 from aptly.exceptions import AptlyException, NoSuchPublish
-from aptly.decorators import CachedMethod
+from aptly.decorators import cached
+from aptly.cache import get_cache
+from aptly.publisher.workers import WorkerPool
+from aptly.publisher.snapshots import SnapshotIndex
+from aptly.publisher.inventory import PublishIndex, PublishInventory, publish_key, publish_name
+from aptly.publisher.graph import SnapshotGraph
+from aptly.publisher.dump import write_publish, read_publish, package_refs
+from aptly.publisher.archive import DumpArchive, is_archive
+from aptly.publisher.packages import PackageRefTable, PackageSelection, parse_ref
 
 lg = logging.getLogger(__name__)
 
 
 def load_publish(publish):
     with open(publish, 'r') as publish_file:
-        return yaml.load(publish_file)
+        return read_publish(publish_file)
 
 
 class PublishManager(object):
@@ -41,19 +49,73 @@ class PublishManager(object):
         for dist in distributions:
             self.publish(dist, storage=storage).add(snapshot, component)
 
-    def restore_publish(self, components, restore_file, recreate):
-        publish_file = load_publish(restore_file)
-        publish_source = Publish(self.client, publish_file.get('publish'), storage=publish_file.get('storage', self.storage))
-        publish_source.restore_publish(publish_file,
-                                       components=components,
-                                       recreate=recreate)
+    def restore_publish(self, components, restore_files, recreate,
+                        workers=1, storage_workers=None, publish_names=None):
+        """
+        Restore publishes from one or more dump files (YAML dumps or dump
+        archives, from archives only publish_names if given)
+
+        Snapshots of all files are created first (with workers > 1
+        concurrently) and rolled back when any of them fails, then restored
+        publishes are published as a batch. Failures of publishing are
+        returned as dict {full_name: exception} when workers > 1.
+        """
+        if not isinstance(restore_files, (list, tuple)):
+            restore_files = [restore_files]
+
+        publish_files = []
+        for restore_file in restore_files:
+            if is_archive(restore_file):
+                with DumpArchive(restore_file) as archive:
+                    for publish in archive.publishes():
+                        if publish_names and 'all' not in publish_names and \
+                                publish['publish'] not in publish_names and \
+                                publish['publish'] not in ['./%s' % name for name in publish_names]:
+                            continue
+                        publish_files.append(archive.load_publish(
+                            publish, None if not components or 'all' in components else components))
+            else:
+                publish_files.append(load_publish(restore_file))
+
+        if not publish_files:
+            raise Exception('Publish(es) required not found')
+
+        # Snapshots shared by restored publishes get the same name, so they
+        # are created only once
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        restored = []
+        for publish_file in publish_files:
+            publish_source = Publish(self.client, publish_file.get('publish'), storage=publish_file.get('storage', self.storage))
+            restored.append((publish_source, publish_source.prepare_restore(publish_file, components, timestamp)))
+
+        Publish.create_restored_snapshots(
+            self.client, [snapshot for _, snapshots in restored for snapshot in snapshots],
+            workers=workers)
+
+        for publish_source, snapshots in restored:
+            publish_source.apply_restore(snapshots, components)
+
+        return self._run_publishes([publish for publish, _ in restored],
+                                   workers, storage_workers,
+                                   recreate=recreate, merge_snapshots=False)
 
-    def dump_publishes(self, publishes_to_save, dump_dir, prefix):
+    def dump_publishes(self, publishes_to_save, dump_dir, prefix, workers=1,
+                       dump_format='yaml', baseline=None):
+        """
+        Dump matching publishes into YAML files in dump_dir or with
+        dump_format 'archive' into single dump archive
+        <prefix><timestamp>.zip, incremental against baseline archive if
+        given
+
+        With workers > 1 publishes are dumped concurrently and failures are
+        returned as dict {full_name: exception}
+        """
 
         if len(dump_dir) > 1 and dump_dir[-1] == '/':
             dump_dir = dump_dir[:-1]
 
         save_list = []
+        saved = set()
         save_all = True
 
         if publishes_to_save and not ('all' in publishes_to_save):
@@ -63,26 +125,112 @@ class PublishManager(object):
         if len(publishes_to_save) == 1 and re.search(r'\(.*\)', publishes_to_save[0]):
             re_publish = re.compile(publishes_to_save[0])
 
-        publishes = self.client.do_get('/publish')
-        for publish in publishes:
-            name = "{}{}{}".format(publish['Storage']+":" if publish['Storage']
-                                else "", publish['Prefix']+"/" if
-                                publish['Prefix'] else "",
-                                publish['Distribution'])
-
+        for name, current_publish in self.load_all().items():
             if not re_publish or re_publish.match(name):
                 if save_all or name in publishes_to_save or re_publish:
-                    current_publish = Publish(self.client, name, load=True, storage=publish.get('Storage', self.storage))
-                    if current_publish not in save_list:
+                    if current_publish not in saved:
+                        saved.add(current_publish)
                         save_list.append(current_publish)
 
         if not save_all and not re_publish and len(save_list) != len(publishes_to_save):
             raise Exception('Publish(es) required not found')
 
+        if dump_format == 'archive':
+            save_path = ''.join([dump_dir, '/', prefix, time.strftime("%Y%m%d%H%M%S"), '.zip'])
+            lg.info("Saving publishes in %s" % save_path)
+            with DumpArchive(save_path, 'w', base=baseline) as archive:
+                # Packages of snapshots unchanged since baseline are not needed
+                Publish._prefetch_packages(self.client, "snapshots", [
+                    snapshot['Name'] for publish in save_list for snapshot in publish.publish_snapshots
+                    if not archive.unchanged(publish.name, publish.storage, snapshot['Component'], snapshot['Name'],
+                                             (publish._find_snapshot(snapshot['Name']) or {}).get('CreatedAt'))
+                ])
+                return self._run_saves([
+                    (publish.full_name, publish.storage, functools.partial(publish.archive_publish, archive))
+                    for publish in save_list
+                ], workers)
+
+        Publish._prefetch_packages(self.client, "snapshots", [snapshot['Name'] for publish in save_list for snapshot in publish.publish_snapshots])
+
+        jobs = []
         for publish in save_list:
             storage = '' if not publish.storage else '-{}-'.format(publish.storage)
             save_path = ''.join([dump_dir, '/', prefix, storage, publish.name.replace('/', '-'), '.yml'])
-            publish.save_publish(save_path)
+            jobs.append((publish.full_name, publish.storage, functools.partial(publish.save_publish, save_path)))
+
+        return self._run_saves(jobs, workers)
+
+    def load_all(self):
+        """
+        Load all remote publishes with their sources at once
+
+        Return PublishInventory, publish list and snapshot list are fetched
+        only once (and reused from client cache).
+        """
+        inventory = PublishInventory()
+        for publish in Publish._get_publishes(self.client):
+            inventory.add(Publish.from_remote(self.client, publish, timestamp=self.timestamp),
+                          publish_name(publish))
+        return inventory
+
+    def update_package_index(self, index, all_snapshots=False, batch=20):
+        """
+        Update aptly.index.PackageIndex by publishes and their snapshots
+
+        Only snapshots used by publishes (published and their sources) are
+        indexed unless all_snapshots is set. Snapshots already indexed with
+        the same creation time are skipped, package lists of the others are
+        fetched in batches (or reused from client cache and package store).
+        """
+        server = self.client.url
+        inventory = self.load_all()
+        snapshots = Publish._get_snapshot_index(self.client)
+
+        if all_snapshots:
+            names = [snapshot['Name'] for snapshot in snapshots.snapshots]
+        else:
+            names = [name for name in list(inventory.published.keys()) + list(inventory.sources.keys())
+                     if name in snapshots]
+        names = list(dict.fromkeys(names))
+
+        indexed = index.snapshots(server)
+        changed = [name for name in names
+                   if not snapshots.get(name).get('CreatedAt') or
+                   indexed.get(name) != snapshots.get(name)['CreatedAt']]
+        wanted = set(names)
+        removed = [name for name in indexed if name not in wanted]
+        lg.info("Indexing %s snapshots (%s already indexed, %s removed)" % (len(changed), len(names) - len(changed), len(removed)))
+
+        for start in range(0, len(changed), batch):
+            chunk = changed[start:start + batch]
+            Publish._prefetch_packages(self.client, "snapshots", chunk)
+            for name in chunk:
+                lg.debug("Indexing packages of snapshot %s" % name)
+                table = Publish._get_package_table(self.client, "snapshots", name)
+                index.add_snapshot(server, name, snapshots.get(name).get('CreatedAt'), table.rows())
+        index.remove_snapshots(server, removed)
+
+        rows = []
+        for name, publish in inventory.items():
+            published = set()
+            for snapshot in publish.publish_snapshots:
+                published.add((snapshot['Component'], snapshot['Name']))
+                rows.append((name, snapshot['Component'], snapshot['Name'], True))
+            for component, sources in publish.components.items():
+                for source in sources:
+                    if (component, source) not in published:
+                        rows.append((name, component, source, False))
+        index.set_publishes(server, rows)
+        return inventory
+
+    def _run_saves(self, jobs, workers):
+        if not workers or workers <= 1:
+            for _, _, save in jobs:
+                save()
+            return {}
+
+        _, failures = WorkerPool(workers).run(jobs)
+        return failures
 
     def _publish_match(self, publish, names=False, name_only=False):
         """
@@ -102,6 +250,14 @@ class PublishManager(object):
             return True
 
     def do_publish(self, *args, **kwargs):
+        """
+        Publish all matching publishes
+
+        With workers > 1 publishes are executed concurrently, limited also by
+        storage_workers dict (eg. {'s3': 2, 'filesystem': 4}). In that case
+        failures are collected and returned as dict {full_name: exception}
+        instead of stopping the whole run.
+        """
         try:
             publish_dist = kwargs.pop('dist')
         except KeyError:
@@ -112,12 +268,32 @@ class PublishManager(object):
         except KeyError:
             publish_names = None
 
+        workers = kwargs.pop('workers', 1)
+        storage_workers = kwargs.pop('storage_workers', None)
+
+        publishes = []
         for publish in self._publishes.values():
             if self._publish_match(publish.name, publish_names or publish_dist, publish_names):
-                publish.do_publish(*args, **kwargs)
+                publishes.append(publish)
             else:
                 lg.info("Skipping publish %s not matching publish names" % publish.name)
 
+        return self._run_publishes(publishes, workers, storage_workers, *args, **kwargs)
+
+    def _run_publishes(self, publishes, workers, storage_workers, *args, **kwargs):
+        if not workers or workers <= 1:
+            for publish in publishes:
+                publish.do_publish(*args, **kwargs)
+            return {}
+
+        pool = WorkerPool(workers, storage_workers)
+        _, failures = pool.run([
+            (publish.full_name, publish.storage,
+             functools.partial(publish.do_publish, *args, **kwargs))
+            for publish in publishes
+        ])
+        return failures
+
     def list_uniq(self, seq):
         keys = {}
         for e in seq:
@@ -126,14 +302,7 @@ class PublishManager(object):
 
     def do_purge(self, config, components=[], hard_purge=False):
         (repo_dict, publish_dict) = self.get_repo_information(config, self.client, hard_purge, components)
-        publishes = self.client.do_get('/publish')
-        publish_list = []
-
-        for publish in publishes:
-            name = '{}/{}'.format(publish['Prefix'].replace("/", "_"), publish['Distribution'])
-            publish_list.append(Publish(self.client, name, load=True))
-
-        for publish in publish_list:
+        for publish in self.load_all():
             repo_dict = publish.purge_publish(repo_dict, publish_dict, components, publish=True)
 
         if hard_purge:
@@ -152,7 +321,7 @@ class PublishManager(object):
                 if components and repo.get('component') not in components:
                     continue
                 if fill_repo and origin == 'repo':
-                    packages = Publish._get_packages("repos", name)
+                    packages = Publish._get_packages(client, "repos", name)
                     repo_dict[name] = packages
                 for distribution in repo.get('distributions'):
                     publish_name = str.join('/', distribution.split('/')[:-1])
@@ -165,64 +334,140 @@ class PublishManager(object):
             if packages:
                 self.client.do_delete('/repos/%s/packages' % repo_name, data={'PackageRefs': packages})
 
-    def cleanup_snapshots(self):
-        # requesting graph.dot always works, even if graphviz (dot) is not installed
-        dot_data = self.client.do_get('/graph.dot')
+    def cleanup_snapshots(self, workers=1):
+        """
+        Delete snapshots which are not published nor used by published
+        snapshots
 
-        # extract edges from dot-data
-        # edges = list of pairs with (node_id, node_id)
-        edges = re.findall('"([^"]+)"->"([^"]+)";', dot_data)
+        Snapshots are deleted in order, so snapshot is deleted only after
+        snapshots created from it. Independent snapshots are deleted by
+        given number of workers concurrently.
+        """
+        # requesting graph.dot always works, even if graphviz (dot) is not
+        # installed and it's the only source of relations between snapshots
+        graph = SnapshotGraph.from_dot(self.client.do_get('/graph.dot'))
+        unreleased_snapshots = self._unused_snapshots(graph)
+
+        pool = WorkerPool(workers)
+        failed = set()
+        for level in graph.deletion_levels(unreleased_snapshots):
+            jobs = []
+            for node_id in level:
+                if graph.children[node_id] & failed:
+                    # Snapshot created from this one wasn't deleted
+                    failed.add(node_id)
+                    continue
+                snapshot = graph.nodes[node_id][1]
+                jobs.append((node_id, "", functools.partial(self._delete_snapshot, snapshot)))
 
-        # extract nodes from dot-data
-        # list of tuples with (node_id, node_type, node_name)
-        # node_type is one of 'Repo'|'Snapshot'|'Publish'
-        nodes_raw = re.findall('[ \t]+"([^"]+)".*label="{(Repo|Snapshot|Published) ([^|]+)[^\}"]+}"', dot_data)
+            results, failures = pool.run(jobs)
+            for node_id, deleted in results.items():
+                if not deleted:
+                    failed.add(node_id)
+            if failures:
+                raise list(failures.values())[0]
 
-        # convert nodes_raw into nodes
-        # nodes = dict of node_id to node
-        # node = (node_type, node_name)
-        nodes = {node_id: (node_type, node_name) for node_id, node_type, node_name in nodes_raw}
+    def _unused_snapshots(self, graph, publishes=None, snapshots=None):
+        """
+        Return ids of snapshot nodes which are not published nor used by
+        published snapshots
 
-        # start with published and flood fill other nodes
-        published_node_ids = [key for key in nodes if nodes[key][0] == 'Published']
+        When list of publishes (Publish objects) is given, their
+        publish_snapshots are used instead of their current sources (as they
+        will be after they are published). Names of other snapshots to keep
+        can be also given.
+        """
+        planned = set((publish.storage, publish.prefix or '.', publish.distribution) for publish in publishes or [])
 
-        # do flood fill
-        while True:
-            # get a list of source node_ids of incoming edges
-            incoming_node_ids = [edge_from for edge_from, edge_to in edges if edge_to in published_node_ids and edge_from not in published_node_ids]
+        # start with published nodes and sources of publishes
+        roots = set() if publishes else set(graph.nodes_of_type('Published'))
+        names = list(snapshots or [])
+        for publish in Publish._get_publishes(self.client):
+            if publish.get('SourceKind', 'snapshot') != 'snapshot':
+                continue
+            if (publish['Storage'], publish['Prefix'].replace('/', '_'), publish['Distribution']) in planned:
+                continue
+            names.extend(source['Name'] for source in publish['Sources'])
+        for publish in publishes or []:
+            names.extend(snapshot['Name'] for snapshot in publish.publish_snapshots)
 
-            # add incoming node_ids
-            published_node_ids.extend(incoming_node_ids)
+        for name in names:
+            node_id = graph.find('Snapshot', name)
+            if node_id:
+                roots.add(node_id)
 
-            # no new nodes, we are finished
-            if len(incoming_node_ids) == 0:
-                break
+        published = graph.reachable(roots)
+        return [node_id for node_id in graph.nodes_of_type('Snapshot') if node_id not in published]
 
-        # we got published nodes, invert the set
-        non_published_node_ids = [node_id for node_id in nodes if node_id not in published_node_ids]
+    def plan_publish(self, plan, **kwargs):
+        """
+        Add operations publishing all matching publishes into Plan
 
-        # list of nodes with (node_type, node_name)
-        unreleased_nodes = [nodes[node_id] for node_id in non_published_node_ids]
+        Return list of planned publishes
+        """
+        publish_dist = kwargs.pop('dist', None)
+        publish_names = kwargs.pop('names', None)
 
-        # use only nodes of type 'Snapshot'
-        unreleased_snapshots = [node[1] for node in unreleased_nodes if node[0] == 'Snapshot']
+        planned = []
+        for publish in self._publishes.values():
+            if self._publish_match(publish.name, publish_names or publish_dist, publish_names):
+                publish.plan_publish(plan, **kwargs)
+                planned.append(publish)
+            else:
+                lg.info("Skipping publish %s not matching publish names" % publish.name)
+        return planned
 
-        # actually delete snapshots that are not published
-        for snapshot in unreleased_snapshots:
-            lg.info("Deleting snapshot %s" % snapshot)
-            try:
-                self.client.do_delete('/snapshots/%s' % snapshot)
-            except AptlyException as e:
-                if e.res.status_code == 409:
-                    lg.warning("Snapshot %s is being used, can't delete" % snapshot)
-                else:
-                    raise
+    def plan_cleanup(self, plan, publishes=None):
+        """
+        Add operations deleting snapshots which won't be published nor used
+        by published snapshots after operations already in plan (publishing
+        given publishes) are executed
+        """
+        graph = SnapshotGraph.from_dot(self.client.do_get('/graph.dot'))
+
+        # Merge snapshots to be created aren't in graph yet, so keep their
+        # sources
+        sources = []
+        for op_id in plan.find('POST', 'create-snapshot:'):
+            data = plan.operations[op_id].data
+            sources.extend(data.get('SourceSnapshots') or data.get('Sources') or [])
+
+        planned = [op.id for op in plan]
+        deletes = {}
+        for level in graph.deletion_levels(self._unused_snapshots(graph, publishes, sources)):
+            for node_id in level:
+                snapshot = graph.nodes[node_id][1]
+                children = [deletes[child] for child in graph.children[node_id] if child in deletes]
+                deletes[node_id] = plan.add(
+                    'delete-snapshot:%s' % snapshot, 'DELETE', '/snapshots/%s' % snapshot,
+                    # snapshot created from this one is deleted before
+                    depends=children or planned,
+                    description="Delete snapshot %s" % snapshot,
+                    # snapshot is still used
+                    ignore_status=[409],
+                )
+        return list(deletes.values())
+
+    def _delete_snapshot(self, snapshot):
+        lg.info("Deleting snapshot %s" % snapshot)
+        try:
+            self.client.do_delete('/snapshots/%s' % snapshot)
+        except AptlyException as e:
+            if e.res.status_code == 409:
+                lg.warning("Snapshot %s is being used, can't delete" % snapshot)
+                return False
+            else:
+                raise
+        return True
 
 
 class Publish(object):
     """
     Single publish object
     """
+    _snapshot_indexes = weakref.WeakKeyDictionary()
+    _publish_indexes = weakref.WeakKeyDictionary()
+
     def __init__(self, client, distribution, timestamp=None, recreate=False, load=False, merge_prefix='_', storage="", architectures=[]):
         self.client = client
         self.recreate = recreate
@@ -261,17 +506,33 @@ class Publish(object):
             # Load information from remote immediately
             self.load()
 
+    @staticmethod
+    def from_remote(client, publish, **kwargs):
+        """
+        Return Publish loaded from item of remote publish list
+        """
+        instance = Publish(client, publish_name(publish), storage=publish['Storage'], **kwargs)
+        instance._load_remote(publish)
+        return instance
+
+    @property
+    def key(self):
+        """
+        Tuple (storage, prefix, distribution) identifying publish
+        """
+        return publish_key(self.storage, self.prefix, self.distribution)
+
     def __eq__(self, other):
         if not isinstance(other, Publish):
             return False
-
-        diff, equal = self.compare(other)
-        if not diff:
-            return True
+        return self.key == other.key
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.key)
+
     def compare(self, other, components=[]):
         """
         Compare two publishes
@@ -334,30 +595,136 @@ class Publish(object):
         )
 
     @staticmethod
-    @CachedMethod
     def _get_packages(client, source_type, source_name):
-        return client.do_get('/{}/{}/packages'.format(source_type, source_name))
+        return Publish._get_package_table(client, source_type, source_name).refs()
+
+    @staticmethod
+    @cached('/{}/{}/packages')
+    def _get_package_table(client, source_type, source_name):
+        """
+        Return PackageRefTable of packages of given source
+        """
+        return PackageRefTable.from_refs(Publish._fetch_packages(client, source_type, source_name))
 
     @staticmethod
-    @CachedMethod
+    def _fetch_packages(client, source_type, source_name):
+        store_key = Publish._package_store_key(client, source_type, source_name)
+        if store_key:
+            packages = client.package_store.get(*store_key)
+            if packages is not None:
+                return packages
+
+        packages = client.do_get('/{}/{}/packages'.format(source_type, source_name))
+        if store_key:
+            client.package_store.set(*(store_key + (packages,)))
+        return packages
+
+    @staticmethod
+    def _package_store_key(client, source_type, source_name):
+        """
+        Return key of snapshot packages in persistent package store of
+        client or None if they can't be stored
+        """
+        if source_type != "snapshots" or getattr(client, 'package_store', None) is None:
+            return None
+
+        snapshot = Publish._lookup_snapshot(client, source_name)
+        if not snapshot or not snapshot.get('CreatedAt'):
+            return None
+        return (client.url, source_name, snapshot['CreatedAt'])
+
+    @staticmethod
+    def _prefetch_packages(client, source_type, source_names):
+        """
+        Fetch package lists of multiple sources at once into cache
+
+        Requests are in flight concurrently when client supports it (eg.
+        aptly.aio.AptlyBridge)
+        """
+        missing = []
+        for name in source_names:
+            if name in missing or Publish._get_package_table.is_cached(client, source_type, name):
+                continue
+
+            store_key = Publish._package_store_key(client, source_type, name)
+            packages = client.package_store.get(*store_key) if store_key else None
+            if packages is not None:
+                Publish._get_package_table.store(PackageRefTable.from_refs(packages), client, source_type, name)
+            else:
+                missing.append(name)
+        if not missing:
+            return
+
+        lg.debug("Fetching packages of %s %s" % (source_type, missing))
+        results = client.do_get_many(['/{}/{}/packages'.format(source_type, name) for name in missing])
+        for name, packages in zip(missing, results):
+            Publish._get_package_table.store(PackageRefTable.from_refs(packages), client, source_type, name)
+            store_key = Publish._package_store_key(client, source_type, name)
+            if store_key:
+                client.package_store.set(*(store_key + (packages,)))
+
+    @staticmethod
+    @cached('/publish')
     def _get_publishes(client):
         return client.do_get('/publish')
 
     @staticmethod
-    @CachedMethod
+    @cached('/snapshots')
     def _get_snapshots(client):
         return client.do_get('/snapshots', {'sort': 'time'})
 
+    @staticmethod
+    def _get_snapshot_index(client):
+        """
+        Return index of remote snapshots, rebuilt only when snapshot list
+        is fetched again
+        """
+        snapshots = Publish._get_snapshots(client)
+        index = Publish._snapshot_indexes.get(client)
+        if index is None or index.snapshots is not snapshots:
+            index = SnapshotIndex(snapshots)
+            # Snapshot list is cached, so nothing was modified since it was
+            # fetched
+            index.generation = get_cache(client).generation
+            Publish._snapshot_indexes[client] = index
+        return index
+
+    @staticmethod
+    def _lookup_snapshot(client, name):
+        """
+        Return remote snapshot by name or None
+
+        Snapshot is looked up in last fetched snapshot list even when it's
+        outdated by creation of other snapshots, unless the snapshot itself
+        was modified since, so lookups don't refetch snapshot list after
+        every created snapshot.
+        """
+        index = Publish._snapshot_indexes.get(client)
+        if index is not None and name in index and \
+                not get_cache(client).modified_since('/snapshots/%s' % name, index.generation):
+            return index.get(name)
+        return Publish._get_snapshot_index(client).get(name)
+
+    @staticmethod
+    def _get_publish_index(client):
+        """
+        Return index of remote publishes, rebuilt only when publish list is
+        fetched again
+        """
+        publishes = Publish._get_publishes(client)
+        index = Publish._publish_indexes.get(client)
+        if index is None or index.publishes is not publishes:
+            index = PublishIndex(publishes)
+            Publish._publish_indexes[client] = index
+        return index
+
     def _get_publish(self):
         """
         Find this publish on remote
         """
-        publishes = self._get_publishes(self.client)
-        for publish in publishes:
-            if publish['Distribution'] == self.distribution and \
-                    publish['Prefix'].replace("/", "_") == (self.prefix or '.') and \
-                    publish['Storage'] == self.storage:
-                return publish
+        publish = self._get_publish_index(self.client).get(self.key)
+        if publish is not None:
+            return publish
         raise NoSuchPublish("Publish %s (%s) does not exist" % (self.name, self.storage or "local"))
 
     def _remove_snapshots(self, snapshots):
@@ -370,39 +737,46 @@ class Publish(object):
         """
         timestamp = time.strftime("%Y%m%d%H%M%S")
 
-        yaml_dict = {}
-        yaml_dict["publish"] = self.name
-        yaml_dict["name"] = timestamp
-        yaml_dict["components"] = []
-        yaml_dict["storage"] = self.storage
-        for component, snapshots in self.components.items():
-            packages = self.get_packages(component)
-            package_dict = []
-            for package in packages:
-                (arch, name, version, ref) = self.parse_package_ref(package)
-                package_dict.append({'package': name, 'version': version, 'arch': arch, 'ref': ref})
-            snapshot = self._find_snapshot(snapshots[0])
-
-            yaml_dict["components"].append({'component': component, 'snapshot': snapshot['Name'],
-                                            'description': snapshot['Description'], 'packages': package_dict})
-
         name = self.name.replace('/', '-')
         lg.info("Saving publish %s in %s" % (name, save_path))
         with open(save_path, 'w') as save_file:
-            yaml.dump(yaml_dict, save_file, default_flow_style=False)
+            write_publish(save_file, self.name, timestamp, self.storage,
+                          self._iter_saved_components())
 
-    def purge_publish(self, repo_dict, publish_dict, components=[], publish=False):
+    def archive_publish(self, archive):
+        """
+        Add publish into DumpArchive
+        """
+        lg.info("Saving publish %s in %s" % (self.name, archive.path))
+        archive.add_publish(self.name, self.storage, self._iter_saved_components(lazy=True))
 
-        apt_pkg.init_system()
+    def _iter_saved_components(self, lazy=False):
+        published = dict((snapshot['Component'], snapshot['Name']) for snapshot in self.publish_snapshots)
+        for component, snapshots in self.components.items():
+            snapshot = self._find_snapshot(snapshots[0])
+            # Packages are of published snapshot, so it identifies them
+            published_snapshot = self._find_snapshot(published[component]) if component in published else None
+            packages = functools.partial(self.get_package_table, component)
+            yield {
+                'component': component,
+                'snapshot': snapshot['Name'],
+                'description': snapshot['Description'],
+                'published': published_snapshot['Name'] if published_snapshot else None,
+                'created_at': published_snapshot.get('CreatedAt') if published_snapshot else None,
+                'packages': packages if lazy else packages(),
+            }
 
+    def purge_publish(self, repo_dict, publish_dict, components=[], publish=False):
+        """
+        Replace publish snapshots by snapshots with only the latest version
+        of every package and remove kept packages from repo_dict, so only
+        obsolete packages are left there
+        """
         new_publish_snapshots = []
 
         for snapshot in self.publish_snapshots:
-            # packages to be kept
-            processed = []
             name = snapshot["Name"]
             component = snapshot["Component"]
-            purge_packages = []
             location = self.name.split('/')[0].replace('_', '/')
 
             if (location, component) in publish_dict:
@@ -417,20 +791,15 @@ class Publish(object):
                     repo_dict[repo_name] = []
                 continue
 
-            packages = self._get_packages(self.client, "snapshots", name)
-            packages = sorted(packages, key=lambda x: self.parse_package_ref(x)[2], reverse=True, cmp=apt_pkg.version_compare)
-
-            for package in packages:
-                package_name = self.parse_package_ref(package)[1]
-
-                if package_name not in processed:
-                    processed.append(package_name)
-                    if repo_dict and repo_name in repo_dict and package in repo_dict[repo_name]:
-                        repo_dict[repo_name].remove(package)
+            table = self._get_package_table(self.client, "snapshots", name)
+            keep, drop = table.select_latest()
+            purge_packages = table.take(sorted(keep)).refs()
 
-                    purge_packages.append(package)
+            if repo_dict and repo_name in repo_dict:
+                kept = set(purge_packages)
+                repo_dict[repo_name] = [package for package in repo_dict[repo_name] if package not in kept]
 
-            if purge_packages != packages:
+            if drop:
                 snapshot_name = '{}-{}'.format(name, 'purged')
                 try:
                     lg.debug("Creating new snapshot: %s" % snapshot_name)
@@ -464,23 +833,25 @@ class Publish(object):
 
         return repo_dict
 
-    def restore_publish(self, config, components, recreate=False):
+    def restore_publish(self, config, components, recreate=False, workers=1):
         """
         Restore publish from config file
         """
-        if "all" in components:
-            components = []
-
-        try:
-            self.load()
-            publish = True
-        except NoSuchPublish:
-            publish = False
+        snapshots = self.prepare_restore(config, components)
+        Publish.create_restored_snapshots(self.client, snapshots, workers=workers)
+        self.apply_restore(snapshots, components)
+        self.do_publish(recreate=recreate, merge_snapshots=False)
 
-        new_publish_snapshots = []
-        to_publish = []
-        created_snapshots = []
+    def prepare_restore(self, config, components, timestamp=None):
+        """
+        Return list of snapshots to create for restored components of
+        publish dump, as dicts with keys Component, Name, Description and
+        PackageRefs
+        """
+        components = [] if not components or "all" in components else components
 
+        timestamp = timestamp or time.strftime("%Y%m%d%H%M%S")
+        snapshots = []
         for saved_component in config.get('components', []):
             component_name = saved_component.get('component')
 
@@ -490,61 +861,106 @@ class Publish(object):
             if components and component_name not in components:
                 continue
 
-            saved_packages = []
-            if not saved_component.get('packages'):
+            # Components loaded from dump archive already have package refs
+            refs = saved_component.get('refs')
+            if refs is None:
+                refs = package_refs(saved_component.get('packages') or [])
+            if not refs:
                 raise Exception("Component %s is empty" % component_name)
 
-            for package in saved_component.get('packages'):
-                package_ref = '{} {} {} {}'.format(package.get('arch'), package.get('package'), package.get('version'), package.get('ref'))
-                saved_packages.append(package_ref)
+            snapshots.append({
+                'Component': component_name,
+                'Name': '{}-{}-{}'.format("restored", timestamp, saved_component.get('snapshot')),
+                'Description': saved_component.get('description'),
+                'PackageRefs': refs,
+            })
 
-            to_publish.append(component_name)
+        if components and len(set(x['Component'] for x in snapshots)) != len(set(components)):
+            raise Exception("Not possible to find all the components required in the backup file")
 
-            timestamp = time.strftime("%Y%m%d%H%M%S")
-            snapshot_name = '{}-{}-{}'.format("restored", timestamp, saved_component.get('snapshot'))
-            lg.debug("Creating snapshot %s for component %s of packages: %s"
-                     % (snapshot_name, component_name, saved_packages))
+        return snapshots
 
-            try:
-                self.client.do_post(
-                    '/snapshots',
-                    data={
-                        'Name': snapshot_name,
-                        'SourceSnapshots': [],
-                        'Description': saved_component.get('description'),
-                        'PackageRefs': saved_packages,
-                    }
-                )
-                created_snapshots.append(snapshot_name)
-            except AptlyException as e:
-                if e.res.status_code == 404:
-                    # delete all the previously created
-                    # snapshots because the file is corrupted
-                    self._remove_snapshots(created_snapshots)
-                    raise Exception("Source snapshot or packages don't exist")
-                else:
-                    raise
+    @staticmethod
+    def create_restored_snapshots(client, snapshots, workers=1):
+        """
+        Create snapshots returned by prepare_restore, with workers > 1
+        concurrently. When creation of any of them fails, already created
+        snapshots are deleted.
 
-            new_publish_snapshots.append({
-                'Component': component_name,
-                'Name': snapshot_name
-            })
+        Snapshots with the same name (eg. shared by several restored
+        publishes) are created only once.
+        """
+        created = {}
+        renamed = {}
+        jobs = []
+        for snapshot in snapshots:
+            name = snapshot['Name']
+            if name in created:
+                if created[name] == snapshot['PackageRefs']:
+                    continue
+                # Snapshot of the same name had different packages when it
+                # was dumped, restore it under unique name
+                base = name
+                while name in created:
+                    renamed[base] = renamed.get(base, 0) + 1
+                    name = '{}-{}'.format(base, renamed[base])
+                snapshot['Name'] = name
+
+            created[name] = snapshot['PackageRefs']
+            lg.debug("Creating snapshot %s for component %s of %s packages"
+                     % (name, snapshot['Component'], len(snapshot['PackageRefs'])))
+            jobs.append((name, None, functools.partial(
+                client.do_post, '/snapshots', data={
+                    'Name': name,
+                    'SourceSnapshots': [],
+                    'Description': snapshot['Description'],
+                    'PackageRefs': snapshot['PackageRefs'],
+                }
+            )))
+
+        if not workers or workers <= 1:
+            results, failures = ({}, {})
+            for name, _, create in jobs:
+                try:
+                    results[name] = create()
+                except Exception as e:
+                    failures[name] = e
+                    break
+        else:
+            results, failures = WorkerPool(workers).run(jobs)
 
-        if components:
-            self.publish_snapshots = [x for x in self.publish_snapshots if x['Component'] not in components and x['Component'] not in to_publish]
-            check_components = [x for x in new_publish_snapshots if x['Component'] in components]
-            if len(check_components) != len(components):
-                self._remove_snapshots(created_snapshots)
-                raise Exception("Not possible to find all the components required in the backup file")
+        if failures:
+            # delete all the previously created snapshots because the file
+            # is corrupted
+            for name in results.keys():
+                client.do_delete('/snapshots/%s' % name)
 
-        self.publish_snapshots += new_publish_snapshots
-        self.do_publish(recreate=recreate, merge_snapshots=False)
+            error = list(failures.values())[0]
+            if isinstance(error, AptlyException) and error.res.status_code == 404:
+                raise Exception("Source snapshot or packages don't exist")
+            raise error
+
+    def apply_restore(self, snapshots, components):
+        """
+        Replace components of publish by restored snapshots
+        """
+        try:
+            self.load()
+        except NoSuchPublish:
+            pass
+
+        components = [] if not components or "all" in components else components
+        restored = set(x['Component'] for x in snapshots)
+        self.publish_snapshots = [x for x in self.publish_snapshots if x['Component'] not in components and x['Component'] not in restored]
+        self.publish_snapshots += [{'Component': x['Component'], 'Name': x['Name']} for x in snapshots]
 
     def load(self):
         """
         Load publish info from remote
         """
-        publish = self._get_publish()
+        self._load_remote(self._get_publish())
+
+    def _load_remote(self, publish):
         self.architectures = publish['Architectures']
         for source in publish['Sources']:
             component = source['Component']
@@ -562,34 +978,37 @@ class Publish(object):
         """
         Return package refs for given components
         """
+        return self.get_package_table(component, components, packages).refs()
+
+    def get_package_table(self, component=None, components=[], packages=None):
+        """
+        Return PackageRefTable of packages for given components
+        """
         if component:
             components = [component]
 
-        package_refs = []
+        if packages and not isinstance(packages, PackageSelection):
+            packages = PackageSelection(packages)
+
+        package_table = PackageRefTable()
         for snapshot in self.publish_snapshots:
             if component and snapshot['Component'] not in components:
                 # We don't want packages for this component
                 continue
 
-            component_refs = self._get_packages(self.client, "snapshots", snapshot['Name'])
+            component_table = self._get_package_table(self.client, "snapshots", snapshot['Name'])
             if packages:
-                # Filter package names
-                for ref in component_refs:
-                    if self.parse_package_ref(ref)[1] in packages:
-                        package_refs.append(ref)
-            else:
-                package_refs.extend(component_refs)
+                # Select packages by names and versions
+                component_table = component_table.filter_packages(packages)
+            package_table.extend(component_table)
 
-        return package_refs
+        return package_table
 
     def parse_package_ref(self, ref):
         """
         Return tuple of architecture, package_name, version, id
         """
-        if not ref:
-            return None
-        parsed = re.match('(.*)\ (.*)\ (.*)\ (.*)', ref)
-        return parsed.groups()
+        return parse_ref(ref)
 
     def add(self, snapshot, component='main'):
         """
@@ -600,16 +1019,14 @@ class Publish(object):
         except KeyError:
             self.components[component] = [snapshot]
 
-    def _find_snapshot(self, name):
+    def _find_snapshot(self, name, regex=False):
         """
         Find snapshot on remote by name or regular expression
         """
-        remote_snapshots = self._get_snapshots(self.client)
-        for remote in reversed(remote_snapshots):
-            if remote["Name"] == name or \
-                    re.match(name, remote["Name"]):
-                return remote
-        return None
+        index = self._get_snapshot_index(self.client)
+        if regex:
+            return index.match(name)
+        return index.get(name)
 
     def _get_source_snapshots(self, snapshot, fallback_self=False):
         """
@@ -631,7 +1048,72 @@ class Publish(object):
         """
         Create component snapshots by merging other snapshots of same component
         """
+        to_merge = self._find_merges()
+
+        if not self.client.has_feature('snapshot_merge'):
+            # Fetch packages of all snapshots to merge at once
+            self._prefetch_packages(self.client, "snapshots", [snapshot for _, snapshots, _ in to_merge for snapshot in snapshots])
+
+        for component, snapshots, snapshot_name in to_merge:
+            lg.info("Creating merge snapshot %s for component %s of snapshots %s" % (snapshot_name, component, snapshots))
+            try:
+                self._create_merge_snapshot(snapshots, snapshot_name)
+            except AptlyException as e:
+                if e.res.status_code == 400:
+                    lg.warning("Error creating snapshot %s, assuming it already exists" % snapshot_name)
+                else:
+                    raise
+
+    def _create_merge_snapshot(self, snapshots, snapshot_name):
+        uri, data = self._merge_snapshot_request(snapshots, snapshot_name)
+        try:
+            self.client.do_post(uri, data=data)
+        except AptlyException as e:
+            if uri == '/snapshots' or e.res.status_code not in (404, 405):
+                raise
+            lg.warning("Server-side merge of snapshot %s failed (%s), merging on client" % (snapshot_name, e))
+            self.client.do_post('/snapshots', data=self._merge_snapshot_data(snapshots, snapshot_name))
+            # Source snapshots exist, so server doesn't support merge
+            self.client.disable_feature('snapshot_merge')
+
+    def _merge_snapshot_request(self, snapshots, snapshot_name):
+        """
+        Return tuple (uri, data) of request creating merge snapshot, when
+        server supports it, packages are merged there
+        """
+        if self.client.has_feature('snapshot_merge'):
+            # Keep all packages of all sources like client-side merge does,
+            # description is the same too
+            return ('/snapshots/%s/merge?no-remove=1' % snapshot_name, {
+                'Sources': snapshots,
+            })
+        return ('/snapshots', self._merge_snapshot_data(snapshots, snapshot_name))
+
+    def _merge_snapshot_data(self, snapshots, snapshot_name, packages=True):
+        """
+        Return data of request creating merge snapshot from packages merged
+        on client, without packages=True only with sources to merge
+        """
+        data = {
+            'Name': snapshot_name,
+            'SourceSnapshots': snapshots,
+            'Description': "Merged from sources: %s" % ', '.join("'%s'" % snap for snap in snapshots),
+        }
+        if packages:
+            package_refs = []
+            for snapshot in snapshots:
+                # Get package refs from each snapshot
+                package_refs.extend(self._get_packages(self.client, "snapshots", snapshot))
+            data['PackageRefs'] = package_refs
+        return data
+
+    def _find_merges(self):
+        """
+        Set publish snapshots and return list of merge snapshots to create
+        as tuples (component, source snapshots, snapshot name)
+        """
         self.publish_snapshots = []
+        to_merge = []
         for component, snapshots in self.components.items():
             if len(snapshots) <= 1:
                 # Only one snapshot, no need to merge
@@ -643,7 +1125,7 @@ class Publish(object):
                 continue
 
             # Look if merged snapshot doesn't already exist
-            remote_snapshot = self._find_snapshot(r'^%s%s-%s-\d+' % (self.merge_prefix, self.name.replace('./', '').replace('/', '-'), component))
+            remote_snapshot = self._get_snapshot_index(self.client).latest('%s%s-%s' % (self.merge_prefix, self.name.replace('./', '').replace('/', '-'), component))
             if remote_snapshot:
                 source_snapshots = self._get_source_snapshots(remote_snapshot)
 
@@ -661,33 +1143,12 @@ class Publish(object):
                     continue
 
             snapshot_name = '%s%s-%s-%s' % (self.merge_prefix, self.name.replace('./', '').replace('/', '-'), component, self.timestamp)
-            lg.info("Creating merge snapshot %s for component %s of snapshots %s" % (snapshot_name, component, snapshots))
-            package_refs = []
-            for snapshot in snapshots:
-                # Get package refs from each snapshot
-                packages = self._get_packages(self.client, "snapshots", snapshot)
-                package_refs.extend(packages)
-
-            try:
-                self.client.do_post(
-                    '/snapshots',
-                    data={
-                        'Name': snapshot_name,
-                        'SourceSnapshots': snapshots,
-                        'Description': "Merged from sources: %s" % ', '.join("'%s'" % snap for snap in snapshots),
-                        'PackageRefs': package_refs,
-                    }
-                )
-            except AptlyException as e:
-                if e.res.status_code == 400:
-                    lg.warning("Error creating snapshot %s, assuming it already exists" % snapshot_name)
-                else:
-                    raise
-
+            to_merge.append((component, snapshots, snapshot_name))
             self.publish_snapshots.append({
                 'Component': component,
                 'Name': snapshot_name
             })
+        return to_merge
 
     def drop_publish(self):
         lg.info("Deleting publish, distribution=%s, storage=%s" % (self.name, self.storage or "local"))
@@ -697,7 +1158,11 @@ class Publish(object):
                        acquire_by_hash=True):
         lg.info("Updating publish, distribution=%s storage=%s snapshots=%s" %
                 (self.name, self.storage or "local", self.publish_snapshots))
-        self.client.do_put(
+        self.client.do_put(*self._update_publish_request(force_overwrite, publish_contents, acquire_by_hash))
+
+    def _update_publish_request(self, force_overwrite, publish_contents,
+                                acquire_by_hash):
+        return (
             '/publish/%s' % (self.full_name),
             {
                 'Snapshots': self.publish_snapshots,
@@ -711,7 +1176,11 @@ class Publish(object):
                        architectures=None, acquire_by_hash=True):
         lg.info("Creating new publish, distribution=%s storage=%s snapshots=%s, architectures=%s" %
                 (self.name, self.storage or "local", self.publish_snapshots, architectures))
+        self.client.do_post(*self._create_publish_request(force_overwrite, publish_contents,
+                                                          architectures, acquire_by_hash))
 
+    def _create_publish_request(self, force_overwrite, publish_contents,
+                                architectures, acquire_by_hash):
         if self.prefix:
             prefix = '%s%s' % ("/"+self.storage+":" or "/", self.prefix)
         else:
@@ -730,9 +1199,98 @@ class Publish(object):
         if architectures or self.architectures:
             opts['Architectures'] = architectures or self.architectures
 
-        self.client.do_post(
-            '/publish%s' % (prefix or ''),
-            opts
+        return ('/publish%s' % (prefix or ''), opts)
+
+    def plan_publish(self, plan, recreate=False, no_recreate=False,
+                     force_overwrite=False, publish_contents=False,
+                     acquire_by_hash=False, architectures=None,
+                     merge_snapshots=True):
+        """
+        Add operations needed to publish into Plan, it reads current state
+        only and doesn't change anything
+
+        Return list of ids of added operations
+        """
+        added = []
+        if merge_snapshots:
+            to_merge = self._find_merges()
+            if not self.client.has_feature('snapshot_merge'):
+                self._prefetch_packages(self.client, "snapshots", [snapshot for _, snapshots, _ in to_merge for snapshot in snapshots])
+            for component, snapshots, snapshot_name in to_merge:
+                uri, data = self._merge_snapshot_request(snapshots, snapshot_name)
+                fallback = None
+                if uri != '/snapshots':
+                    # Server may not support merge, packages are merged on
+                    # client then
+                    fallback = {
+                        'uri': '/snapshots',
+                        'data': self._merge_snapshot_data(snapshots, snapshot_name, packages=False),
+                    }
+                added.append(plan.add(
+                    'create-snapshot:%s' % snapshot_name, 'POST', uri, data=data,
+                    description="Create merge snapshot %s for component %s of snapshots %s" % (snapshot_name, component, snapshots),
+                    storage=self.storage,
+                    # snapshot probably already exists
+                    ignore_status=[400],
+                    fallback=fallback,
+                ))
+
+        try:
+            publish = self._get_publish()
+        except NoSuchPublish:
+            publish = None
+
+        architectures = architectures or self.architectures
+        create = functools.partial(self._plan_create_publish, plan, force_overwrite,
+                                   publish_contents, architectures, acquire_by_hash)
+
+        if not publish:
+            added.append(create(list(added)))
+            return added
+
+        to_publish = sorted(x['Name'] for x in self.publish_snapshots)
+        published = sorted(x['Name'] for x in publish['Sources'])
+
+        if recreate:
+            drop = self._plan_drop_publish(plan, list(added))
+            added.extend([drop, create(added + [drop])])
+        elif to_publish == published:
+            lg.info("Publish %s (%s) is up to date" % (self.name, self.storage or "local"))
+        elif sorted(x['Component'] for x in self.publish_snapshots) == \
+                sorted(x['Component'] for x in publish['Sources']):
+            uri, data = self._update_publish_request(force_overwrite, publish_contents, acquire_by_hash)
+            added.append(plan.add(
+                'update-publish:%s' % self.full_name, 'PUT', uri, data=data,
+                depends=list(added),
+                description="Update publish %s (%s) to snapshots %s" % (self.name, self.storage or "local", to_publish),
+                storage=self.storage,
+            ))
+        elif no_recreate:
+            lg.error("Cannot update publish %s (adding new components?), falling back to recreating it is disabled so skipping." % self.full_name)
+        else:
+            # Only way to add new components is to recreate publish
+            lg.warning("Cannot update publish %s (adding new components?), planning to recreate it" % self.full_name)
+            drop = self._plan_drop_publish(plan, list(added))
+            added.extend([drop, create(added + [drop])])
+        return added
+
+    def _plan_create_publish(self, plan, force_overwrite, publish_contents,
+                             architectures, acquire_by_hash, depends):
+        uri, data = self._create_publish_request(force_overwrite, publish_contents,
+                                                 architectures, acquire_by_hash)
+        return plan.add(
+            'create-publish:%s' % self.full_name, 'POST', uri, data=data,
+            depends=depends,
+            description="Create publish %s (%s) of snapshots %s" % (self.name, self.storage or "local", [x['Name'] for x in self.publish_snapshots]),
+            storage=self.storage,
+        )
+
+    def _plan_drop_publish(self, plan, depends):
+        return plan.add(
+            'drop-publish:%s' % self.full_name, 'DELETE', '/publish/%s' % self.full_name,
+            depends=depends,
+            description="Delete publish %s (%s)" % (self.name, self.storage or "local"),
+            storage=self.storage,
         )
 
     def do_publish(self, recreate=False, no_recreate=False,
@@ -6,11 +6,21 @@ from __future__ import print_function
 import sys
 import argparse
 from aptly.client import Aptly
+from aptly.cache import Cache
+from aptly.store import PackageStore
+from aptly.index import PackageIndex
+from aptly.transport import get_codec, RetryPolicy
+from aptly.cassette import Cassette
 from aptly.publisher import PublishManager, Publish
+from aptly.publisher.workers import parse_storage_workers
+from aptly.publisher.plan import Plan, PlanExecutor
+from aptly.publisher.diff import DiffEngine, package_changes
+from aptly.publisher.packages import PackageSelection
+from aptly.publisher.promote import BatchPromoter
 from aptly.exceptions import NoSuchPublish
 import yaml
+import json
 import logging
-import copy
 import re
 
 logging.basicConfig()
@@ -20,25 +30,29 @@ lg = logging.getLogger('aptly-publisher')
 
 def load_config(config):
     with open(config, 'r') as fh:
-        return yaml.load(fh)
+        return yaml.safe_load(fh)
 
 
 def get_latest_snapshot(snapshots, name):
-    for snapshot in reversed(snapshots):
-        if re.match(r'%s[-_]\d+' % name, snapshot['Name']):
-            return snapshot['Name']
+    """
+    Return name of latest snapshot <name>-<number> or <name>_<number> from
+    SnapshotIndex
+    """
+    snapshot = snapshots.latest(name, separators='-_')
+    if snapshot:
+        return snapshot['Name']
 
 
 def main():
     parser = argparse.ArgumentParser("aptly-publisher")
 
     group_common = parser.add_argument_group("Common")
-    parser.add_argument('action', help="Action to perform (publish, promote, cleanup, restore, dump, purge)")
+    parser.add_argument('action', help="Action to perform (publish, promote, cleanup, restore, dump, purge, apply, query)")
     group_common.add_argument('-v', '--verbose', action="store_true")
     group_common.add_argument('-d', '--debug', action="store_true")
     group_common.add_argument('--dry', '--dry-run', action="store_true")
     group_common.add_argument('--timeout', type=int, default=300, help="Aptly client timeout. Raise for larger publishes and slow server.")
-    group_common.add_argument('--url', required=True, help="URL to Aptly API, eg. http://localhost:8080")
+    group_common.add_argument('--url', help="URL to Aptly API, eg. http://localhost:8080 (required unless --replay-cassette is used)")
     group_common.add_argument('--recreate', action="store_true", help="Drop publish and create it again, only way to add new components")
     group_common.add_argument('--no-recreate', action="store_true", help="Never recreate publish (even when we are adding new components where it's the only option)")
     group_common.add_argument('--force-overwrite', action="store_true", help="Overwrite files in pool/ directory without notice")
@@ -46,6 +60,25 @@ def main():
     group_common.add_argument('--acquire-by-hash', action="store_true", default=False, help="Use Acquire-by-hash option. This may help with repository consistency.")
     group_common.add_argument('--components', nargs='+', help="Space-separated list of components to promote or restore or to purge (in case of purge)")
     group_common.add_argument('--storage', default="", help="Storage backend to use for all publishes, can be empty (filesystem, default), swift:[name] or s3:[name]")
+    group_common.add_argument('--tasks', action="store_true", default=False, help="Run mutating API calls as Aptly background tasks and poll for their result, so long publishes are not limited by --timeout")
+    group_common.add_argument('--task-timeout', type=int, help="Maximum time to wait for background task, default unlimited")
+    group_common.add_argument('--cache-size', type=int, default=512, help="Maximum size of cached API results in MB")
+    group_common.add_argument('--cache-ttl', type=int, help="Expire cached API results after given number of seconds, default never")
+    group_common.add_argument('--package-store', help="Path to persistent store of snapshot package lists reused by later runs, eg. ~/.cache/aptly-publisher/packages.db")
+    group_common.add_argument('--package-store-size', type=int, default=1024, help="Maximum size of persistent package store in MB")
+    group_common.add_argument('--async-client', action="store_true", default=False, help="Use asyncio Aptly client (requires aiohttp), requests share single event loop")
+    group_common.add_argument('--pool-size', type=int, default=100, help="Maximum number of connections to Aptly API kept open (should be at least --workers)")
+    group_common.add_argument('--retries', type=int, default=3, help="Number of retries of request failed by connection error, timeout or 502, 503, 504 status, default 3 (POST requests are retried only when it's safe)")
+    group_common.add_argument('--retry-backoff', type=float, default=0.5, help="Initial delay before retry in seconds, doubled by every retry (with random jitter)")
+    group_common.add_argument('--retry-budget', type=int, help="Maximum number of retries during whole run, default unlimited")
+    group_common.add_argument('--json-codec', default='auto', help="JSON codec used to encode and decode API payloads (json, orjson), default is orjson when installed")
+    group_common.add_argument('--stream-requests', action="store_true", default=False, help="Encode large request bodies incrementally and send them as chunked requests")
+    group_common.add_argument('--compress-requests', action="store_true", default=False, help="Compress request bodies by gzip (requires server or proxy decompressing them)")
+    group_common.add_argument('--metrics-file', help="Write per-endpoint metrics of API requests into given file at the end of run")
+    group_common.add_argument('--metrics-format', choices=['json', 'prometheus'], help="Format of --metrics-file, default prometheus (for node_exporter textfile collector) for .prom files, json otherwise")
+    group_common.add_argument('--record-cassette', help="Record all API requests and responses into given cassette file (eg. run.cassette.gz) to replay them later without server")
+    group_common.add_argument('--replay-cassette', help="Replay API responses from given cassette file instead of sending requests to server")
+    group_common.add_argument('--replay-latency-scale', type=float, default=1.0, help="Multiplier of recorded latencies of replayed responses, 0 to respond immediately, default 1 (original latencies)")
     group_common.add_argument('-p', '--publish', nargs='+', help="Space-separated list of publish")
 
     group_publish = parser.add_argument_group("Action 'publish'")
@@ -53,22 +86,37 @@ def main():
     group_publish.add_argument('--dists', nargs='+', help="Space-separated list of distribution to work with (including prefix), default all.")
     group_publish.add_argument('--architectures', nargs='+', help="List of architectures to publish (also determined by config, defaults to amd64, i386)")
     group_publish.add_argument('--only-latest', action="store_true", default=False, help="Publish only latest packages of every publishes")
+    group_publish.add_argument('--workers', type=int, default=1, help="Number of publishes to execute, dump or restore (or snapshots to delete by cleanup or create by restore) concurrently, default 1 (serial)")
+    group_publish.add_argument('--storage-workers', nargs='+', help="Space-separated list of concurrency limits per storage backend or storage name, eg. s3=2 swift=2 filesystem=4")
+    group_publish.add_argument('--plan', action="store_true", default=False, help="Compute all operations first and execute them as dependency graph (independent operations concurrently with --workers). With --dry plan is printed instead.")
+    group_publish.add_argument('--plan-file', help="Save computed plan as JSON into given file (or execute plan from this file with action 'apply')")
+    group_publish.add_argument('--cleanup', action="store_true", default=False, help="With --plan also delete snapshots which are not used after publishing")
 
     group_promote = parser.add_argument_group("Action 'promote'")
     group_promote.add_argument('--source', help="Source publish to take snapshots from. Can be regular expression, eg. jessie(/?.*)/nightly")
     group_promote.add_argument('--target', help="Target publish to update. Must be format if source is regex, eg. jessie{0}/testing")
-    group_promote.add_argument('--packages', nargs='+', help="Space-separated list of packages to promote")
-    group_promote.add_argument('--diff', action="store_true", help="Show differences between publishes (snapshots to be updated)")
+    group_promote.add_argument('--packages', nargs='+', help="Space-separated list of packages to promote (or to query), names can be globs (python-*) or regular expressions in slashes (/^lib.*-dev$/) with optional version constraint, eg. 'aptly (>= 1.2)'")
+    group_promote.add_argument('--diff', action="store_true", help="Show differences between publishes (snapshots to be updated), components are compared concurrently with --workers")
+    group_promote.add_argument('--diff-format', choices=['text', 'json'], default='text', help="Output format of --diff, text (default) or json (JSON line per component)")
+    group_promote.add_argument('--diff-local', action="store_true", default=False, help="Compare packages locally after fetching package lists instead of by server (lists already cached are always compared locally)")
+
+    group_query = parser.add_argument_group("Action 'query'")
+    group_query.add_argument('--index', default='~/.cache/aptly-publisher/index.db', help="Path to persistent index of packages of published snapshots, default ~/.cache/aptly-publisher/index.db")
+    group_query.add_argument('--no-index-update', action="store_true", default=False, help="Query index without updating it from server (which isn't contacted at all, --url is needed only when index contains more servers)")
+    group_query.add_argument('--index-all-snapshots', action="store_true", default=False, help="Index all snapshots, not only published ones and their sources")
+    group_query.add_argument('--query-format', choices=['text', 'json'], default='text', help="Output format of query, text (default) or json (JSON line per package version)")
 
     group_purge = parser.add_argument_group("Purge")
     group_purge.add_argument('--hard', action="store_true", default=False, help="Remove all unused packages and snapshots")
 
     group_restore = parser.add_argument_group("Action 'restore'")
-    group_restore.add_argument('-r', '--restore-file', help="File used to restore publish")
+    group_restore.add_argument('-r', '--restore-file', nargs='+', help="Space-separated list of files used to restore publishes, they are published as a batch (concurrently with --workers). Dump archives are detected automatically, only publishes given by --publish are restored from them (default all).")
 
     group_save = parser.add_argument_group("Action 'dump'")
     group_save.add_argument('-s', '--save-dir', default='.', help="Path of where dump of publish will be done")
     group_save.add_argument('-x', '--prefix', default="saved-", help="Prefix for dump files' names")
+    group_save.add_argument('--format', dest='dump_format', choices=['yaml', 'archive'], default='yaml', help="Dump format, yaml (file per publish, default) or archive (single compressed file with package lists shared by publishes)")
+    group_save.add_argument('--baseline', help="Previous dump archive, dump only changes since it (implies --format archive)")
 
     args = parser.parse_args()
 
@@ -80,124 +128,166 @@ def main():
         lg_aptly.setLevel(logging.DEBUG)
         lg.setLevel(logging.DEBUG)
 
-    client = Aptly(args.url, dry=args.dry, timeout=args.timeout)
-    publishmgr = PublishManager(client, storage=args.storage)
-
-    if args.action == 'publish':
-        action_publish(client, publishmgr, config_file=args.config,
-                       recreate=args.recreate,
-                       no_recreate=args.no_recreate,
-                       force_overwrite=args.force_overwrite,
-                       publish_contents=args.publish_contents,
-                       acquire_by_hash=args.acquire_by_hash,
-                       publish_names=args.publish,
-                       publish_dist=args.dists,
-                       architectures=args.architectures,
-                       only_latest=args.only_latest,
-                       components=args.components)
-    elif args.action == 'promote':
-        if not args.source or not args.target:
-            parser.error("Action 'promote' requires both --source and --target arguments")
-        action_promote(client, source=args.source, target=args.target,
-                       components=args.components, recreate=args.recreate,
-                       no_recreate=args.no_recreate, packages=args.packages,
-                       diff=args.diff, force_overwrite=args.force_overwrite,
-                       publish_contents=args.publish_contents,
-                       acquire_by_hash=args.acquire_by_hash,
-                       storage=args.storage)
-    elif args.action == 'cleanup':
-        publishmgr.cleanup_snapshots()
-        sys.exit(0)
-    elif args.action == 'dump':
-        action_dump(publishmgr, args.save_dir, args.publish, args.prefix)
-    elif args.action == 'purge':
-        config = load_config(args.config)
-        publishmgr.do_purge(config, components=args.components, hard_purge=args.hard)
-    elif args.action == "restore":
-        action_restore(publishmgr, components=args.components,
-                       recreate=args.recreate,
-                       restore_file=args.restore_file)
-
-def promote(client, source, target, components=None, recreate=False,
-            no_recreate=False, packages=None, diff=False, force_overwrite=False,
-            publish_contents=False, acquire_by_hash=False, storage=""):
     try:
-        publish_source = Publish(client, source, load=True, storage=storage)
-    except NoSuchPublish as e:
-        lg.error(e)
-        sys.exit(1)
+        storage_workers = parse_storage_workers(args.storage_workers)
+    except ValueError as e:
+        parser.error(str(e))
 
-    publish_target = Publish(client, target, storage=storage)
     try:
-        publish_target.load()
-    except NoSuchPublish:
-        if diff:
-            lg.error("Target publish %s does not exist" % target)
-            sys.exit(1)
-        # Target doesn't have to exist, it will be created
-        pass
-
-    if diff:
-        # Only print differences and exit
-        action_diff(source=publish_source, target=publish_target, components=components)
-        sys.exit(0)
-
-    # Check if target is not already up to date
-    diffs, equals = publish_source.compare(publish_target, components=components)
-    if not diffs:
-        lg.warn("Target {0} is up to date with source publish {1}".format(target, source))
-        if not recreate:
-            lg.warn("There is nothing to do with target publish {0}".format(target))
-            sys.exit(0)
+        codec = get_codec(args.json_codec)
+    except (ValueError, ImportError) as e:
+        parser.error("Invalid JSON codec: %s" % e)
+
+    packages = None
+    if args.packages:
+        try:
+            packages = PackageSelection(args.packages)
+        except re.error as e:
+            parser.error("Invalid package pattern in --packages: %s" % e)
+        except ImportError as e:
+            parser.error("Invalid --packages: %s" % e)
+
+    if args.action == 'query':
+        if not packages:
+            parser.error("Action 'query' requires --packages argument")
+        if args.no_index_update:
+            # Index is queried without server, only URL identifies it
+            action_query(packages, args.index, url=args.url,
+                         architectures=args.architectures,
+                         output_format=args.query_format)
+            return
+
+    cassette = None
+    if args.record_cassette and args.replay_cassette:
+        parser.error("Options --record-cassette and --replay-cassette can't be used together")
+    if args.record_cassette or args.replay_cassette:
+        if args.async_client:
+            parser.error("Cassettes are not supported by asyncio client")
+        if args.record_cassette:
+            cassette = Cassette(args.record_cassette, 'record')
         else:
-            lg.warn("Recreating target publish {0} on your command".format(target))
-
-    if packages:
-        # We are only going to promote specific packages
-        packages_promoted = False
-        for component, snapshots in publish_source.components.items():
-            if components and component not in components:
-                # We don't want to promote this component
-                continue
-
-            # Get packages to promote
-            package_refs = publish_source.get_packages(component=component, packages=packages)
-            if package_refs:
-                # Create snapshot for selected packages
-                snapshot_name = 'ext_%s-%s' % (component, publish_target.timestamp)
-                lg.debug("Creating snapshot %s for component %s of packages: %s" % (snapshot_name, component, packages))
-                client.do_post(
-                    '/snapshots',
-                    data={
-                        'Name': snapshot_name,
-                        'SourceSnapshots': snapshots,
-                        'Description': "Promoted packages from snapshots %s: %s" % (snapshots, packages),
-                        'PackageRefs': package_refs,
-                    }
-                )
-                publish_target.components[component].append(snapshot_name)
-                packages_promoted = True
-        if not packages_promoted:
-            lg.error("No packages were promoted : are you sure components: %s and packages: %s are valid?" % (components, packages))
-            sys.exit(1)
+            cassette = Cassette(args.replay_cassette, 'replay',
+                                latency_scale=args.replay_latency_scale)
+            # Server is not needed, recorded URL is used for messages only
+            args.url = args.url or cassette.url
+    if not args.url:
+        parser.error("argument --url is required")
+
+    cache = Cache(max_bytes=args.cache_size * 1024 * 1024, ttl=args.cache_ttl)
+    package_store = None
+    if args.package_store:
+        package_store = PackageStore(args.package_store,
+                                     max_bytes=args.package_store_size * 1024 * 1024)
+    if args.async_client:
+        from aptly.aio import AptlyBridge
+        client = AptlyBridge(args.url, dry=args.dry, timeout=args.timeout,
+                             pool_size=args.pool_size, use_tasks=args.tasks,
+                             task_timeout=args.task_timeout, cache=cache,
+                             package_store=package_store, codec=codec,
+                             stream_requests=args.stream_requests,
+                             compress_requests=args.compress_requests)
     else:
-        # Publish whole components
-        # Use source publish components structure for creation of target publish
-        if not components:
-            publish_target.components = copy.deepcopy(publish_source.components)
-        else:
-            for component in components:
-                try:
-                    publish_target.components[component] = copy.deepcopy(publish_source.components[component])
-                except KeyError:
-                    lg.error("Component %s does not exist")
-                    sys.exit(1)
-
-    publish_target.do_publish(recreate=recreate, no_recreate=no_recreate,
-                              force_overwrite=force_overwrite,
-                              publish_contents=publish_contents,
-                              acquire_by_hash=acquire_by_hash,
-                              architectures=publish_source.architectures)
+        client = Aptly(args.url, dry=args.dry, timeout=args.timeout,
+                       use_tasks=args.tasks, task_timeout=args.task_timeout,
+                       cache=cache, package_store=package_store,
+                       codec=codec, stream_requests=args.stream_requests,
+                       compress_requests=args.compress_requests,
+                       retry=RetryPolicy(retries=args.retries,
+                                         backoff_initial=args.retry_backoff,
+                                         budget=args.retry_budget),
+                       pool_size=args.pool_size, cassette=cassette)
+    publishmgr = PublishManager(client, storage=args.storage)
+
+    if args.only_latest and (args.plan or args.plan_file):
+        parser.error("Option --only-latest can't be used with --plan")
+
+    try:
+        if args.action == 'publish':
+            action_publish(client, publishmgr, config_file=args.config,
+                           recreate=args.recreate,
+                           no_recreate=args.no_recreate,
+                           force_overwrite=args.force_overwrite,
+                           publish_contents=args.publish_contents,
+                           acquire_by_hash=args.acquire_by_hash,
+                           publish_names=args.publish,
+                           publish_dist=args.dists,
+                           architectures=args.architectures,
+                           only_latest=args.only_latest,
+                           components=args.components,
+                           workers=args.workers,
+                           storage_workers=storage_workers,
+                           plan=args.plan or bool(args.plan_file),
+                           plan_file=args.plan_file, cleanup=args.cleanup,
+                           dry=args.dry)
+        elif args.action == 'apply':
+            if not args.plan_file:
+                parser.error("Action 'apply' requires --plan-file argument")
+            with open(args.plan_file, 'r') as plan_file:
+                plan = Plan.from_json(plan_file.read())
+            execute_plan(client, plan, dry=args.dry, workers=args.workers,
+                         storage_workers=storage_workers)
+        elif args.action == 'promote':
+            if not args.source or not args.target:
+                parser.error("Action 'promote' requires both --source and --target arguments")
+            action_promote(client, source=args.source, target=args.target,
+                           components=args.components, recreate=args.recreate,
+                           no_recreate=args.no_recreate, packages=packages,
+                           diff=args.diff, force_overwrite=args.force_overwrite,
+                           publish_contents=args.publish_contents,
+                           acquire_by_hash=args.acquire_by_hash,
+                           storage=args.storage, workers=args.workers,
+                           storage_workers=storage_workers,
+                           diff_format=args.diff_format,
+                           diff_local=args.diff_local)
+        elif args.action == 'cleanup':
+            if args.dry:
+                # Show snapshots that would be deleted
+                plan = Plan()
+                publishmgr.plan_cleanup(plan)
+                execute_plan(client, plan, dry=True)
+            else:
+                publishmgr.cleanup_snapshots(workers=args.workers)
+            sys.exit(0)
+        elif args.action == 'dump':
+            action_dump(publishmgr, args.save_dir, args.publish, args.prefix,
+                        workers=args.workers,
+                        dump_format='archive' if args.baseline else args.dump_format,
+                        baseline=args.baseline)
+        elif args.action == 'purge':
+            config = load_config(args.config)
+            publishmgr.do_purge(config, components=args.components, hard_purge=args.hard)
+        elif args.action == 'query':
+            action_query(packages, args.index, publishmgr=publishmgr,
+                         all_snapshots=args.index_all_snapshots,
+                         architectures=args.architectures,
+                         output_format=args.query_format)
+        elif args.action == "restore":
+            action_restore(publishmgr, components=args.components,
+                           recreate=args.recreate,
+                           restore_file=args.restore_file,
+                           workers=args.workers,
+                           storage_workers=storage_workers,
+                           publish_names=args.publish)
+    finally:
+        retry = getattr(client, 'retry', None)
+        if retry and retry.retried:
+            lg.info("Retry statistics: %s" % retry.stats())
+        lg.debug("Cache statistics: %s" % client.cache.stats())
+        if package_store:
+            lg.debug("Package store statistics: %s" % package_store.stats())
+        if args.metrics_file:
+            client.metrics.write(args.metrics_file, args.metrics_format)
+        if cassette:
+            lg.debug("Cassette statistics: %s" % cassette.stats())
+            cassette.close()
+
+
+def promote(client, source, target, **kwargs):
+    """
+    Promote single source publish into target publish
+    """
+    action_promote(client, source=source, target=target, **kwargs)
+
 
 def find_publishes(client, source, target):
     ret = []
@@ -223,92 +313,220 @@ def find_publishes(client, source, target):
     return ret
 
 
-def action_promote(client, **kwargs):
+def action_promote(client, source, target, components=None, recreate=False,
+                   no_recreate=False, packages=None, diff=False,
+                   force_overwrite=False, publish_contents=False,
+                   acquire_by_hash=False, storage="", workers=1,
+                   storage_workers=None, diff_format='text', diff_local=False):
     # Determine if source is regular expression with group, in this case, we
     # will work with multiple publishes
-    if re.search(r'\(.*\)', kwargs['source']):
-        for publish in find_publishes(client, kwargs['source'], kwargs['target']):
-            source = publish[0]
-            target = publish[1]
-            lg.info("Found source publish matching regex, promoting {0} to {1}".format(source, target))
-            kwargs_copy = kwargs.copy()
-            kwargs_copy['source'] = source
-            kwargs_copy['target'] = target
-            try:
-                promote(client, **kwargs_copy)
-            except SystemExit:
-                pass
+    if re.search(r'\(.*\)', source):
+        pairs = find_publishes(client, source, target)
+        for source_name, target_name in pairs:
+            lg.info("Found source publish matching regex, promoting {0} to {1}".format(source_name, target_name))
     else:
-        promote(client, **kwargs)
+        pairs = [(source, target)]
 
-def action_dump(publishmgr, path, publish_to_save, prefix):
-    publishmgr.dump_publishes(publish_to_save, path, prefix)
+    if diff:
+        # Only print differences
+        if not action_diff_publishes(client, pairs, components=components,
+                                     storage=storage, workers=workers,
+                                     diff_format=diff_format,
+                                     diff_local=diff_local):
+            sys.exit(1)
+        return
+
+    promoter = BatchPromoter(client, storage=storage, workers=workers,
+                             storage_workers=storage_workers)
+    promotions = promoter.promote(pairs, components=components,
+                                  packages=packages, recreate=recreate,
+                                  no_recreate=no_recreate,
+                                  force_overwrite=force_overwrite,
+                                  publish_contents=publish_contents,
+                                  acquire_by_hash=acquire_by_hash)
+
+    failed = False
+    for promotion in promotions:
+        if promotion.error:
+            lg.error("Promotion of %s to %s failed: %s" % (promotion.source_name, promotion.target_name, promotion.error))
+            failed = True
+        elif promotion.up_to_date:
+            lg.info("Target %s is up to date with %s, nothing to do" % (promotion.target_name, promotion.source_name))
+        else:
+            lg.info("Promoted %s to %s" % (promotion.source_name, promotion.target_name))
+    if failed:
+        sys.exit(1)
 
 
-def action_restore(publishmgr, components, restore_file, recreate):
-    publishmgr.restore_publish(components, restore_file, recreate)
+def action_diff_publishes(client, publishes, components=None, storage="",
+                          workers=1, diff_format='text', diff_local=False):
+    """
+    Print differences of list of (source, target) publish names
+    """
+    pairs = []
+    ok = True
+    for source, target in publishes:
+        try:
+            pairs.append((Publish(client, source, load=True, storage=storage),
+                          Publish(client, target, load=True, storage=storage)))
+        except NoSuchPublish as e:
+            lg.error(e)
+            ok = False
+
+    return action_diff(client, pairs, components=components, workers=workers,
+                       output_format=diff_format, local=diff_local) and ok
+
+
+def action_dump(publishmgr, path, publish_to_save, prefix, workers=1,
+                dump_format='yaml', baseline=None):
+    failures = publishmgr.dump_publishes(publish_to_save, path, prefix,
+                                         workers=workers,
+                                         dump_format=dump_format,
+                                         baseline=baseline)
+    if failures:
+        for name, error in failures.items():
+            lg.error("Dump of publish %s failed: %s" % (name, error))
+        sys.exit(1)
 
 
-def action_diff(source, target, components=[], packages=True):
-    diff, equal = source.compare(target, components=components)
-    if not diff:
-        print("Target {0} is up to date with source publish {1}".format(target.full_name.replace('_', '/'), source.full_name.replace('_', '/')))
-        return
+def action_query(packages, index_path, publishmgr=None, url=None,
+                 all_snapshots=False, architectures=None, output_format='text'):
+    """
+    Print snapshots and publishes containing selected packages, exit with
+    1 if none was found
+
+    Index is updated from server of publishmgr first, without it index of
+    server with given URL (or the only indexed server) is queried.
+    """
+    with PackageIndex(index_path) as index:
+        if publishmgr:
+            publishmgr.update_package_index(index, all_snapshots=all_snapshots)
+            server = publishmgr.client.url
+        elif url:
+            # Servers are indexed by API URL of client
+            server = '%s/api' % url
+        else:
+            servers = index.servers()
+            if len(servers) != 1:
+                lg.error("Package index %s contains %s servers, select one by --url" % (index_path, len(servers) or 'no'))
+                sys.exit(1)
+            server = servers[0]
+        lg.debug("Package index statistics: %s" % index.stats())
+        results = index.query(server, packages, architectures=architectures)
 
-    print("\033[1;36m= Differencies per component\033[m")
-    for component, snapshots in diff.items():
-        if not snapshots:
+    for result in results:
+        if output_format == 'json':
+            print(json.dumps(result, sort_keys=True))
             continue
 
-        published_source = [i for i in source.publish_snapshots if i['Component'] == component][0]['Name']
-        published_target = [i for i in target.publish_snapshots if i['Component'] == component][0]['Name']
+        print("%s %s %s" % (result['package'], result['version'], result['arch']))
+        for snapshot in result['snapshots']:
+            publishes = ["%s [%s]%s" % (x['publish'], x['component'], '' if x['published'] else ' (source)')
+                         for x in snapshot['publishes']]
+            print("  %s: %s" % (snapshot['name'], ', '.join(publishes) or 'not published'))
 
-        print("\033[1;33m== %s \033[1;30m(%s -> %s)\033[m" % (component, published_target, published_source))
+    if not results:
+        lg.warning("No packages matching %s found" % packages)
+        sys.exit(1)
+
+
+def action_restore(publishmgr, components, restore_file, recreate, workers=1,
+                   storage_workers=None, publish_names=None):
+    failures = publishmgr.restore_publish(components, restore_file, recreate,
+                                          workers=workers,
+                                          storage_workers=storage_workers,
+                                          publish_names=publish_names)
+    if failures:
+        for name, error in failures.items():
+            lg.error("Restore of publish %s failed: %s" % (name, error))
+        sys.exit(1)
+
+
+def action_diff(client, pairs, components=None, packages=True, workers=1,
+                output_format='text', local=False):
+    """
+    Print differences of (source, target) publish pairs as colored text or
+    JSON lines, return False if diff of any component failed
+    """
+    results = DiffEngine(client, workers=workers, local=local).diff(pairs, components=components, packages=packages)
+    failed = False
+    for source, target, component_diffs in results:
+        if output_format == 'json':
+            print_diff_json(source, target, component_diffs, packages)
+        else:
+            print_diff_text(source, target, component_diffs, packages)
+        for component_diff in component_diffs:
+            if component_diff.error:
+                lg.error("Diff of component %s of %s and %s failed: %s" % (component_diff.component, source.name, target.name, component_diff.error))
+                failed = True
+    return not failed
+
+
+def print_diff_text(source, target, component_diffs, packages=True):
+    if not component_diffs:
+        print("Target {0} is up to date with source publish {1}".format(target.full_name.replace('_', '/'), source.full_name.replace('_', '/')))
+        return
+
+    print("\033[1;36m= Differencies per component\033[m")
+    for component_diff in component_diffs:
+        print("\033[1;33m== %s \033[1;30m(%s -> %s)\033[m" % (component_diff.component, component_diff.target_snapshot, component_diff.source_snapshot))
         print("\033[1;35m=== Snapshots:\033[m")
-        for snapshot in snapshots:
+        for snapshot in component_diff.snapshots:
             print("    - %s" % snapshot)
 
         if packages:
             print("\033[1;35m=== Packages:\033[m")
-            diff_packages = source.client.do_get('/snapshots/%s/diff/%s' % (published_source, published_target))
-            if not diff_packages:
+            if component_diff.error:
+                print("\033[1;31m    - Diff failed: %s\033[m" % component_diff.error)
+            elif not component_diff.packages:
                 print("\033[1;31m    - Snapshots contain same packages\033[m")
 
-            for pkg in diff_packages:
-                left = source.parse_package_ref(pkg['Left'])
-                right = target.parse_package_ref(pkg['Right'])
-
-                if not left:
-                    # Parse pkg name from target if not in source
-                    # This should not happen and is mostly caused by this bug:
-                    # https://github.com/smira/aptly/issues/287
-                    pkg_name = right[1]
-                else:
-                    pkg_name = left[1]
+            for name, _, old, new in package_changes(component_diff.packages or []):
+                print('    - %s \033[1;30m(%s -> %s)\033[m' % (name, old, new))
 
-                if left:
-                    new = left[2]
-                else:
-                    new = pkg['Left']
+        print()
 
-                if right:
-                    old = right[2]
-                else:
-                    old = pkg['Right']
 
-                print('    - %s \033[1;30m(%s -> %s)\033[m' % (pkg_name, old, new))
+def print_diff_json(source, target, component_diffs, packages=True):
+    """
+    Print JSON line per different component or single line with
+    up_to_date true when target is up to date
+    """
+    pair = {
+        'source': source.name,
+        'source_storage': source.storage,
+        'target': target.name,
+        'target_storage': target.storage,
+    }
+    if not component_diffs:
+        print(json.dumps(dict(pair, up_to_date=True), sort_keys=True))
+        return
 
-        print()
+    for component_diff in component_diffs:
+        record = dict(pair, up_to_date=False,
+                      component=component_diff.component,
+                      source_snapshot=component_diff.source_snapshot,
+                      target_snapshot=component_diff.target_snapshot,
+                      snapshots=component_diff.snapshots)
+        if packages:
+            record['error'] = str(component_diff.error) if component_diff.error else None
+            record['packages'] = [
+                {'package': name, 'arch': arch, 'old': old, 'new': new}
+                for name, arch, old, new in package_changes(component_diff.packages or [])
+            ]
+        print(json.dumps(record, sort_keys=True))
 
 
 def action_publish(client, publishmgr, config_file, recreate=False,
                    no_recreate=False, force_overwrite=False,
                    publish_contents=False, acquire_by_hash=False,
                    publish_dist=None, publish_names=None, architectures=None,
-                   only_latest=False, components=[]):
+                   only_latest=False, components=[], workers=1,
+                   storage_workers=None, plan=False, plan_file=None,
+                   cleanup=False, dry=False):
     if not architectures:
         architectures = []
-    snapshots = Publish._get_snapshots(client)
+    snapshots = Publish._get_snapshot_index(client)
 
     config = load_config(config_file)
     for name, repo in config.get('mirror', {}).items():
@@ -339,13 +557,57 @@ def action_publish(client, publishmgr, config_file, recreate=False,
             if arch not in architectures:
                 architectures.append(arch)
 
-    publishmgr.do_publish(recreate=recreate, no_recreate=no_recreate,
-                          force_overwrite=force_overwrite,
-                          acquire_by_hash=acquire_by_hash,
-                          publish_contents=publish_contents, dist=publish_dist,
-                          names=publish_names, architectures=architectures,
-                          only_latest=only_latest, config=config,
-                          components=components)
+    if (plan or dry) and not only_latest:
+        publish_plan = Plan()
+        planned = publishmgr.plan_publish(publish_plan, recreate=recreate,
+                                          no_recreate=no_recreate,
+                                          force_overwrite=force_overwrite,
+                                          acquire_by_hash=acquire_by_hash,
+                                          publish_contents=publish_contents,
+                                          dist=publish_dist,
+                                          names=publish_names,
+                                          architectures=architectures)
+        if cleanup:
+            publishmgr.plan_cleanup(publish_plan, planned)
+        execute_plan(client, publish_plan, dry=dry, plan_file=plan_file,
+                     workers=workers, storage_workers=storage_workers)
+        return
+
+    failures = publishmgr.do_publish(recreate=recreate,
+                                     no_recreate=no_recreate,
+                                     force_overwrite=force_overwrite,
+                                     acquire_by_hash=acquire_by_hash,
+                                     publish_contents=publish_contents,
+                                     dist=publish_dist, names=publish_names,
+                                     architectures=architectures,
+                                     only_latest=only_latest, config=config,
+                                     components=components, workers=workers,
+                                     storage_workers=storage_workers)
+    if failures:
+        for name, error in failures.items():
+            lg.error("Publish %s failed: %s" % (name, error))
+        sys.exit(1)
+
+
+def execute_plan(client, plan, dry=False, plan_file=None, workers=1,
+                 storage_workers=None):
+    if plan_file:
+        with open(plan_file, 'w') as f:
+            f.write(plan.to_json())
+
+    if dry:
+        print(plan.to_json(compact=True))
+        return
+
+    if not len(plan):
+        lg.info("Nothing to do")
+        return
+
+    _, failures = PlanExecutor(client, workers, storage_workers).execute(plan)
+    if failures:
+        for op_id, error in failures.items():
+            lg.error("Operation %s failed: %s" % (op_id, error))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+
+ARCHIVE_FORMAT = 'aptly-publisher-archive'
+ARCHIVE_VERSION = 1
+MANIFEST = 'manifest.json'
+REFS_DIR = 'refs/'
+IDS_DIR = 'ids/'
+DELTAS_DIR = 'deltas/'
+# Number of package refs in one member of table of refs
+REFS_CHUNK = 4096
+
+
+def is_archive(path):
+    """
+    Return True if path is dump archive (and not YAML dump)
+    """
+    return zipfile.is_zipfile(path)
+
+
+def _encode_ids(ids):
+    # Sorted ids as differences of consecutive ones, mostly small numbers
+    # which compress well
+    previous = 0
+    lines = []
+    for ref_id in ids:
+        lines.append(str(ref_id - previous))
+        previous = ref_id
+    return '\n'.join(lines).encode('utf-8')
+
+
+def _decode_ids(data):
+    ref_id = 0
+    ids = []
+    for line in (data.split('\n') if data else []):
+        ref_id += int(line)
+        ids.append(ref_id)
+    return ids
+
+
+class DumpArchive(object):
+    """
+    Compressed dump of multiple publishes
+
+    Archive is ZIP file with manifest.json describing publishes and their
+    components. Every package ref is stored only once in table of refs
+    split into chunks, package lists are separate members with ids of
+    their refs. Members are named by SHA-256 of their content. So
+    components with the same packages (eg. snapshot published in several
+    distributions) share single member, different lists (eg. merged
+    snapshots of several publishes) share their refs and single publish or
+    component can be read decoding only chunks of refs it uses.
+
+    Incremental archive is written against base archive (eg. previous dump)
+    and stores only package lists and refs that are not in base, ids of
+    refs continue after ids of base. Package list of component changed
+    only a little is stored as delta (added and removed package refs)
+    against its package list in base, unchanged one only as reference.
+    Base archive is expected in the same directory, archive can be read as
+    long as the whole chain of base archives is available.
+    """
+    def __init__(self, path, mode='r', base=None):
+        if mode not in ('r', 'w'):
+            raise ValueError("Unsupported archive mode %s" % mode)
+
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._packages = {}
+        self._base = None
+        self._base_publishes = {}
+        self._chunks = {}
+        # Refs added into archive opened for writing
+        self._ref_ids = {}
+        self._refs = []
+        self._ref_offset = 0
+
+        if mode == 'r':
+            self._zip = zipfile.ZipFile(path, 'r')
+            try:
+                manifest = json.loads(self._zip.read(MANIFEST).decode('utf-8'))
+            except KeyError:
+                raise ValueError("%s is not publish dump archive" % path)
+            if manifest.get('format') != ARCHIVE_FORMAT:
+                raise ValueError("%s is not publish dump archive" % path)
+            if manifest.get('version', 0) > ARCHIVE_VERSION:
+                raise ValueError("Unsupported version %s of dump archive %s"
+                                 % (manifest.get('version'), path))
+            manifest.setdefault('deltas', {})
+            self.manifest = manifest
+            self._members = set(self._zip.namelist())
+        else:
+            # Write into temporary file, so interrupted dump doesn't leave
+            # incomplete archive behind
+            self._zip = zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED,
+                                        allowZip64=True)
+            self.manifest = {
+                'format': ARCHIVE_FORMAT,
+                'version': ARCHIVE_VERSION,
+                'name': time.strftime("%Y%m%d%H%M%S"),
+                'publishes': [],
+                'deltas': {},
+            }
+            self._members = set()
+            if base:
+                self._base = DumpArchive(base)
+                self.manifest['base'] = {
+                    'path': os.path.basename(base),
+                    'name': self._base.name,
+                }
+                for publish in self._base.publishes():
+                    for component in publish['components']:
+                        self._base_publishes[(publish['storage'], publish['publish'], component['component'])] = component
+                # Refs of base are reused by their ids
+                base_refs = self._base.ref_table()
+                self._ref_ids = dict((ref, ref_id) for ref_id, ref in enumerate(base_refs))
+                self._ref_offset = len(base_refs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.mode == 'w':
+            self.abort()
+        else:
+            self.close()
+
+    def abort(self):
+        """
+        Close archive opened for writing without creating it
+        """
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+            os.remove(self.path + '.tmp')
+        self._close_base()
+
+    def _close_base(self):
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+
+    def close(self):
+        if self._zip is None:
+            return
+
+        if self.mode == 'w':
+            chunks = []
+            for start in range(0, len(self._refs), REFS_CHUNK):
+                data = '\n'.join(self._refs[start:start + REFS_CHUNK]).encode('utf-8')
+                digest = hashlib.sha256(data).hexdigest()
+                if REFS_DIR + digest not in self._members:
+                    self._zip.writestr(REFS_DIR + digest, data)
+                    self._members.add(REFS_DIR + digest)
+                chunks.append(digest)
+            self.manifest['refs'] = {
+                'offset': self._ref_offset,
+                'count': len(self._refs),
+                'chunk': REFS_CHUNK,
+                'chunks': chunks,
+            }
+            self.manifest['publishes'].sort(key=lambda x: (x['storage'], x['publish']))
+            self._zip.writestr(MANIFEST, json.dumps(self.manifest, indent=2, sort_keys=True))
+            self._zip.close()
+            os.rename(self.path + '.tmp', self.path)
+        else:
+            self._zip.close()
+        self._zip = None
+        self._close_base()
+
+    @property
+    def name(self):
+        return self.manifest['name']
+
+    @property
+    def base(self):
+        """
+        Base archive of incremental archive or None
+        """
+        if self._base is None and self.manifest.get('base'):
+            path = os.path.join(os.path.dirname(self.path), self.manifest['base']['path'])
+            self._base = DumpArchive(path)
+            if self._base.name != self.manifest['base']['name']:
+                raise ValueError("Base archive %s of %s was replaced by another dump"
+                                 % (path, self.path))
+        return self._base
+
+    def _chunk(self, index):
+        """
+        Return list of package refs of given chunk of table of refs
+        """
+        with self._lock:
+            chunk = self._chunks.get(index)
+        if chunk is None:
+            data = self._read(REFS_DIR + self.manifest['refs']['chunks'][index])
+            chunk = data.split('\n') if data else []
+            with self._lock:
+                self._chunks[index] = chunk
+        return chunk
+
+    def _check_base_refs(self):
+        offset = self.manifest['refs']['offset']
+        if offset:
+            base_refs = self.base.manifest['refs']
+            if base_refs['offset'] + base_refs['count'] != offset:
+                raise ValueError("Refs of base archive of %s don't match" % self.path)
+
+    def ref_table(self):
+        """
+        Return list of all package refs indexed by their ids, including refs
+        of base archives
+        """
+        self._check_base_refs()
+        table = list(self.base.ref_table()) if self.manifest['refs']['offset'] else []
+        for index in range(len(self.manifest['refs']['chunks'])):
+            table.extend(self._chunk(index))
+        return table
+
+    def lookup_refs(self, ids):
+        """
+        Return package refs of given sorted ids, only chunks of table of
+        refs (of this archive or its base archives) containing them are read
+        """
+        self._check_base_refs()
+        offset = self.manifest['refs']['offset']
+        size = self.manifest['refs']['chunk']
+        own = 0
+        while own < len(ids) and ids[own] < offset:
+            own += 1
+        refs = self.base.lookup_refs(ids[:own]) if own else []
+        for ref_id in ids[own:]:
+            index, position = divmod(ref_id - offset, size)
+            refs.append(self._chunk(index)[position])
+        return refs
+
+    def unchanged(self, publish, storage, component, published, created_at):
+        """
+        Check if component of publish has the same published snapshot (by
+        name and creation time) as in base archive, so its packages didn't
+        change (snapshots are immutable)
+        """
+        base = self._base_publishes.get((storage, publish, component))
+        return bool(base and published and created_at and base.get('published') == published and
+                    base.get('created_at') == created_at)
+
+    def has_packages(self, digest):
+        """
+        Check if package list is stored in archive or its base archives
+        """
+        if IDS_DIR + digest in self._members or digest in self.manifest['deltas']:
+            return True
+        return self.base is not None and self.base.has_packages(digest)
+
+    def _read(self, name):
+        with self._lock:
+            return self._zip.read(name).decode('utf-8')
+
+    def add_packages(self, refs, base_digest=None):
+        """
+        Store list of package refs unless it's already stored, return its
+        digest
+
+        Refs not yet in archive (or its base) are added into table of refs,
+        list is stored as ids of its refs. When base_digest is given,
+        package list is stored as delta against package list of that digest
+        if it's smaller.
+        """
+        refs = sorted(refs)
+        digest = hashlib.sha256('\n'.join(refs).encode('utf-8')).hexdigest()
+        with self._lock:
+            if digest in self._packages:
+                return digest
+            self._packages[digest] = len(refs)
+
+        if self.base is not None and self.base.has_packages(digest):
+            return digest
+
+        if base_digest:
+            base_refs = set(self.base.read_packages(base_digest))
+            current = set(refs)
+            delta = (['+%s' % ref for ref in sorted(current - base_refs)] +
+                     ['-%s' % ref for ref in sorted(base_refs - current)])
+            if len(delta) < len(refs) // 2:
+                delta_data = '\n'.join(delta).encode('utf-8')
+                delta_digest = hashlib.sha256(delta_data).hexdigest()
+                with self._lock:
+                    self._zip.writestr(DELTAS_DIR + delta_digest, delta_data)
+                    self._members.add(DELTAS_DIR + delta_digest)
+                    self.manifest['deltas'][digest] = {
+                        'base': base_digest,
+                        'delta': delta_digest,
+                    }
+                return digest
+
+        with self._lock:
+            ids = []
+            for ref in refs:
+                ref_id = self._ref_ids.get(ref)
+                if ref_id is None:
+                    ref_id = self._ref_ids[ref] = self._ref_offset + len(self._refs)
+                    self._refs.append(ref)
+                ids.append(ref_id)
+            ids.sort()
+            self._zip.writestr(IDS_DIR + digest, _encode_ids(ids))
+            self._members.add(IDS_DIR + digest)
+        return digest
+
+    def add_publish(self, publish, storage, components):
+        """
+        Add publish, components is iterable of dicts with keys component,
+        snapshot, description, published (name of published snapshot),
+        created_at (its creation time) and packages (PackageRefTable or
+        callable returning it)
+
+        Packages of snapshot that is the same as in base archive are not
+        loaded at all.
+        """
+        saved_components = []
+        for component in components:
+            saved = {
+                'component': component['component'],
+                'snapshot': component['snapshot'],
+                'description': component['description'],
+                'published': component.get('published'),
+                'created_at': component.get('created_at'),
+            }
+
+            base = self._base_publishes.get((storage, publish, component['component']))
+            if self.unchanged(publish, storage, component['component'],
+                              saved['published'], saved['created_at']):
+                saved['packages'] = base['packages']
+                saved['count'] = base['count']
+            else:
+                packages = component['packages']
+                if callable(packages):
+                    packages = packages()
+                saved['packages'] = self.add_packages(packages.refs(),
+                                                      base['packages'] if base else None)
+                saved['count'] = len(packages)
+
+            saved_components.append(saved)
+
+        with self._lock:
+            self.manifest['publishes'].append({
+                'publish': publish,
+                'storage': storage,
+                'components': saved_components,
+            })
+
+    def publishes(self):
+        return self.manifest['publishes']
+
+    def read_packages(self, digest):
+        """
+        Return list of package refs of given digest, reconstructed from
+        deltas and base archives when needed
+        """
+        if IDS_DIR + digest in self._members:
+            return sorted(self.lookup_refs(_decode_ids(self._read(IDS_DIR + digest))))
+
+        delta = self.manifest['deltas'].get(digest)
+        if delta is None:
+            if self.base is None:
+                raise KeyError("Package list %s not found in dump archive %s" % (digest, self.path))
+            return self.base.read_packages(digest)
+
+        refs = set(self.read_packages(delta['base']))
+        data = self._read(DELTAS_DIR + delta['delta'])
+        for line in (data.split('\n') if data else []):
+            if line[0] == '+':
+                refs.add(line[1:])
+            else:
+                refs.discard(line[1:])
+        return sorted(refs)
+
+    def load_publish(self, publish, components=None):
+        """
+        Return publish from manifest in the same form as loaded YAML dump,
+        with package refs of components in key refs. Only packages of
+        given components are read.
+        """
+        config = {
+            'publish': publish['publish'],
+            'name': self.name,
+            'storage': publish['storage'],
+            'components': [],
+        }
+        for component in publish['components']:
+            saved = dict(component)
+            if not components or component['component'] in components:
+                saved['refs'] = self.read_packages(component['packages'])
+            else:
+                saved['refs'] = []
+            config['components'].append(saved)
+        return config
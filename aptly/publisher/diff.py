@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import functools
+from aptly.publisher import Publish
+from aptly.publisher.workers import WorkerPool
+from aptly.publisher.packages import PackageRefTable, parse_ref
+
+lg = logging.getLogger(__name__)
+
+
+def diff_tables(left, right):
+    """
+    Return differences of two PackageRefTables in format of
+    /snapshots/{left}/diff/{right}: list of dicts {'Left': ref, 'Right': ref}
+    where versions of the same package (architecture and name) are paired
+    and missing side is None
+    """
+    left_keys = left.keys()
+    right_keys = right.keys()
+
+    by_package = {}
+    for side, refs in ((0, left_keys.difference(right_keys)), (1, right_keys.difference(left_keys))):
+        for ref in refs:
+            arch, name = ref.split(' ', 2)[:2]
+            by_package.setdefault((arch, name), ([], []))[side].append(ref)
+
+    diff = []
+    for key in sorted(by_package):
+        left_refs, right_refs = [sorted(refs) for refs in by_package[key]]
+        for i in range(max(len(left_refs), len(right_refs))):
+            diff.append({
+                'Left': left_refs[i] if i < len(left_refs) else None,
+                'Right': right_refs[i] if i < len(right_refs) else None,
+            })
+    return diff
+
+
+def package_changes(diff):
+    """
+    Return list of tuples (package, arch, old version, new version) of
+    snapshot diff, version is None when package is missing on that side
+    """
+    changes = []
+    for pkg in diff:
+        left = parse_ref(pkg['Left'])
+        right = parse_ref(pkg['Right'])
+
+        # Package name is taken from target if not in source, it's mostly
+        # caused by this bug: https://github.com/smira/aptly/issues/287
+        arch, name = (left or right or (None, None))[:2]
+        new = left[2] if left else pkg['Left']
+        old = right[2] if right else pkg['Right']
+        changes.append((name, arch, old, new))
+    return changes
+
+
+class ComponentDiff(object):
+    """
+    Differences of single component of source and target publish
+    """
+    def __init__(self, component, snapshots, source_snapshot, target_snapshot):
+        self.component = component
+        self.snapshots = snapshots
+        self.source_snapshot = source_snapshot
+        self.target_snapshot = target_snapshot
+        # Result of snapshot diff, None when packages weren't compared
+        self.packages = None
+        self.local = False
+        self.error = None
+
+
+class DiffEngine(object):
+    """
+    Compare pairs of source and target publishes
+
+    Components of all pairs are compared concurrently by given number of
+    workers. When package lists of both published snapshots are already
+    cached by client, they are compared locally, otherwise by server (or
+    locally after fetching them with local=True).
+    """
+    def __init__(self, client, workers=1, local=False):
+        self.client = client
+        self.pool = WorkerPool(workers)
+        self.local = local
+
+    def diff(self, pairs, components=None, packages=True):
+        """
+        Compare list of (source, target) Publish tuples
+
+        Return list of tuples (source, target, [ComponentDiff]), list is
+        empty for target up to date with source
+        """
+        results = []
+        jobs = []
+        for source, target in pairs:
+            diff, _ = source.compare(target, components=components)
+            source_snapshots = dict((x['Component'], x['Name']) for x in source.publish_snapshots)
+            target_snapshots = dict((x['Component'], x['Name']) for x in target.publish_snapshots)
+
+            component_diffs = []
+            for component, snapshots in sorted(diff.items()):
+                if not snapshots or (components and component not in components):
+                    continue
+                component_diff = ComponentDiff(component, snapshots,
+                                               source_snapshots.get(component),
+                                               target_snapshots.get(component))
+                component_diffs.append(component_diff)
+                if packages and component_diff.source_snapshot:
+                    jobs.append(((len(results), component), '',
+                                 functools.partial(self._diff_component, component_diff)))
+            results.append((source, target, component_diffs))
+
+        if self.local:
+            # Fetch all package lists at once
+            Publish._prefetch_packages(self.client, "snapshots", [
+                name for _, _, component_diffs in results for component_diff in component_diffs
+                for name in (component_diff.source_snapshot, component_diff.target_snapshot) if name
+            ])
+
+        done, failures = self.pool.run(jobs)
+        for i, (_, _, component_diffs) in enumerate(results):
+            for component_diff in component_diffs:
+                key = (i, component_diff.component)
+                component_diff.error = failures.get(key)
+                if key in done:
+                    component_diff.packages, component_diff.local = done[key]
+        return results
+
+    def _diff_component(self, component_diff):
+        """
+        Return tuple (diff, computed locally)
+        """
+        source, target = (component_diff.source_snapshot, component_diff.target_snapshot)
+        if not target:
+            # Component is missing in target, all packages are new
+            return (diff_tables(Publish._get_package_table(self.client, "snapshots", source),
+                                PackageRefTable()), True)
+
+        if self.local or all(Publish._get_package_table.is_cached(self.client, "snapshots", name)
+                             for name in (source, target)):
+            return (diff_tables(Publish._get_package_table(self.client, "snapshots", source),
+                                Publish._get_package_table(self.client, "snapshots", target)), True)
+
+        return (self.client.do_get('/snapshots/%s/diff/%s' % (source, target)), False)
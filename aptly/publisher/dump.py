@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+
+def _dump(data, stream, indent=''):
+    text = yaml.dump(data, Dumper=SafeDumper, default_flow_style=False)
+    if indent:
+        text = ''.join(indent + line for line in text.splitlines(True))
+    stream.write(text)
+
+
+def write_publish(stream, publish, name, storage, components, chunk_size=1000):
+    """
+    Write YAML dump of publish incrementally, so only chunk of packages is
+    serialized at once. Output is readable by Publish.restore_publish.
+
+    components is iterable of dicts with keys component, snapshot,
+    description and packages (PackageRefTable)
+    """
+    _dump({'publish': publish, 'name': name, 'storage': storage}, stream)
+
+    empty = True
+    for component in components:
+        if empty:
+            stream.write('components:\n')
+            empty = False
+
+        packages = component['packages']
+        _dump([{
+            'component': component['component'],
+            'snapshot': component['snapshot'],
+            'description': component['description'],
+        }], stream)
+
+        if not len(packages):
+            stream.write('  packages: []\n')
+            continue
+
+        stream.write('  packages:\n')
+        for start in range(0, len(packages), chunk_size):
+            _dump([
+                {'package': name, 'version': version, 'arch': arch, 'ref': ref}
+                for (arch, name, version, ref) in packages.rows(start, start + chunk_size)
+            ], stream, indent='  ')
+
+    if empty:
+        stream.write('components: []\n')
+
+
+def read_publish(stream):
+    """
+    Load YAML dump of publish (using C loader when available)
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def package_refs(packages):
+    """
+    Return list of package refs of saved packages
+    """
+    return ['%s %s %s %s' % (package.get('arch'), package.get('package'),
+                             package.get('version'), package.get('ref'))
+            for package in packages]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import re
+from collections import deque
+
+RE_EDGE = re.compile('"([^"]+)"->"([^"]+)";')
+RE_NODE = re.compile('[ \t]+"([^"]+)".*label="{(Repo|Snapshot|Published) ([^|]+)[^\\}"]+}"')
+
+
+class SnapshotGraph(object):
+    """
+    Dependency graph of repos, snapshots and publishes
+
+    Edges lead from source to object created from it (repo -> snapshot,
+    snapshot -> merged snapshot, snapshot -> publish).
+    """
+    def __init__(self):
+        # node_id -> (node_type, node_name)
+        self.nodes = {}
+        # (node_type, node_name) -> node_id
+        self.ids = {}
+        self.parents = {}
+        self.children = {}
+
+    @classmethod
+    def from_dot(cls, dot_data):
+        """
+        Build graph from /graph.dot output
+        """
+        graph = cls()
+        for node_id, node_type, node_name in RE_NODE.findall(dot_data):
+            graph.add_node(node_id, node_type, node_name)
+        for edge_from, edge_to in RE_EDGE.findall(dot_data):
+            graph.add_edge(edge_from, edge_to)
+        return graph
+
+    def add_node(self, node_id, node_type, node_name):
+        self.nodes[node_id] = (node_type, node_name)
+        self.ids[(node_type, node_name)] = node_id
+        self.parents.setdefault(node_id, set())
+        self.children.setdefault(node_id, set())
+
+    def add_edge(self, edge_from, edge_to):
+        self.children.setdefault(edge_from, set()).add(edge_to)
+        self.parents.setdefault(edge_to, set()).add(edge_from)
+
+    def find(self, node_type, node_name):
+        return self.ids.get((node_type, node_name))
+
+    def nodes_of_type(self, node_type):
+        return [node_id for node_id, node in self.nodes.items() if node[0] == node_type]
+
+    def reachable(self, roots):
+        """
+        Return set of roots and all nodes they were created from
+        """
+        seen = set(roots)
+        queue = deque(seen)
+        while queue:
+            for parent in self.parents.get(queue.popleft(), ()):
+                if parent not in seen:
+                    seen.add(parent)
+                    queue.append(parent)
+        return seen
+
+    def deletion_levels(self, node_ids):
+        """
+        Order nodes for deletion so nodes are deleted before nodes they
+        were created from
+
+        Return list of levels (lists of node ids), nodes in the same level
+        don't depend on each other. Nodes on a cycle are left out.
+        """
+        node_ids = set(node_ids)
+        pending = dict(
+            (node_id, len(self.children.get(node_id, set()) & node_ids))
+            for node_id in node_ids
+        )
+
+        levels = []
+        level = sorted(node_id for node_id, count in pending.items() if count == 0)
+        while level:
+            levels.append(level)
+            next_level = []
+            for node_id in level:
+                del pending[node_id]
+                for parent in self.parents.get(node_id, ()):
+                    if parent in pending:
+                        pending[parent] -= 1
+                        if pending[parent] == 0:
+                            next_level.append(parent)
+            level = sorted(next_level)
+        return levels
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+def publish_key(storage, prefix, distribution):
+    """
+    Return key identifying publish, prefix is normalized the way publisher
+    names it (slashes replaced by underscores, '.' for root)
+    """
+    return (storage or '', (prefix or '.').replace('/', '_'), distribution)
+
+
+def publish_name(publish):
+    """
+    Return name of publish from remote publish list, eg. s3:bucket:prefix/xenial
+    """
+    return "{}{}{}".format(publish['Storage'] + ":" if publish['Storage'] else "",
+                           publish['Prefix'] + "/" if publish['Prefix'] else "",
+                           publish['Distribution'])
+
+
+class PublishIndex(object):
+    """
+    Index of remote publishes built once per fetch of publish list
+    """
+    def __init__(self, publishes):
+        self.publishes = publishes
+        self.by_key = {}
+        for publish in publishes:
+            self.by_key[publish_key(publish['Storage'], publish['Prefix'], publish['Distribution'])] = publish
+
+    def __len__(self):
+        return len(self.publishes)
+
+    def get(self, key):
+        """
+        Return remote publish by key (see publish_key) or None
+        """
+        return self.by_key.get(key)
+
+
+class PublishInventory(object):
+    """
+    Loaded publishes indexed by their key and by snapshots they use
+
+    Publishes are kept in order of remote publish list. For every snapshot
+    there are keys of publishes publishing it and keys of publishes whose
+    published snapshot was created from it (component lineage).
+    """
+    def __init__(self):
+        # key -> Publish
+        self.publishes = OrderedDict()
+        # key -> name in remote publish list
+        self.names = {}
+        # snapshot name -> [key]
+        self.published = {}
+        self.sources = {}
+
+    def add(self, publish, name=None):
+        """
+        Add loaded Publish, publish with the same key is added only once
+        """
+        key = publish.key
+        if key in self.publishes:
+            return self.publishes[key]
+
+        self.publishes[key] = publish
+        self.names[key] = name or publish.name
+        for snapshot in publish.publish_snapshots:
+            self.published.setdefault(snapshot['Name'], []).append(key)
+        for snapshots in publish.components.values():
+            for snapshot in snapshots:
+                self.sources.setdefault(snapshot, []).append(key)
+        return publish
+
+    def __len__(self):
+        return len(self.publishes)
+
+    def __iter__(self):
+        return iter(self.publishes.values())
+
+    def __contains__(self, publish):
+        return getattr(publish, 'key', publish) in self.publishes
+
+    def items(self):
+        """
+        Return list of tuples (name, Publish)
+        """
+        return [(self.names[key], publish) for key, publish in self.publishes.items()]
+
+    def get(self, key):
+        return self.publishes.get(key)
+
+    def snapshots(self):
+        """
+        Return names of all published snapshots, each only once
+        """
+        return list(self.published.keys())
+
+    def published_by(self, snapshot):
+        """
+        Return publishes publishing given snapshot
+        """
+        return [self.publishes[key] for key in self.published.get(snapshot, [])]
+
+    def used_by(self, snapshot):
+        """
+        Return publishes whose published snapshots were created from given
+        snapshot
+        """
+        return [self.publishes[key] for key in self.sources.get(snapshot, [])]
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import fnmatch
+import operator
+import functools
+from array import array
+
+COLUMNS = ('arch', 'name', 'version', 'hash')
+
+_apt_pkg = None
+
+
+def load_apt_pkg():
+    """
+    Import and initialize apt_pkg (python-apt) used to compare versions,
+    raise ImportError when it's not available
+    """
+    global _apt_pkg
+    if _apt_pkg is None:
+        try:
+            import apt_pkg
+        except ImportError as e:
+            raise ImportError("Version constraints require python-apt (apt_pkg): %s" % e)
+        apt_pkg.init_system()
+        _apt_pkg = apt_pkg
+    return _apt_pkg
+
+
+def version_compare(a, b):
+    """
+    Compare Debian versions using apt_pkg
+    """
+    return load_apt_pkg().version_compare(a, b)
+
+
+# Debian relations, < and > are deprecated forms of <= and >=
+RELATIONS = {
+    '<<': lambda result: result < 0,
+    '<=': lambda result: result <= 0,
+    '<': lambda result: result <= 0,
+    '=': lambda result: result == 0,
+    '>=': lambda result: result >= 0,
+    '>': lambda result: result >= 0,
+    '>>': lambda result: result > 0,
+}
+
+RE_CONSTRAINT = re.compile(r'^\s*(\S+)\s*\(\s*(<<|<=|>=|>>|<|>|=)\s*([^\s)]+)\s*\)\s*$')
+
+
+def parse_ref(ref):
+    """
+    Return tuple of architecture, package_name, version, id of package ref
+    "<arch> <name> <version> <files hash>" or None
+    """
+    if not ref:
+        return None
+    parsed = ref.rsplit(' ', 3)
+    if len(parsed) != 4:
+        return None
+    return tuple(parsed)
+
+
+class PackageSelector(object):
+    """
+    Selector of packages by name and optionally version constraint
+
+    Name is exact package name, glob (eg. python-*) or regular expression
+    enclosed in slashes (eg. /^lib.*-dev$/), followed by optional Debian
+    version constraint, eg. "foo (>= 1.2)".
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.relation = None
+        self.version = None
+
+        match = RE_CONSTRAINT.match(spec)
+        if match:
+            name, self.relation, self.version = match.groups()
+        else:
+            name = spec.strip()
+
+        self.name = None
+        self.pattern = None
+        if len(name) > 1 and name.startswith('/') and name.endswith('/'):
+            self.pattern = re.compile(name[1:-1])
+        elif set('*?[').intersection(name):
+            self.pattern = re.compile(fnmatch.translate(name))
+        else:
+            self.name = name
+
+    def __repr__(self):
+        return self.spec
+
+    def match_name(self, name):
+        if self.pattern is not None:
+            return self.pattern.search(name) is not None
+        return name == self.name
+
+    def match_version(self, version, compare=version_compare):
+        if self.relation is None:
+            return True
+        return RELATIONS[self.relation](compare(version, self.version))
+
+
+class PackageSelection(object):
+    """
+    Packages selected by list of PackageSelector specs, package is selected
+    when any of them matches
+
+    Raise ImportError when some spec has version constraint and apt_pkg
+    used to compare versions isn't available.
+    """
+    def __init__(self, specs):
+        self.selectors = [spec if isinstance(spec, PackageSelector) else PackageSelector(spec)
+                          for spec in specs]
+        # Exact names are looked up in name index of table, patterns are
+        # matched only against distinct names
+        self.by_name = {}
+        self.patterns = []
+        for selector in self.selectors:
+            if selector.name is not None:
+                self.by_name.setdefault(selector.name, []).append(selector)
+            else:
+                self.patterns.append(selector)
+        if self.has_relations:
+            load_apt_pkg()
+
+    @property
+    def has_relations(self):
+        return any(selector.relation is not None for selector in self.selectors)
+
+    def __repr__(self):
+        return repr(self.selectors)
+
+    def select(self, table, compare=version_compare):
+        """
+        Return sorted list of indexes of selected rows of PackageRefTable
+        """
+        index = table.name_index()
+        names = table.names
+        selectors = {}
+        for name, name_selectors in self.by_name.items():
+            name_id = names.index.get(name)
+            if name_id is not None and name_id in index:
+                selectors[name_id] = list(name_selectors)
+        if self.patterns:
+            for name_id in index:
+                name = names.values[name_id]
+                for selector in self.patterns:
+                    if selector.match_name(name):
+                        selectors.setdefault(name_id, []).append(selector)
+
+        versions = table.versions.values
+        selected = []
+        for name_id, name_selectors in selectors.items():
+            if all(selector.relation is None for selector in name_selectors):
+                selected.extend(index[name_id])
+                continue
+            for i in index[name_id]:
+                version = versions[table.version[i]]
+                if any(selector.match_version(version, compare) for selector in name_selectors):
+                    selected.append(i)
+        selected.sort()
+        return selected
+
+
+class StringPool(object):
+    """
+    Interned strings referenced by index
+    """
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __sizeof__(self):
+        return (sys.getsizeof(self.values) + sys.getsizeof(self.index) +
+                sum(sys.getsizeof(value) for value in self.values))
+
+    def add(self, value):
+        try:
+            return self.index[value]
+        except KeyError:
+            self.index[value] = len(self.values)
+            self.values.append(value)
+            return self.index[value]
+
+    def add_many(self, values):
+        """
+        Add values and return array of their indexes
+        """
+        index = self.index
+        for value in dict.fromkeys(values):
+            if value not in index:
+                index[value] = len(self.values)
+                self.values.append(value)
+        return array('I', map(index.__getitem__, values))
+
+
+class HashColumn(object):
+    """
+    Column of files hashes
+
+    Hashes are hexadecimal uint64 as printed by aptly, so they are stored as
+    integers while they round-trip, otherwise as strings.
+    """
+    def __init__(self, hashes=None):
+        self.values = array('Q')
+        self.strings = None
+        if hashes:
+            self.extend(hashes)
+
+    def __len__(self):
+        return len(self.strings if self.strings is not None else self.values)
+
+    def __sizeof__(self):
+        if self.strings is not None:
+            return sys.getsizeof(self.strings) + sum(sys.getsizeof(h) for h in self.strings)
+        return self.values.buffer_info()[1] * self.values.itemsize
+
+    def __getitem__(self, i):
+        if self.strings is not None:
+            return self.strings[i]
+        return '%x' % self.values[i]
+
+    def _to_strings(self):
+        self.strings = ['%x' % value for value in self.values]
+        self.values = array('Q')
+
+    def extend(self, hashes):
+        if self.strings is None:
+            try:
+                values = array('Q', map(functools.partial(int, base=16), hashes))
+            except (ValueError, OverflowError, TypeError):
+                values = None
+            if values is not None and all(map(operator.eq, map('{:x}'.format, values), hashes)):
+                self.values.extend(values)
+                return
+            self._to_strings()
+        self.strings.extend(hashes)
+
+    def keys(self):
+        """
+        Return list of hashes comparable within the same representation
+        (integers or strings)
+        """
+        return self.strings if self.strings is not None else self.values
+
+    def take(self, indexes):
+        column = HashColumn()
+        if self.strings is not None:
+            column.strings = [self.strings[i] for i in indexes]
+        else:
+            column.values = array('Q', [self.values[i] for i in indexes])
+        return column
+
+    def tolist(self, start=None, stop=None):
+        if self.strings is not None:
+            return self.strings[start:stop]
+        return ['%x' % value for value in self.values[start:stop]]
+
+
+class PackageRefTable(object):
+    """
+    Columnar table of package refs ("<arch> <name> <version> <files hash>")
+
+    Architectures, names and versions are interned in pools shared by
+    tables derived from the same table, rows are stored as arrays of
+    indexes into them.
+    """
+    def __init__(self, archs=None, names=None, versions=None):
+        self.archs = archs if archs is not None else StringPool()
+        self.names = names if names is not None else StringPool()
+        self.versions = versions if versions is not None else StringPool()
+
+        self.arch = array('I')
+        self.name = array('I')
+        self.version = array('I')
+        self.hash = HashColumn()
+        self._reset()
+
+    def _reset(self):
+        # Derived data, rebuilt when rows are added
+        self._name_index = None
+        self._refs = None
+        self._keys = None
+        self._ids = None
+        self._id_set = None
+
+    @classmethod
+    def from_refs(cls, refs):
+        """
+        Parse list of package refs (eg. /snapshots/{name}/packages response)
+        """
+        table = cls()
+        table.extend_refs(refs)
+        return table
+
+    def _derive(self):
+        return PackageRefTable(self.archs, self.names, self.versions)
+
+    def extend_refs(self, refs):
+        self._reset()
+        refs = list(refs)
+        # Split all refs at once, fall back to parsing one by one when some
+        # ref doesn't have exactly four fields
+        if refs and set(map(operator.methodcaller('count', ' '), refs)) == set([3]):
+            fields = ' '.join(refs).split(' ')
+            archs, names, versions, hashes = (fields[0::4], fields[1::4], fields[2::4], fields[3::4])
+        else:
+            parsed = [parse_ref(ref) for ref in refs]
+            if None in parsed:
+                raise ValueError("Invalid package ref %s" % refs[parsed.index(None)])
+            archs, names, versions, hashes = [list(column) for column in zip(*parsed)] or ([], [], [], [])
+
+        self.arch.extend(self.archs.add_many(archs))
+        self.name.extend(self.names.add_many(names))
+        self.version.extend(self.versions.add_many(versions))
+        self.hash.extend(hashes)
+
+    def extend(self, other):
+        """
+        Append rows of other table
+        """
+        self._reset()
+        if other.names is self.names and other.archs is self.archs and other.versions is self.versions:
+            self.arch.extend(other.arch)
+            self.name.extend(other.name)
+            self.version.extend(other.version)
+            self.hash.extend(other.hash.tolist())
+        else:
+            self.extend_refs(other.refs())
+
+    def __len__(self):
+        return len(self.name)
+
+    def __iter__(self):
+        return iter(self.refs())
+
+    def __contains__(self, ref):
+        return ref in self.keys()
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self)
+        for column in (self.arch, self.name, self.version):
+            size += column.buffer_info()[1] * column.itemsize
+        return (size + sys.getsizeof(self.hash) + sys.getsizeof(self.archs) +
+                sys.getsizeof(self.names) + sys.getsizeof(self.versions))
+
+    def row(self, i):
+        """
+        Return tuple of architecture, package_name, version, id of row
+        """
+        return (self.archs.values[self.arch[i]], self.names.values[self.name[i]],
+                self.versions.values[self.version[i]], self.hash[i])
+
+    def ref(self, i):
+        return ' '.join(self.row(i))
+
+    def column(self, name, start=None, stop=None):
+        """
+        Return list of values of given column (optionally only of rows from
+        start to stop)
+        """
+        if name == 'hash':
+            return self.hash.tolist(start, stop)
+        values = getattr(self, name + 's').values
+        return [values[i] for i in getattr(self, name)[start:stop]]
+
+    def rows(self, start=None, stop=None):
+        return list(zip(*[self.column(name, start, stop) for name in COLUMNS]))
+
+    def refs(self):
+        if self._refs is None:
+            self._refs = [' '.join(row) for row in self.rows()]
+        return list(self._refs)
+
+    def keys(self):
+        """
+        Return frozenset of package refs, built once until table is extended
+        """
+        if self._keys is None:
+            self._keys = frozenset(self.refs())
+        return self._keys
+
+    def id_rows(self, strings=False):
+        """
+        Return list of rows as tuples of pool ids of architecture, name and
+        version and files hash (as string when strings is true, otherwise
+        as stored), built once until table is extended
+        """
+        if strings and self.hash.strings is None:
+            return list(zip(self.arch, self.name, self.version, self.hash.tolist()))
+        if self._ids is None:
+            self._ids = list(zip(self.arch, self.name, self.version, self.hash.keys()))
+        return self._ids
+
+    def _id_keys(self, other):
+        """
+        Return tuple of id rows of this table and set of id rows of other
+        table comparable with them
+        """
+        strings = (self.hash.strings is None) != (other.hash.strings is None)
+        ids = self.id_rows(strings)
+        if other.archs is self.archs and other.names is self.names and other.versions is self.versions:
+            if strings:
+                return (ids, set(other.id_rows(strings)))
+            if other._id_set is None:
+                other._id_set = frozenset(other.id_rows())
+            return (ids, other._id_set)
+
+        # Translate ids of other pools, values missing in pools of this
+        # table get -1 so their rows never match
+        archs, names, versions = [
+            [pool.index.get(value, -1) for value in other_pool.values]
+            for pool, other_pool in ((self.archs, other.archs), (self.names, other.names),
+                                     (self.versions, other.versions))]
+        hashes = other.hash.tolist() if strings else other.hash.keys()
+        return (ids, set(zip(map(archs.__getitem__, other.arch), map(names.__getitem__, other.name),
+                             map(versions.__getitem__, other.version), hashes)))
+
+    def take(self, indexes):
+        """
+        Return table with given rows
+        """
+        table = self._derive()
+        table.arch = array('I', [self.arch[i] for i in indexes])
+        table.name = array('I', [self.name[i] for i in indexes])
+        table.version = array('I', [self.version[i] for i in indexes])
+        table.hash = self.hash.take(indexes)
+        return table
+
+    def filter(self, predicate):
+        """
+        Return table of rows for which predicate(row) is true
+        """
+        return self.take([i for i, row in enumerate(self.rows()) if predicate(row)])
+
+    def name_index(self):
+        """
+        Return dict {name id: [row indexes]} of package names in table, built
+        once (tables of snapshots are cached, so once per snapshot)
+        """
+        if self._name_index is None:
+            index = {}
+            for i, name in enumerate(self.name):
+                try:
+                    index[name].append(i)
+                except KeyError:
+                    index[name] = [i]
+            self._name_index = index
+        return self._name_index
+
+    def filter_names(self, names, invert=False):
+        """
+        Return table of rows with package name in names
+        """
+        index = self.name_index()
+        ids = set(self.names.index[name] for name in names if name in self.names.index)
+        if invert:
+            return self.take([i for i, name in enumerate(self.name) if name not in ids])
+        return self.take(sorted(i for name in ids if name in index for i in index[name]))
+
+    def filter_packages(self, selection, compare=version_compare):
+        """
+        Return table of rows selected by PackageSelection (or list of its
+        specs)
+        """
+        if not isinstance(selection, PackageSelection):
+            selection = PackageSelection(selection)
+        return self.take(selection.select(self, compare))
+
+    def group_by(self, *columns):
+        """
+        Return dict of {value: [row indexes]} for single column or
+        {(value, ...): [row indexes]} for multiple columns
+        """
+        columns = columns or ('name',)
+        if len(columns) == 1:
+            keys = self.column(columns[0])
+        else:
+            keys = list(zip(*[self.column(name) for name in columns]))
+
+        groups = {}
+        for i, key in enumerate(keys):
+            try:
+                groups[key].append(i)
+            except KeyError:
+                groups[key] = [i]
+        return groups
+
+    def select_latest(self, compare=version_compare):
+        """
+        Select newest version of every package (name, architecture) in
+        single pass
+
+        Return tuple (keep, drop) of sets of row indexes
+        """
+        versions = self.versions.values
+        version = self.version
+        latest = {}
+        for i, key in enumerate(zip(self.name, self.arch)):
+            j = latest.get(key)
+            if j is None or (version[i] != version[j] and
+                             compare(versions[version[i]], versions[version[j]]) > 0):
+                latest[key] = i
+
+        keep = set(latest.values())
+        drop = set(range(len(self))).difference(keep)
+        return (keep, drop)
+
+    def union(self, other):
+        other_ids, keys = other._id_keys(self)
+        table = self.take(range(len(self)))
+        table.extend(other.take([i for i, row in enumerate(other_ids) if row not in keys]))
+        return table
+
+    def intersection(self, other):
+        ids, keys = self._id_keys(other)
+        return self.take([i for i, row in enumerate(ids) if row in keys])
+
+    def difference(self, other):
+        ids, keys = self._id_keys(other)
+        return self.take([i for i, row in enumerate(ids) if row not in keys])
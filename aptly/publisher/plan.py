@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import functools
+from collections import OrderedDict
+from aptly.exceptions import AptlyException
+from aptly.publisher.workers import WorkerPool
+
+lg = logging.getLogger(__name__)
+
+METHODS = ('POST', 'PUT', 'DELETE')
+
+
+class Operation(object):
+    """
+    Single mutating API call of plan
+
+    Operation is started only after operations it depends on succeed.
+    Errors with status code in ignore_status are logged and ignored (eg.
+    400 when creating snapshot that already exists).
+
+    Fallback is dict with uri and data of POST sent instead when server
+    doesn't support the endpoint (404 or 405), eg. creating snapshot from
+    packages merged on client instead of server-side merge. Its data
+    without PackageRefs get packages of all SourceSnapshots.
+    """
+    def __init__(self, op_id, method, uri, data=None, depends=None,
+                 description=None, storage='', ignore_status=None,
+                 fallback=None):
+        if method not in METHODS:
+            raise ValueError("Unsupported method %s of operation %s" % (method, op_id))
+
+        self.id = op_id
+        self.method = method
+        self.uri = uri
+        self.data = data
+        self.depends = list(depends or [])
+        self.description = description or '%s %s' % (method, uri)
+        self.storage = storage
+        self.ignore_status = list(ignore_status or [])
+        self.fallback = fallback
+
+    def to_dict(self, compact=False):
+        data = self.data
+        if compact and data and 'PackageRefs' in data:
+            data = dict(data)
+            data['PackageRefs'] = '<%s package refs>' % len(data['PackageRefs'])
+        return OrderedDict([
+            ('id', self.id),
+            ('description', self.description),
+            ('method', self.method),
+            ('uri', self.uri),
+            ('data', data),
+            ('depends', self.depends),
+            ('storage', self.storage),
+            ('ignore_status', self.ignore_status),
+            ('fallback', self.fallback),
+        ])
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['method'], data['uri'],
+                   data=data.get('data'),
+                   depends=data.get('depends'),
+                   description=data.get('description'),
+                   storage=data.get('storage', ''),
+                   ignore_status=data.get('ignore_status'),
+                   fallback=data.get('fallback'))
+
+
+class Plan(object):
+    """
+    Graph of operations computed from current state before anything is
+    changed
+    """
+    def __init__(self):
+        self.operations = OrderedDict()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations.values())
+
+    def __contains__(self, op_id):
+        return op_id in self.operations
+
+    def add(self, op_id, method, uri, data=None, depends=None, **kwargs):
+        """
+        Add operation and return its id
+        """
+        if op_id in self.operations:
+            raise ValueError("Operation %s is already planned" % op_id)
+        for dep in depends or []:
+            if dep not in self.operations:
+                raise ValueError("Operation %s depends on unknown operation %s" % (op_id, dep))
+
+        self.operations[op_id] = Operation(op_id, method, uri, data=data,
+                                           depends=depends, **kwargs)
+        return op_id
+
+    def find(self, method=None, prefix=None):
+        """
+        Return ids of operations with given method and id prefix
+        """
+        return [op.id for op in self
+                if (not method or op.method == method) and
+                (not prefix or op.id.startswith(prefix))]
+
+    def levels(self):
+        """
+        Return list of levels (lists of operation ids), operations in the
+        same level don't depend on each other
+        """
+        done = set()
+        levels = []
+        remaining = list(self.operations.values())
+        while remaining:
+            level = [op.id for op in remaining if done.issuperset(op.depends)]
+            if not level:
+                raise ValueError("Plan has cyclic dependencies")
+            levels.append(level)
+            done.update(level)
+            remaining = [op for op in remaining if op.id not in done]
+        return levels
+
+    def to_dict(self, compact=False):
+        """
+        Return plan as JSON-serializable dict, with compact=True package
+        refs are replaced by their count
+        """
+        return OrderedDict([
+            ('operations', [op.to_dict(compact) for op in self]),
+            ('levels', self.levels()),
+        ])
+
+    def to_json(self, compact=False):
+        return json.dumps(self.to_dict(compact), indent=2)
+
+    @classmethod
+    def from_dict(cls, data):
+        plan = cls()
+        for op in data.get('operations', []):
+            op = Operation.from_dict(op)
+            if op.data and 'PackageRefs' in op.data and not isinstance(op.data['PackageRefs'], list):
+                raise ValueError("Operation %s is in compact form and can't be executed" % op.id)
+            plan.add(op.id, op.method, op.uri, data=op.data, depends=op.depends,
+                     description=op.description, storage=op.storage,
+                     ignore_status=op.ignore_status, fallback=op.fallback)
+        return plan
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_dict(json.loads(data))
+
+
+class PlanExecutor(object):
+    """
+    Execute plan, independent operations are executed concurrently by given
+    number of workers (limited also by storage_workers, see WorkerPool)
+    """
+    def __init__(self, client, workers=1, storage_workers=None):
+        self.client = client
+        self.pool = WorkerPool(workers, storage_workers)
+
+    def execute(self, plan):
+        """
+        Execute operations of plan
+
+        Return tuple (results, failures) of dicts {operation id: value},
+        operations depending on failed operation are not executed and are
+        reported as failed.
+        """
+        jobs = []
+        depends = {}
+        for op in plan:
+            jobs.append((op.id, op.storage, functools.partial(self._execute, op)))
+            depends[op.id] = op.depends
+        return self.pool.run(jobs, depends)
+
+    def _execute(self, op):
+        lg.info(op.description)
+        try:
+            try:
+                return self._send(op.method, op.uri, op.data)
+            except AptlyException as e:
+                if not op.fallback or e.res.status_code not in (404, 405):
+                    raise
+                lg.warning("Operation %s isn't supported by server (%s), sending POST %s instead"
+                           % (op.id, e, op.fallback['uri']))
+                return self._send('POST', op.fallback['uri'], self._fallback_data(op.fallback['data']))
+        except AptlyException as e:
+            if e.res.status_code in op.ignore_status:
+                lg.warning("Operation %s failed, ignoring: %s" % (op.id, e))
+                return None
+            raise
+
+    def _send(self, method, uri, data):
+        if method == 'POST':
+            return self.client.do_post(uri, data)
+        elif method == 'PUT':
+            return self.client.do_put(uri, data)
+        else:
+            return self.client.do_delete(uri, data=data)
+
+    def _fallback_data(self, data):
+        if 'PackageRefs' in data or not data.get('SourceSnapshots'):
+            return data
+        data = dict(data)
+        data['PackageRefs'] = [
+            ref for refs in self.client.do_get_many(
+                ['/snapshots/%s/packages' % snapshot for snapshot in data['SourceSnapshots']])
+            for ref in refs]
+        return data
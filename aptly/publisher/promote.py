@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import functools
+from aptly.exceptions import NoSuchPublish
+from aptly.publisher import Publish
+from aptly.publisher.workers import WorkerPool
+
+lg = logging.getLogger(__name__)
+
+
+class PromoteError(Exception):
+    pass
+
+
+class Promotion(object):
+    """
+    Promotion of source publish into target publish
+    """
+    def __init__(self, source_name, target_name):
+        self.source_name = source_name
+        self.target_name = target_name
+        self.source = None
+        self.target = None
+        # Snapshots of promoted packages to create as tuples (component,
+        # snapshot name, source snapshots, description, package refs)
+        self.snapshots = []
+        self.up_to_date = False
+        self.error = None
+
+    def __repr__(self):
+        return "%s -> %s" % (self.source_name, self.target_name)
+
+
+class BatchPromoter(object):
+    """
+    Promote multiple source publishes into target publishes
+
+    All publishes are loaded and components of targets computed first,
+    then target publishes are published concurrently by given number of
+    workers (limited also by storage_workers, see WorkerPool). Failure of
+    one promotion doesn't stop the others.
+    """
+    def __init__(self, client, storage="", workers=1, storage_workers=None):
+        self.client = client
+        self.storage = storage
+        self.pool = WorkerPool(workers, storage_workers)
+        self._sources = {}
+
+    def _load_source(self, name):
+        # Source can be shared by several promotions, it's not modified
+        try:
+            return self._sources[name]
+        except KeyError:
+            self._sources[name] = Publish(self.client, name, load=True, storage=self.storage)
+            return self._sources[name]
+
+    def load(self, pairs):
+        """
+        Return list of Promotions of (source, target) publish names with
+        loaded publishes, target doesn't have to exist
+        """
+        promotions = []
+        for source, target in pairs:
+            promotion = Promotion(source, target)
+            promotions.append(promotion)
+            try:
+                promotion.source = self._load_source(source)
+            except NoSuchPublish as e:
+                promotion.error = e
+                continue
+
+            promotion.target = Publish(self.client, target, storage=self.storage)
+            try:
+                promotion.target.load()
+            except NoSuchPublish:
+                # Target will be created
+                pass
+        return promotions
+
+    def prepare(self, promotion, components=None, packages=None, recreate=False):
+        """
+        Set components of target publish (and snapshots of promoted
+        packages to create)
+        """
+        source, target = (promotion.source, promotion.target)
+        diffs, _ = source.compare(target, components=components)
+        if not diffs:
+            lg.warning("Target %s is up to date with source publish %s" % (promotion.target_name, promotion.source_name))
+            if not recreate:
+                promotion.up_to_date = True
+                return
+            lg.warning("Recreating target publish %s on your command" % promotion.target_name)
+
+        if packages:
+            # Promote only specific packages
+            for component, snapshots in source.components.items():
+                if components and component not in components:
+                    continue
+
+                package_refs = source.get_packages(component=component, packages=packages)
+                if package_refs:
+                    snapshot_name = 'ext_%s-%s-%s' % (target.name.replace('./', '').replace('/', '-'), component, target.timestamp)
+                    promotion.snapshots.append((component, snapshot_name, snapshots,
+                                                "Promoted packages from snapshots %s: %s" % (snapshots, packages),
+                                                package_refs))
+            if not promotion.snapshots:
+                raise PromoteError("No packages were promoted: are you sure components: %s and packages: %s are valid?" % (components, packages))
+        elif not components:
+            # Use source publish components structure for target publish
+            target.components = copy.deepcopy(source.components)
+        else:
+            for component in components:
+                try:
+                    target.components[component] = copy.deepcopy(source.components[component])
+                except KeyError:
+                    raise PromoteError("Component %s does not exist in source publish %s" % (component, promotion.source_name))
+
+    def promote(self, pairs, components=None, packages=None, recreate=False,
+                **kwargs):
+        """
+        Promote list of (source, target) publish names, remaining arguments
+        are passed to Publish.do_publish
+
+        Return list of Promotions, failed ones have error set
+        """
+        promotions = self.load(pairs)
+
+        jobs = []
+        targets = {}
+        for promotion in promotions:
+            if promotion.error:
+                continue
+            if promotion.target.full_name in targets:
+                promotion.error = PromoteError("Target %s is already promoted from %s" % (promotion.target_name, targets[promotion.target.full_name]))
+                continue
+            targets[promotion.target.full_name] = promotion.source_name
+
+            try:
+                self.prepare(promotion, components=components, packages=packages, recreate=recreate)
+            except PromoteError as e:
+                promotion.error = e
+                continue
+            if promotion.up_to_date:
+                continue
+
+            lg.info("Promoting %s to %s" % (promotion.source_name, promotion.target_name))
+            jobs.append((promotion.target.full_name, promotion.target.storage,
+                         functools.partial(self._execute, promotion, recreate=recreate, **kwargs)))
+
+        _, failures = self.pool.run(jobs)
+        for promotion in promotions:
+            if not promotion.error and promotion.target.full_name in failures:
+                promotion.error = failures[promotion.target.full_name]
+        return promotions
+
+    def _execute(self, promotion, **kwargs):
+        source, target = (promotion.source, promotion.target)
+        for component, snapshot_name, snapshots, description, package_refs in promotion.snapshots:
+            lg.debug("Creating snapshot %s for component %s of %s packages" % (snapshot_name, component, len(package_refs)))
+            self.client.do_post(
+                '/snapshots',
+                data={
+                    'Name': snapshot_name,
+                    'SourceSnapshots': snapshots,
+                    'Description': description,
+                    'PackageRefs': package_refs,
+                }
+            )
+            target.add(snapshot_name, component)
+
+        target.do_publish(architectures=source.architectures, **kwargs)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+# Separator followed by number, eg. -1234 in name-1234
+RE_NUMBERED = re.compile(r'[-_]\d')
+
+_patterns = {}
+
+
+def compile_pattern(pattern):
+    """
+    Return compiled regular expression, cached by pattern
+    """
+    try:
+        return _patterns[pattern]
+    except KeyError:
+        _patterns[pattern] = re.compile(pattern)
+        return _patterns[pattern]
+
+
+class SnapshotIndex(object):
+    """
+    Index of remote snapshots built once per fetch of snapshot list
+
+    Snapshots are expected in order returned by /snapshots?sort=time (oldest
+    first), so the newest match is returned by all lookups.
+    """
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.by_name = {}
+        self.position = {}
+        for position, snapshot in enumerate(snapshots):
+            self.by_name[snapshot['Name']] = snapshot
+            self.position[snapshot['Name']] = position
+
+        self._by_prefix = None
+        self._matches = {}
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        """
+        Return snapshot by exact name or None
+        """
+        return self.by_name.get(name)
+
+    def match(self, pattern):
+        """
+        Return newest snapshot whose name matches regular expression
+        """
+        try:
+            return self._matches[pattern]
+        except KeyError:
+            pass
+
+        regex = compile_pattern(pattern)
+        found = None
+        for snapshot in reversed(self.snapshots):
+            if regex.match(snapshot['Name']):
+                found = snapshot
+                break
+        self._matches[pattern] = found
+        return found
+
+    def _build_prefixes(self):
+        # Bucket snapshots by every prefix followed by separator and number,
+        # eg. _nightly-trusty-main-1234 is in bucket _nightly-trusty-main-
+        by_prefix = {}
+        for snapshot in self.snapshots:
+            name = snapshot['Name']
+            for numbered in RE_NUMBERED.finditer(name):
+                by_prefix.setdefault(name[:numbered.start() + 1], []).append(snapshot)
+        self._by_prefix = by_prefix
+
+    def latest(self, prefix, separators='-'):
+        """
+        Return newest snapshot with name in format <prefix><separator><number>,
+        equivalent to matching ^<prefix>[<separators>]\\d+ with literal prefix
+        """
+        if self._by_prefix is None:
+            self._build_prefixes()
+
+        found = None
+        for separator in separators:
+            bucket = self._by_prefix.get(prefix + separator)
+            if bucket and (found is None or self.position[bucket[-1]['Name']] > self.position[found['Name']]):
+                found = bucket[-1]
+        return found
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+lg = logging.getLogger(__name__)
+
+
+def storage_backend(storage):
+    """
+    Return storage backend type (filesystem, s3, swift) of publish storage
+    string, eg. s3:mys3 -> s3
+    """
+    if not storage:
+        return 'filesystem'
+    return storage.split(':')[0]
+
+
+def parse_storage_workers(values):
+    """
+    Parse list of backend=limit strings (eg. from command line) into dict
+    """
+    limits = {}
+    for value in values or []:
+        try:
+            backend, limit = value.split('=', 1)
+            limits[backend] = int(limit)
+        except ValueError:
+            raise ValueError("Invalid storage limit %s, expected format is backend=number, eg. s3=2" % value)
+        if limits[backend] < 1:
+            raise ValueError("Storage limit for %s must be at least 1" % backend)
+    return limits
+
+
+class WorkerPool(object):
+    """
+    Run jobs in thread pool with global limit of workers and optional
+    separate limits per storage.
+
+    Storage limit can be given either for full storage name (eg. s3:mys3) or
+    for storage backend type (filesystem, s3, swift).
+    """
+    def __init__(self, workers=1, storage_workers=None):
+        self.workers = max(int(workers or 1), 1)
+        self.storage_workers = storage_workers or {}
+
+    def _storage_key(self, storage):
+        if storage in self.storage_workers:
+            return storage
+        return storage_backend(storage)
+
+    def _storage_limit(self, key):
+        return self.storage_workers.get(key, self.workers)
+
+    def run(self, jobs, depends=None):
+        """
+        Run list of jobs given as tuples (key, storage, callable)
+
+        Optional depends is dict {key: [keys]} of jobs that have to finish
+        successfully before given job is started. Jobs that depend on failed
+        job are not executed and reported as failed too.
+
+        Return tuple (results, failures) of dicts {key: value} where failures
+        contains exception raised by job. Failed job doesn't stop others.
+        """
+        results, failures = ({}, {})
+
+        keys = set(job[0] for job in jobs)
+        blocked = {}
+        dependents = {}
+        for key, deps in (depends or {}).items():
+            deps = set(deps) & keys
+            deps.discard(key)
+            if deps:
+                blocked[key] = deps
+                for dep in deps:
+                    dependents.setdefault(dep, []).append(key)
+
+        pending = {}
+        order = []
+        waiting = {}
+
+        def queue(job):
+            storage_key = self._storage_key(job[1])
+            if storage_key not in pending:
+                pending[storage_key] = []
+                if storage_key not in order:
+                    order.append(storage_key)
+                    running_storage[storage_key] = 0
+            pending[storage_key].append(job)
+
+        def fail_dependents(key):
+            for dependent in dependents.get(key, []):
+                if dependent in waiting:
+                    del waiting[dependent]
+                    failures[dependent] = Exception("Job %s was not executed, job %s it depends on failed" % (dependent, key))
+                    fail_dependents(dependent)
+
+        running = {}
+        running_storage = {}
+        for job in jobs:
+            if job[0] in blocked:
+                waiting[job[0]] = job
+            else:
+                queue(job)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                # Submit as many jobs as both limits allow, round-robin over
+                # storages so slow backend doesn't starve the others
+                submitted = True
+                while submitted and len(running) < self.workers:
+                    submitted = False
+                    for storage_key in order:
+                        if len(running) >= self.workers:
+                            break
+                        if not pending.get(storage_key):
+                            continue
+                        if running_storage[storage_key] >= self._storage_limit(storage_key):
+                            continue
+
+                        key, storage, func = pending[storage_key].pop(0)
+                        if not pending[storage_key]:
+                            del pending[storage_key]
+                        lg.debug("Starting job %s (storage %s)" % (key, storage or "local"))
+                        running[executor.submit(func)] = (key, storage_key)
+                        running_storage[storage_key] += 1
+                        submitted = True
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, storage_key = running.pop(future)
+                    running_storage[storage_key] -= 1
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        lg.debug("Job %s failed: %s" % (key, e), exc_info=True)
+                        failures[key] = e
+                        fail_dependents(key)
+                        continue
+
+                    for dependent in dependents.get(key, []):
+                        if dependent not in waiting:
+                            continue
+                        blocked[dependent].discard(key)
+                        if not blocked[dependent]:
+                            queue(waiting.pop(dependent))
+
+        for key in waiting:
+            # Only jobs on dependency cycle can be left
+            failures[key] = Exception("Job %s was not executed, it has cyclic dependencies" % key)
+
+        return (results, failures)
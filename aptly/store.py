@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+import logging
+
+lg = logging.getLogger(__name__)
+
+
+class PackageStore(object):
+    """
+    Persistent store of snapshot package lists
+
+    Snapshots are immutable, so package list is stored under snapshot name
+    and its creation time and can be reused by later runs. Lists are kept
+    compressed in SQLite database, which is cheap to reopen and safe to use
+    by concurrent processes. When total size exceeds max_bytes, least
+    recently used lists are evicted.
+    """
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60,
+                                     check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS packages ('
+                'server TEXT, name TEXT, created_at TEXT, data BLOB, '
+                'size INTEGER, used REAL, '
+                'PRIMARY KEY (server, name, created_at))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS packages_used ON packages (used)'
+            )
+            self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _encode(packages):
+        return zlib.compress('\n'.join(packages).encode('utf-8'))
+
+    @staticmethod
+    def _decode(data):
+        data = zlib.decompress(data).decode('utf-8')
+        return data.split('\n') if data else []
+
+    def get(self, server, name, created_at):
+        """
+        Return stored package list or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM packages '
+                'WHERE server = ? AND name = ? AND created_at = ?',
+                (server, name, created_at)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                'UPDATE packages SET used = ? '
+                'WHERE server = ? AND name = ? AND created_at = ?',
+                (time.time(), server, name, created_at)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        return self._decode(row[0])
+
+    def set(self, server, name, created_at, packages):
+        data = self._encode(packages)
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            # Snapshot with same name but different creation time was
+            # replaced, so we won't need its packages any more
+            self._conn.execute(
+                'DELETE FROM packages WHERE server = ? AND name = ?',
+                (server, name)
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)',
+                (server, name, created_at, sqlite3.Binary(data), len(data),
+                 time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if not self.max_bytes:
+            return
+
+        total = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM packages').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._conn.execute(
+            'SELECT server, name, created_at, size FROM packages '
+            'ORDER BY used').fetchall()
+        for server, name, created_at, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute(
+                'DELETE FROM packages '
+                'WHERE server = ? AND name = ? AND created_at = ?',
+                (server, name, created_at)
+            )
+            total -= size
+            self.evictions += 1
+            lg.debug("Evicted packages of snapshot %s from store" % name)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM packages'
+            ).fetchone()
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
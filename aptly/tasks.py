@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import time
+from aptly.exceptions import AptlyException
+
+TASK_IDLE = 0
+TASK_RUNNING = 1
+TASK_SUCCEEDED = 2
+TASK_FAILED = 3
+
+TASK_STATES = {
+    TASK_IDLE: 'idle',
+    TASK_RUNNING: 'running',
+    TASK_SUCCEEDED: 'succeeded',
+    TASK_FAILED: 'failed',
+}
+
+
+def backoff(initial, maximum, factor=1.5):
+    """
+    Generate poll intervals growing exponentially up to maximum
+    """
+    interval = initial
+    while True:
+        yield interval
+        interval = min(interval * factor, maximum)
+
+
+class TaskResponse(object):
+    """
+    Response-like object of failed task, so consumers of AptlyException can
+    check status_code the same way as for synchronous calls
+    """
+    def __init__(self, status_code, reason, text=""):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        raise ValueError("Task response has no JSON body")
+
+
+class Task(object):
+    """
+    Aptly background task submitted by mutating API call with _async=true
+    """
+    def __init__(self, data, method=None, uri=None):
+        self.id = data['ID']
+        self.name = data.get('Name')
+        self.state = data.get('State', TASK_IDLE)
+        self.method = method
+        self.uri = uri
+        self.submitted = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return "<Task %s %s (%s)>" % (self.id, self.name, self.state_name)
+
+    @property
+    def done(self):
+        return self.state in (TASK_SUCCEEDED, TASK_FAILED)
+
+    @property
+    def state_name(self):
+        return TASK_STATES.get(self.state, str(self.state))
+
+    @property
+    def duration(self):
+        """
+        Duration from submission until the task was seen finished
+        """
+        return (self.finished or time.time()) - self.submitted
+
+    def update(self, data):
+        self.state = data.get('State', self.state)
+        if self.done and self.finished is None:
+            self.finished = time.time()
+
+    def set_return_value(self, value, output=None):
+        """
+        Set result or error from /tasks/{id}/return_value response
+        ({'Code': http_code, 'Value': value}) and task output
+        """
+        code = None
+        if isinstance(value, dict) and 'Code' in value:
+            code = value.get('Code')
+            value = value.get('Value')
+
+        if self.state == TASK_FAILED or (code and (code < 200 or code >= 300)):
+            if not code or 200 <= code < 300:
+                code = 500
+            reason = (output or "").strip().splitlines()
+            reason = reason[-1] if reason else "task %s failed" % self.id
+            self.error = AptlyException(
+                TaskResponse(code, reason, output or ""),
+                "Something went wrong: %s (%s)" % (reason, code)
+            )
+        else:
+            self.result = value
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state_name,
+            'method': self.method,
+            'uri': self.uri,
+            'duration': self.duration,
+        }
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import zlib
+import time
+import random
+import logging
+import threading
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from aptly.tasks import backoff
+
+lg = logging.getLogger(__name__)
+
+# Size of chunks of incrementally encoded request body
+CHUNK_SIZE = 64 * 1024
+
+
+class JsonCodec(object):
+    """
+    JSON codec using standard json module, it can encode incrementally
+    """
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def iterencode(self, data):
+        return (chunk.encode('utf-8') for chunk in json.JSONEncoder().iterencode(data))
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    JSON codec using orjson, it's much faster but can't encode
+    incrementally, so whole body is encoded at once
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, data):
+        return self._orjson.dumps(data)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+    def iterencode(self, data):
+        data = self.dumps(data)
+        for start in range(0, len(data), CHUNK_SIZE):
+            yield data[start:start + CHUNK_SIZE]
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+}
+
+
+def get_codec(name='auto'):
+    """
+    Return JSON codec of given name, auto selects the fastest installed one
+    """
+    if name in (None, 'auto'):
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return JsonCodec()
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError("Unknown JSON codec %s, available are %s" % (name, ', '.join(sorted(CODECS))))
+
+
+def _join_chunks(pieces, chunk_size=CHUNK_SIZE):
+    chunk = []
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def encode_body(data, codec, stream=False, compress=False):
+    """
+    Encode request body as JSON, optionally gzip compressed
+
+    With stream=True return generator of chunks, so body is sent as chunked
+    request while it's being encoded, otherwise bytes.
+    """
+    if stream:
+        chunks = _join_chunks(codec.iterencode(data))
+    else:
+        chunks = [codec.dumps(data)]
+
+    if compress:
+        chunks = _gzip_chunks(chunks)
+
+    if stream:
+        return chunks
+    return b''.join(chunks)
+
+
+def _shorten(value, max_items):
+    if isinstance(value, list):
+        shortened = [_shorten(item, max_items) for item in value[:max_items]]
+        if len(value) > max_items:
+            shortened.append('... %s more' % (len(value) - max_items))
+        return shortened
+    if isinstance(value, dict):
+        return dict((key, _shorten(item, max_items)) for key, item in value.items())
+    return value
+
+
+class LogPayload(object):
+    """
+    Request body formatted for log message only when it's emitted, with
+    long lists shortened and whole text capped at max_length characters
+    """
+    def __init__(self, data, max_length=1024, max_items=10):
+        self.data = data
+        self.max_length = max_length
+        self.max_items = max_items
+
+    def __str__(self):
+        text = json.dumps(_shorten(self.data, self.max_items))
+        if self.max_length and len(text) > self.max_length:
+            text = '%s... (%s characters)' % (text[:self.max_length], len(text))
+        return text
+
+
+def _not_sent(error):
+    """
+    Check if request failed before it was sent (so it's safe to retry even
+    non-idempotent request)
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# Status of retried request failing only because it was already applied by
+# previous attempt: duplicate of created object or missing deleted object
+APPLIED_STATUSES = {
+    'POST': 400,
+    'DELETE': 404,
+}
+
+
+class RetryPolicy(object):
+    """
+    Retry requests failed by connection errors, timeouts or transient
+    server errors, with exponential backoff and jitter
+
+    GET, PUT and DELETE are idempotent and always retried, POST only when
+    request wasn't sent at all or when its URI matches safe_posts (creating
+    named object where repeated request fails as duplicate). Error of
+    retried request which may have been applied by previous attempt
+    (duplicate 400 of POST, 404 of DELETE) is passed to confirm function,
+    which returns response replacing it when the object was created or
+    deleted by that attempt. Total number of retries of client can be
+    limited by budget.
+    """
+    def __init__(self, retries=3, backoff_initial=0.5, backoff_max=30,
+                 backoff_factor=2, statuses=(502, 503, 504), budget=None,
+                 safe_posts=(r'^/snapshots(/[^/?]+/merge)?(\?.*)?$',)):
+        self.retries = retries
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.backoff_factor = backoff_factor
+        self.statuses = set(statuses)
+        self.budget = budget
+        self.safe_posts = [re.compile(pattern) for pattern in safe_posts]
+
+        self._lock = threading.Lock()
+        self.retried = 0
+        self.waited = 0.0
+        self.exhausted = 0
+
+    def _retryable(self, method, uri, not_sent=False):
+        if method != 'POST' or not_sent:
+            return True
+        return any(pattern.match(uri) for pattern in self.safe_posts)
+
+    def _take_budget(self):
+        with self._lock:
+            if self.budget is not None and self.retried >= self.budget:
+                self.exhausted += 1
+                return False
+            self.retried += 1
+            return True
+
+    def call(self, method, uri, request, confirm=None):
+        """
+        Call request (function returning requests.Response) and retry it
+        according to policy
+        """
+        delays = backoff(self.backoff_initial, self.backoff_max, self.backoff_factor)
+        attempt = 0
+        # Previous attempt may have been processed by server
+        applied = False
+        while True:
+            try:
+                res = request()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                not_sent = _not_sent(e)
+                if attempt >= self.retries or not self._retryable(method, uri, not_sent):
+                    raise
+                applied = applied or not not_sent
+                error = e
+            else:
+                if res.status_code not in self.statuses or attempt >= self.retries or \
+                        not self._retryable(method, uri):
+                    if applied and confirm is not None and res.status_code == APPLIED_STATUSES.get(method):
+                        confirmed = confirm(res)
+                        if confirmed is not None:
+                            lg.warning("%s %s failed (%s %s), it was applied by previous attempt"
+                                       % (method, uri, res.status_code, res.reason))
+                            return confirmed
+                    return res
+                applied = True
+                error = "%s %s" % (res.status_code, res.reason)
+
+            if not self._take_budget():
+                lg.warning("Retry budget exhausted, not retrying %s %s" % (method, uri))
+                if isinstance(error, Exception):
+                    raise error
+                return res
+
+            # Full jitter, so concurrent workers don't retry at once
+            delay = random.uniform(0, next(delays))
+            attempt += 1
+            lg.warning("%s %s failed (%s), retrying in %.1fs (%s/%s)"
+                       % (method, uri, error, delay, attempt, self.retries))
+            with self._lock:
+                self.waited += delay
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'retries': self.retried,
+                'wait': round(self.waited, 3),
+                'budget_exhausted': self.exhausted,
+            }
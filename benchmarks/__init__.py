@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of aptly publisher against fake Aptly API server, run by
+python -m benchmarks --help
+"""
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import timeit
+import yaml
+
+from aptly.client import Aptly
+from aptly.publisher import PublishManager, Publish
+from aptly.publisher import __main__ as publisher
+from benchmarks.fake_aptly import FakeAptlyServer, SyntheticRepository
+
+lg = logging.getLogger('aptly-benchmark')
+
+SCENARIOS = ('publish', 'promote', 'purge', 'dump', 'dump-archive', 'restore', 'cleanup')
+MICRO = ('parse_package_ref', 'compare', 'purge_publish')
+
+
+def run_publisher(url, args):
+    """
+    Run aptly-publisher with given arguments, return True if it succeeded
+    """
+    argv = sys.argv
+    sys.argv = ['aptly-publisher', '--url', url] + args
+    try:
+        publisher.main()
+    except SystemExit as e:
+        return not e.code
+    finally:
+        sys.argv = argv
+    return True
+
+
+class Benchmark(object):
+    """
+    Run scenarios end to end (aptly-publisher actions) against fake server
+    with fresh synthetic data for every run and micro-benchmarks of
+    publisher internals
+    """
+    def __init__(self, repository, server, workers=1, repeat=3):
+        self.repository = repository
+        self.server = server
+        self.workers = workers
+        self.repeat = repeat
+        self.tmpdir = tempfile.mkdtemp(prefix='aptly-benchmark-')
+        self.config_file = os.path.join(self.tmpdir, 'publisher.yaml')
+        with open(self.config_file, 'w') as config_file:
+            yaml.safe_dump(repository.config(), config_file)
+
+    def close(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _workdir(self, name):
+        path = os.path.join(self.tmpdir, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def scenario_args(self, name):
+        """
+        Return arguments of aptly-publisher for scenario, preparing its
+        prerequisites (not measured)
+        """
+        workers = ['--workers', str(self.workers)]
+        if name == 'publish':
+            return ['publish', '-c', self.config_file] + workers
+        if name == 'promote':
+            return ['promote', '--source', r'%s(\d+)/nightly' % self.repository.prefix,
+                    '--target', '%s{0}/testing' % self.repository.prefix]
+        if name == 'purge':
+            return ['purge', '-c', self.config_file]
+        if name == 'dump':
+            return ['dump', '-s', self._workdir('dump'), '-p', 'all'] + workers
+        if name == 'dump-archive':
+            return ['dump', '-s', self._workdir('dump'), '-p', 'all', '--format', 'archive'] + workers
+        if name == 'restore':
+            dump_dir = self._workdir('restore')
+            if not run_publisher(self.server.url, ['dump', '-s', dump_dir, '-p', 'all'] + workers):
+                raise Exception("Dump for restore failed")
+            return ['restore', '-r'] + sorted(glob.glob(os.path.join(dump_dir, '*.yml'))) + workers
+        if name == 'cleanup':
+            return ['cleanup'] + workers
+        raise ValueError("Unknown scenario %s" % name)
+
+    def run_scenario(self, name):
+        times = []
+        requests = 0
+        failed = False
+        for _ in range(self.repeat):
+            self.server.state = self.repository.state()
+            args = self.scenario_args(name)
+            self.server.state.requests.clear()
+
+            start = timeit.default_timer()
+            if not run_publisher(self.server.url, args):
+                failed = True
+            times.append(timeit.default_timer() - start)
+            requests = sum(self.server.state.requests.values())
+        return summarize(times, requests=requests, failed=failed)
+
+    def micro_setup(self, name):
+        """
+        Return function measured by micro-benchmark
+        """
+        source = self.repository.sources[0][1]
+        if name == 'parse_package_ref':
+            publish = Publish(None, 'bench/parse')
+            refs = self.repository.snapshot_refs(source, 0)
+
+            def parse():
+                for ref in refs:
+                    publish.parse_package_ref(ref)
+            return parse
+
+        if name == 'compare':
+            components = ['component%s' % i for i in range(max(self.repository.packages // 100, 10))]
+            snapshots = [self.repository.snapshot_name(source, number) for number in range(self.repository.snapshots)]
+            publish, other = (Publish(None, 'bench/new'), Publish(None, 'bench/old'))
+            for component in components:
+                for snapshot in snapshots[1:]:
+                    publish.add(snapshot, component)
+                for snapshot in snapshots[:-1]:
+                    other.add(snapshot, component)
+            return lambda: publish.compare(other)
+
+        if name == 'purge_publish':
+            # Package lists are fetched once and cached, snapshots are not
+            # created by dry client
+            self.server.state = self.repository.state()
+            client = Aptly(self.server.url, dry=True)
+            publish = Publish(client, self.repository.distributions[0], load=True)
+            Publish._prefetch_packages(client, 'snapshots', [snapshot['Name'] for snapshot in publish.publish_snapshots])
+            _, publish_dict = PublishManager.get_repo_information(self.repository.config(), client)
+            publish_snapshots = list(publish.publish_snapshots)
+
+            def purge():
+                publish.publish_snapshots = list(publish_snapshots)
+                publish.purge_publish({}, publish_dict)
+            return purge
+
+        raise ValueError("Unknown micro-benchmark %s" % name)
+
+    def run_micro(self, name, number=10):
+        func = self.micro_setup(name)
+        times = timeit.Timer(func).repeat(self.repeat, number)
+        return summarize([duration / number for duration in times])
+
+
+def summarize(times, **kwargs):
+    times = sorted(times)
+    result = {
+        'times': [round(duration, 6) for duration in times],
+        'min': round(times[0], 6),
+        'median': round(times[len(times) // 2], 6),
+        'mean': round(sum(times) / len(times), 6),
+    }
+    result.update(kwargs)
+    return result
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Print comparison of medians with baseline results, return list of
+    benchmarks slower by more than threshold (fraction)
+    """
+    regressions = []
+    print("\nComparison with baseline from %s:" % baseline.get('created'))
+    if baseline.get('params') != results['params']:
+        print("  Warning: baseline was run with different parameters %s" % baseline.get('params'))
+    for name, result in sorted(results['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or not base['median']:
+            continue
+        ratio = result['median'] / base['median']
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = ' REGRESSION'
+        print("  %-28s %12.6fs -> %12.6fs %7.2fx%s" % (name, base['median'], result['median'], ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("aptly-benchmark")
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('--packages', type=int, default=1000, help="Number of packages of every source (each in --versions versions)")
+    parser.add_argument('--snapshots', type=int, default=8, help="Total number of snapshots of sources (at least 2 per source)")
+    parser.add_argument('--publishes', type=int, default=4, help="Number of publishes")
+    parser.add_argument('--components', nargs='+', default=['main', 'extra'], help="Components, every one has mirror and repo source")
+    parser.add_argument('--versions', type=int, default=3, help="Maximum number of versions of package in snapshot")
+    parser.add_argument('--server-version', default='1.5.0', help="Aptly version reported by fake server (1.6.0 and newer merges snapshots on server)")
+    parser.add_argument('--latency', type=float, default=0, help="Latency of every request in seconds")
+    parser.add_argument('--publish-latency', type=float, default=0, help="Additional latency of creating, updating and deleting publish in seconds")
+    parser.add_argument('--workers', type=int, default=1, help="Value of --workers of publisher")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs of every benchmark")
+    parser.add_argument('--number', type=int, default=10, help="Number of calls per run of micro-benchmarks")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS), help="End to end scenarios to run")
+    parser.add_argument('--micro', nargs='*', choices=MICRO, default=list(MICRO), help="Micro-benchmarks to run")
+    parser.add_argument('-o', '--output', help="Save results as JSON into given file")
+    parser.add_argument('--compare', help="Compare results with previously saved results")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Slowdown (fraction of baseline median) reported as regression, default 0.2")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.verbose:
+        lg.setLevel(logging.INFO)
+        logging.getLogger('aptly').setLevel(logging.INFO)
+    else:
+        # Publisher warnings would be repeated for every run
+        logging.getLogger('aptly').setLevel(logging.ERROR)
+        logging.getLogger('aptly-publisher').setLevel(logging.ERROR)
+
+    repository = SyntheticRepository(packages=args.packages,
+                                     snapshots=args.snapshots,
+                                     publishes=args.publishes,
+                                     components=args.components,
+                                     versions=args.versions,
+                                     server_version=args.server_version)
+    params = dict((key, getattr(args, key)) for key in (
+        'packages', 'snapshots', 'publishes', 'components', 'versions',
+        'server_version', 'latency', 'publish_latency', 'workers', 'repeat',
+        'number'))
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': {},
+    }
+
+    with FakeAptlyServer(latency=args.latency, publish_latency=args.publish_latency) as server:
+        benchmark = Benchmark(repository, server, workers=args.workers, repeat=args.repeat)
+        try:
+            for name in args.scenarios:
+                lg.info("Running scenario %s" % name)
+                result = results['results'][name] = benchmark.run_scenario(name)
+                print("%-28s %10.4fs (median %.4fs, %s requests)%s"
+                      % (name, result['min'], result['median'], result['requests'],
+                         ' FAILED' if result['failed'] else ''))
+
+            for name in args.micro:
+                lg.info("Running micro-benchmark %s" % name)
+                result = results['results']['micro.%s' % name] = benchmark.run_micro(name, args.number)
+                print("%-28s %10.6fs (median %.6fs)" % ('micro.%s' % name, result['min'], result['median']))
+        finally:
+            benchmark.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    failed = [name for name, result in results['results'].items() if result.get('failed')]
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r') as baseline:
+            regressions = compare_results(results, json.load(baseline), args.threshold)
+
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process stand-in for Aptly API with synthetic repositories
+
+It implements only endpoints used by publisher and keeps everything in
+memory, requests can be delayed to simulate latency of real server.
+"""
+
+import io
+import re
+import json
+import gzip
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from aptly.client import has_feature
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+    from urllib import unquote
+
+lg = logging.getLogger(__name__)
+
+# First snapshot creation time of synthetic data
+EPOCH = 1767225600
+
+
+class FakeAptlyError(Exception):
+    def __init__(self, status, message):
+        super(FakeAptlyError, self).__init__(message)
+        self.status = status
+
+
+def _split_publish(path):
+    """
+    Return tuple (storage, prefix) of publish path in API URI, eg.
+    s3:mys3:trusty_main -> ('s3:mys3', 'trusty/main')
+    """
+    path = path.lstrip('/')
+    storage, prefix = path.rsplit(':', 1) if ':' in path else ('', path)
+    return (storage, prefix.replace('_', '/') or '.')
+
+
+def _package_key(ref):
+    # "<arch> <name> <version> <hash>" -> (arch, name)
+    return tuple(ref.split(' ', 2)[:2])
+
+
+class FakeAptlyState(object):
+    """
+    Repositories, snapshots and publishes of fake server
+    """
+    def __init__(self, version='1.5.0'):
+        self.version = version
+        self.lock = threading.RLock()
+        self.repos = OrderedDict()
+        self.snapshots = OrderedDict()
+        self.publishes = OrderedDict()
+        self.packages = set()
+        self.requests = {}
+        self._clock = EPOCH
+
+        self.routes = [
+            ('GET', r'/version', self.get_version),
+            ('GET', r'/publish', self.list_publishes),
+            ('POST', r'/publish(?P<path>/.*)?', self.create_publish),
+            ('PUT', r'/publish/(?P<path>.+)', self.update_publish),
+            ('DELETE', r'/publish/(?P<path>.+)', self.drop_publish),
+            ('GET', r'/snapshots', self.list_snapshots),
+            ('POST', r'/snapshots', self.create_snapshot),
+            ('POST', r'/snapshots/(?P<name>[^/]+)/merge', self.merge_snapshots),
+            ('GET', r'/snapshots/(?P<name>[^/]+)', self.get_snapshot),
+            ('GET', r'/snapshots/(?P<name>[^/]+)/packages', self.snapshot_packages),
+            ('GET', r'/snapshots/(?P<left>[^/]+)/diff/(?P<right>[^/]+)', self.diff_snapshots),
+            ('DELETE', r'/snapshots/(?P<name>[^/]+)', self.delete_snapshot),
+            ('GET', r'/repos/(?P<name>[^/]+)/packages', self.repo_packages),
+            ('DELETE', r'/repos/(?P<name>[^/]+)/packages', self.delete_repo_packages),
+            ('GET', r'/graph\.dot', self.graph),
+        ]
+        self.routes = [(method, re.compile('^%s$' % pattern), handler)
+                       for method, pattern, handler in self.routes]
+
+    def _created_at(self):
+        self._clock += 1
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self._clock))
+
+    def add_repo(self, name, refs):
+        self.repos[name] = list(refs)
+        self.packages.update(refs)
+
+    def add_snapshot(self, name, refs, description=None, sources=None,
+                     repo=None):
+        self.snapshots[name] = {
+            'Name': name,
+            'Description': description or "Snapshot from local repo [%s]" % repo,
+            'CreatedAt': self._created_at(),
+            'refs': refs,
+            'sources': list(sources or []),
+            'repo': repo,
+        }
+
+    def add_publish(self, prefix, distribution, sources, storage='',
+                    architectures=('amd64',)):
+        self.publishes[(storage, prefix, distribution)] = {
+            'Storage': storage,
+            'Prefix': prefix,
+            'Distribution': distribution,
+            'SourceKind': 'snapshot',
+            'Sources': [{'Component': component, 'Name': name} for component, name in sources],
+            'Architectures': list(architectures),
+        }
+
+    def handle(self, method, path, query, data):
+        """
+        Dispatch API request, return tuple (status, result)
+        """
+        for route_method, pattern, handler in self.routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if not match:
+                continue
+            name = '%s %s' % (method, pattern.pattern[1:-1])
+            with self.lock:
+                self.requests[name] = self.requests.get(name, 0) + 1
+                try:
+                    return (200, handler(query=query, data=data, **match.groupdict()))
+                except FakeAptlyError as e:
+                    return (e.status, {'error': str(e)})
+        return (404, {'error': 'Page not found'})
+
+    def _snapshot(self, name):
+        try:
+            return self.snapshots[name]
+        except KeyError:
+            raise FakeAptlyError(404, "snapshot with name %s not found" % name)
+
+    def _publish(self, path):
+        storage, prefix = _split_publish(path)
+        parts = prefix.split('/')
+        key = (storage, '/'.join(parts[:-1]) or '.', parts[-1])
+        if key not in self.publishes:
+            raise FakeAptlyError(404, "published repo with storage:prefix/distribution %s:%s/%s not found" % key)
+        return key
+
+    def _check_sources(self, sources):
+        for source in sources:
+            self._snapshot(source['Name'])
+
+    # Endpoints
+
+    def get_version(self, query, data):
+        return {'Version': self.version}
+
+    def list_publishes(self, query, data):
+        return list(self.publishes.values())
+
+    def create_publish(self, query, data, path=None):
+        storage, prefix = _split_publish(path or '')
+        key = (storage, prefix, data['Distribution'])
+        if key in self.publishes:
+            raise FakeAptlyError(400, "prefix/distribution already used by another published repo")
+        self._check_sources(data['Sources'])
+        self.add_publish(prefix, data['Distribution'],
+                         [(source['Component'], source['Name']) for source in data['Sources']],
+                         storage=storage,
+                         architectures=data.get('Architectures') or ('amd64',))
+        return self.publishes[key]
+
+    def update_publish(self, query, data, path):
+        publish = self.publishes[self._publish(path)]
+        self._check_sources(data['Snapshots'])
+        components = sorted(source['Component'] for source in publish['Sources'])
+        if sorted(source['Component'] for source in data['Snapshots']) != components:
+            raise FakeAptlyError(404, "component is not in published repository")
+        publish['Sources'] = [{'Component': source['Component'], 'Name': source['Name']}
+                              for source in data['Snapshots']]
+        return publish
+
+    def drop_publish(self, query, data, path):
+        del self.publishes[self._publish(path)]
+        return {}
+
+    def _snapshot_info(self, snapshot):
+        # API fields only, internal ones are lowercase
+        return dict((key, value) for key, value in snapshot.items() if key[0].isupper())
+
+    def list_snapshots(self, query, data):
+        return [self._snapshot_info(snapshot) for snapshot in self.snapshots.values()]
+
+    def get_snapshot(self, query, data, name):
+        return self._snapshot_info(self._snapshot(name))
+
+    def create_snapshot(self, query, data):
+        if data['Name'] in self.snapshots:
+            raise FakeAptlyError(400, "snapshot with name %s already exists" % data['Name'])
+        for source in data.get('SourceSnapshots') or []:
+            self._snapshot(source)
+        refs = data.get('PackageRefs') or []
+        for ref in refs:
+            if ref not in self.packages:
+                raise FakeAptlyError(404, "package %s: not found" % ref)
+        self.add_snapshot(data['Name'], list(refs), description=data.get('Description'),
+                          sources=data.get('SourceSnapshots'))
+        return self._snapshot_info(self.snapshots[data['Name']])
+
+    def merge_snapshots(self, query, data, name):
+        if not has_feature(self.version, 'snapshot_merge'):
+            raise FakeAptlyError(404, 'Page not found')
+        if not data.get('Sources'):
+            raise FakeAptlyError(400, 'At least one source snapshot is required')
+        if name in self.snapshots:
+            raise FakeAptlyError(400, "snapshot with name %s already exists" % name)
+
+        merged = OrderedDict()
+        no_remove = query.get('no-remove', ['0'])[0] in ('1', 'true')
+        for source in data['Sources']:
+            for ref in self._snapshot(source)['refs']:
+                # Without no-remove, newer sources override packages
+                merged[ref if no_remove else _package_key(ref)] = ref
+        self.add_snapshot(name, list(merged.values()),
+                          description="Merged from sources: %s" % ', '.join("'%s'" % source for source in data['Sources']),
+                          sources=data['Sources'])
+        return self._snapshot_info(self.snapshots[name])
+
+    def snapshot_packages(self, query, data, name):
+        return self._snapshot(name)['refs']
+
+    def diff_snapshots(self, query, data, left, right):
+        left_keys, right_keys = ({}, {})
+        for refs, keys in ((self._snapshot(left)['refs'], left_keys),
+                           (self._snapshot(right)['refs'], right_keys)):
+            for ref in refs:
+                keys.setdefault(_package_key(ref), set()).add(ref)
+
+        diff = []
+        for key in sorted(set(left_keys) | set(right_keys)):
+            left_refs = left_keys.get(key, set())
+            right_refs = right_keys.get(key, set())
+            left_only = sorted(left_refs - right_refs)
+            right_only = sorted(right_refs - left_refs)
+            for i in range(max(len(left_only), len(right_only))):
+                diff.append({
+                    'Left': left_only[i] if i < len(left_only) else None,
+                    'Right': right_only[i] if i < len(right_only) else None,
+                })
+        return diff
+
+    def delete_snapshot(self, query, data, name):
+        self._snapshot(name)
+        for publish in self.publishes.values():
+            if name in [source['Name'] for source in publish['Sources']]:
+                raise FakeAptlyError(409, "unable to drop: snapshot is published")
+        for snapshot in self.snapshots.values():
+            if name in snapshot['sources']:
+                raise FakeAptlyError(409, "won't delete snapshot that was used as source for other snapshots")
+        del self.snapshots[name]
+        return {}
+
+    def repo_packages(self, query, data, name):
+        try:
+            return self.repos[name]
+        except KeyError:
+            raise FakeAptlyError(404, "local repo with name %s not found" % name)
+
+    def delete_repo_packages(self, query, data, name):
+        refs = set(data.get('PackageRefs') or [])
+        self.repos[name] = [ref for ref in self.repo_packages(query, data, name) if ref not in refs]
+        return {}
+
+    def graph(self, query, data):
+        lines = ['digraph aptly {']
+        ids = {}
+
+        def node(node_type, name, color):
+            ids[(node_type, name)] = '%s-%s' % (node_type.lower(), len(ids))
+            lines.append('\t"%s" [shape=Mrecord, style=filled, fillcolor="%s", label="{%s %s|%s}"];'
+                         % (ids[(node_type, name)], color, node_type, name, node_type.lower()))
+
+        for name in self.repos:
+            node('Repo', name, 'mediumseagreen')
+        for name in self.snapshots:
+            node('Snapshot', name, 'cadetblue1')
+        for storage, prefix, distribution in self.publishes:
+            node('Published', '%s/%s' % (prefix, distribution), 'darkolivegreen1')
+
+        for name, snapshot in self.snapshots.items():
+            if snapshot['repo'] in self.repos:
+                lines.append('\t"%s"->"%s";' % (ids[('Repo', snapshot['repo'])], ids[('Snapshot', name)]))
+            for source in snapshot['sources']:
+                if source in self.snapshots:
+                    lines.append('\t"%s"->"%s";' % (ids[('Snapshot', source)], ids[('Snapshot', name)]))
+        for (storage, prefix, distribution), publish in self.publishes.items():
+            for source in publish['Sources']:
+                lines.append('\t"%s"->"%s";' % (ids[('Snapshot', source['Name'])],
+                                                ids[('Published', '%s/%s' % (prefix, distribution))]))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeAptlyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't wait for ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        lg.debug(format % args)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if body and self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        return json.loads(body.decode('utf-8')) if body else None
+
+    def _handle(self):
+        data = self._read_body()
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if not path.startswith('/api/'):
+            status, result = (404, {'error': 'Page not found'})
+        else:
+            server = self.server.fake_aptly
+            status, result = server.state.handle(self.command, path[4:], parse_qs(url.query), data)
+            delay = server.latency
+            if self.command != 'GET' and path.startswith('/api/publish'):
+                delay += server.publish_latency
+            if delay:
+                time.sleep(delay)
+
+        if isinstance(result, str):
+            body = result.encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            body = json.dumps(result).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class FakeAptlyServer(object):
+    """
+    Fake Aptly API server running in background thread
+
+    Every request is delayed by latency seconds, mutating publish requests
+    (publishing itself) additionally by publish_latency.
+    """
+    def __init__(self, state=None, latency=0, publish_latency=0,
+                 host='127.0.0.1', port=0):
+        self.state = state if state is not None else FakeAptlyState()
+        self.latency = latency
+        self.publish_latency = publish_latency
+        self.httpd = _ThreadingHTTPServer((host, port), FakeAptlyHandler)
+        self.httpd.fake_aptly = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.httpd.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class SyntheticRepository(object):
+    """
+    Generator of synthetic data for fake server
+
+    For every component there are two sources (a mirror and repo of
+    updates), each with packages * versions package refs in repository and
+    snapshots-many snapshots of them, each snapshot has one to versions
+    versions of every package. Publishes <prefix><n>/nightly are published
+    from the older snapshots of mirrors, so publishing updates them to the
+    latest merged snapshots.
+    """
+    def __init__(self, packages=1000, snapshots=8, publishes=4,
+                 components=('main', 'extra'), versions=3, prefix='bench',
+                 server_version='1.5.0'):
+        self.packages = packages
+        self.snapshots = max(snapshots, 2)
+        self.publishes = publishes
+        self.components = list(components)
+        self.versions = versions
+        self.prefix = prefix
+        self.server_version = server_version
+        self._refs = {}
+
+    @property
+    def sources(self):
+        """
+        Return list of tuples (config section, source name, component)
+        """
+        sources = []
+        for component in self.components:
+            sources.append(('mirror', '%s-%s' % (self.prefix, component), component))
+            sources.append(('repo', '%s-%s-updates' % (self.prefix, component), component))
+        return sources
+
+    @property
+    def distributions(self):
+        return ['%s%s/nightly' % (self.prefix, i) for i in range(self.publishes)]
+
+    def snapshot_name(self, source, number):
+        return '%s-%04d' % (source, number)
+
+    def _source_refs(self, source):
+        # package refs are generated once and shared by generated states
+        try:
+            return self._refs[source]
+        except KeyError:
+            pass
+
+        refs = []
+        for package in range(self.packages):
+            versions = []
+            for version in range(1, self.versions + 1):
+                files_hash = hashlib.md5(('%s %s %s' % (source, package, version)).encode('utf-8')).hexdigest()[:16]
+                versions.append('Pamd64 %s-pkg%05d 1.%s-1 %s' % (source, package, version, files_hash))
+            refs.append(versions)
+        self._refs[source] = refs
+        return refs
+
+    def snapshot_refs(self, source, number):
+        """
+        Return package refs of given snapshot of source
+        """
+        return [ref for package, versions in enumerate(self._source_refs(source))
+                for ref in versions[:1 + (number + package) % self.versions]]
+
+    def state(self):
+        """
+        Return new FakeAptlyState with generated data
+        """
+        state = FakeAptlyState(version=self.server_version)
+        per_source = max(self.snapshots // len(self.sources), 2)
+        for _, source, _ in self.sources:
+            state.add_repo(source, [ref for versions in self._source_refs(source) for ref in versions])
+
+        for number in range(per_source):
+            for _, source, _ in self.sources:
+                state.add_snapshot(self.snapshot_name(source, number),
+                                   self.snapshot_refs(source, number), repo=source)
+
+        for distribution in self.distributions:
+            prefix, distribution = distribution.split('/')
+            state.add_publish(prefix, distribution, [
+                (component, self.snapshot_name(source, per_source - 2))
+                for section, source, component in self.sources if section == 'mirror'
+            ])
+        return state
+
+    def config(self):
+        """
+        Return publisher configuration of generated sources
+        """
+        config = {'mirror': {}, 'repo': {}}
+        for section, source, component in self.sources:
+            config[section][source] = {
+                'component': component,
+                'distributions': self.distributions,
+                'architectures': ['amd64'],
+            }
+        return config
@@ -19,7 +19,12 @@ setup(
         'requests>=0.14',
         'PyYaml',
         'python-apt',
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'orjson': ['orjson'],
+    },
     entry_points={
         'console_scripts': ['aptly-publisher = aptly.publisher.__main__:main']
     },
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.fake_aptly import FakeAptlyServer, FakeAptlyState
+from aptly.client import Aptly
+from aptly.publisher import PublishManager
+from aptly.publisher.archive import DumpArchive
+
+
+def _merge(state, name, sources):
+    refs = [ref for source in sources for ref in state.snapshots[source]['refs']]
+    state.add_snapshot(name, refs, sources=sources,
+                       description="Merged from sources: %s" % ', '.join("'%s'" % source for source in sources))
+
+
+class TestIncrementalArchive(unittest.TestCase):
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.state = FakeAptlyState()
+        self.state.add_snapshot('a-1', ['Pamd64 a 1 1a'])
+        self.state.add_snapshot('b-1', ['Pamd64 c 1 1c'])
+        _merge(self.state, '_x-main-1', ['a-1', 'b-1'])
+        self.state.add_publish('x', 'nightly', [('main', '_x-main-1')])
+        self.server = FakeAptlyServer(self.state).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dump_dir)
+
+    def _dump(self, prefix, baseline=None):
+        manager = PublishManager(Aptly(self.server.url))
+        failures = manager.dump_publishes(['all'], self.dump_dir, prefix,
+                                          dump_format='archive', baseline=baseline)
+        self.assertFalse(failures)
+        path, = [os.path.join(self.dump_dir, name) for name in os.listdir(self.dump_dir)
+                 if name.startswith(prefix)]
+        return path
+
+    def _refs(self, path):
+        with DumpArchive(path) as archive:
+            publish, = archive.publishes()
+            component, = archive.load_publish(publish)['components']
+            return component['refs']
+
+    def test_changed_merge_source(self):
+        base = self._dump('base-')
+        self.assertEqual(self._refs(base), ['Pamd64 a 1 1a', 'Pamd64 c 1 1c'])
+
+        # Only second source of published merge snapshot changes
+        self.state.add_snapshot('b-2', ['Pamd64 c 2 2c', 'Pamd64 d 1 1d'])
+        _merge(self.state, '_x-main-2', ['a-1', 'b-2'])
+        self.state.publishes[('', 'x', 'nightly')]['Sources'] = [{'Component': 'main', 'Name': '_x-main-2'}]
+
+        incremental = self._dump('incremental-', baseline=base)
+        self.assertEqual(self._refs(incremental),
+                         ['Pamd64 a 1 1a', 'Pamd64 c 2 2c', 'Pamd64 d 1 1d'])
+
+    def test_unchanged_publish(self):
+        base = self._dump('base-')
+        incremental = self._dump('incremental-', baseline=base)
+        with DumpArchive(incremental) as archive:
+            self.assertEqual(archive.manifest['refs']['count'], 0)
+        self.assertEqual(self._refs(incremental), self._refs(base))
+
+
+if __name__ == '__main__':
+    unittest.main()